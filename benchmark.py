@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# Offline benchmark for the download pipeline in main.py. A local HTTP server serves
+# synthetic media generated with FFmpeg, and the real download functions fetch it through
+# yt-dlp's generic extractor, so runs need no network and are repeatable. Every scenario
+# runs in its own process with its own HOME, so cache, archive and peak memory start fresh.
+import os
+import sys
+import json
+import re
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import threading
+import mimetypes
+import http.server
+from pathlib import Path
+from colorama import init, Fore, Style
+
+init(autoreset=True)
+
+REPO_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = REPO_DIR / "benchmark-results"
+# Metrics shown by --compare; for the first four lower is better
+COMPARED_METRICS = ["wall_s", "extract_s", "ttfb_s", "postprocess_s", "throughput_mibs", "aggregate_mibs"]
+LOWER_IS_BETTER = {"wall_s", "extract_s", "ttfb_s", "postprocess_s", "cpu_s", "peak_rss_mb"}
+
+# HTTP server for the generated media with byte ranges, a per-connection speed limit
+# and a fixed delay before each response. /sweep/<name>-<n>.<ext> serves <name>.<ext>,
+# so one file can be downloaded many times under different titles.
+class MediaHandler(http.server.SimpleHTTPRequestHandler):
+    root = None
+    rate = 0  # Bytes/s per connection, 0 = unlimited
+    latency = 0.0  # Seconds before each response
+
+    def log_message(self, *args):
+        pass
+
+    def _file(self):
+        path = self.path.split('?')[0]
+        match = re.fullmatch(r'/sweep/(.+)-\d+(\.\w+)', path)
+        if match:
+            path = f"/{match.group(1)}{match.group(2)}"
+        file = (self.root / path.lstrip('/')).resolve()
+        return file if file.is_file() and self.root in file.parents else None
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def _serve(self, head):
+        time.sleep(self.latency)
+        file = self._file()
+        if file is None:
+            self.send_error(404)
+            return
+        size = file.stat().st_size
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(file.name)[0] or 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+        with open(file, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            started = time.monotonic()
+            sent = 0
+            while left > 0:
+                chunk = f.read(min(64 * 1024, left))
+                try:
+                    self.wfile.write(chunk)
+                except OSError:
+                    return
+                left -= len(chunk)
+                sent += len(chunk)
+                if self.rate:
+                    # Sleep until the bytes sent so far fit the rate
+                    delay = sent / self.rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
+def start_server(root, rate, latency):
+    handler = type("Handler", (MediaHandler,), {'root': Path(root).resolve(), 'rate': rate, 'latency': latency})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="benchmark-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def ffmpeg(*args):
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args], check=True)
+
+# Synthetic media: noise video (so it doesn't compress below the target size) with a tone,
+# as one progressive MP4 and as HLS with separate video and audio renditions
+def generate_media(media_dir, size_mb, duration, fragments):
+    media_dir.mkdir(parents=True, exist_ok=True)
+    video_kbps = max(int(size_mb * 8 * 1024 / duration) - 128, 100)
+    source = media_dir / "video.mp4"
+    print(f"{Fore.BLUE}Generating {size_mb} MB / {duration}s of synthetic media...{Style.RESET_ALL}")
+    ffmpeg("-f", "lavfi", "-i", f"color=gray:s=640x360:d={duration},noise=alls=60:allf=t",
+           "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+           "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k",
+           "-bufsize", f"{video_kbps}k", "-force_key_frames", f"expr:gte(t,n_forced*{duration / fragments})",
+           "-c:a", "aac", "-b:a", "128k", "-shortest", "-movflags", "+faststart", str(source))
+    hls = media_dir / "hls"
+    hls.mkdir(exist_ok=True)
+    for kind, stream in (("v", "0:v"), ("a", "0:a")):
+        ffmpeg("-i", str(source), "-map", stream, "-c", "copy", "-f", "hls", "-hls_time", str(duration / fragments),
+               "-hls_playlist_type", "vod", "-hls_segment_filename", str(hls / f"{kind}_%04d.ts"), str(hls / f"{kind}.m3u8"))
+    (hls / "master.m3u8").write_text(
+        "#EXTM3U\n"
+        '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="audio",DEFAULT=YES,AUTOSELECT=YES,URI="a.m3u8"\n'
+        f'#EXT-X-STREAM-INF:BANDWIDTH={video_kbps * 1000},RESOLUTION=640x360,CODECS="avc1.42e01e,mp4a.40.2",AUDIO="aud"\n'
+        "v.m3u8\n")
+
+# The scenarios of a run. Each one names a download function, the URLs it gets and
+# config overrides; sweep scenarios push several links through the scheduler.
+def build_scenarios(args):
+    segmented = {'segment_min_mb': max(args.size_mb // 4, 1)}
+    scenarios = [
+        {'name': "progressive", 'kind': "video", 'urls': ["/video.mp4"]},
+        {'name': "progressive-segmented", 'kind': "video", 'urls': ["/video.mp4"], 'config': segmented},
+        {'name': "progressive-single-connection", 'kind': "video", 'urls': ["/video.mp4"],
+         'config': {'segmented_downloads': False}},
+        {'name': f"hls-{args.fragments}-fragments-merge", 'kind': "video", 'urls': ["/hls/master.m3u8"]},
+        {'name': "audio-copy", 'kind': "audio", 'urls': ["/video.mp4"], 'audio_codec': "original"},
+        {'name': "audio-transcode-mp3", 'kind': "audio", 'urls': ["/video.mp4"], 'audio_codec': "mp3"},
+    ]
+    for concurrency in args.sweep:
+        scenarios.append({'name': f"sweep-concurrency-{concurrency}", 'kind': "video", 'concurrency': concurrency,
+                          'urls': [f"/sweep/video-{n}.mp4" for n in range(args.sweep_links)]})
+    if args.only:
+        scenarios = [s for s in scenarios if any(pattern in s['name'] for pattern in args.only)]
+    return scenarios
+
+# Run one scenario in a child process and return its measurements
+def run_scenario(scenario, base_url, work_dir):
+    home = Path(tempfile.mkdtemp(prefix="home-", dir=work_dir))
+    result_file = home / "result.json"
+    env = {**os.environ, 'HOME': str(home), 'USERPROFILE': str(home)}
+    spec = {**scenario, 'urls': [base_url + path for path in scenario['urls']]}
+    started = time.monotonic()
+    proc = subprocess.run([sys.executable, __file__, "--child", json.dumps(spec), str(result_file)],
+                          env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if not result_file.exists():
+        return {'name': scenario['name'], 'ok': False, 'wall_s': round(time.monotonic() - started, 3),
+                'error': proc.stderr.strip().splitlines()[-1:] or ["no result"]}
+    result = json.loads(result_file.read_text())
+    shutil.rmtree(home, ignore_errors=True)
+    return result
+
+# Startup cost of main.py: Python code run in a fresh process, and whether the ffmpeg probe
+# cache is filled first (warm) or left empty (cold)
+STARTUP_SCENARIOS = [
+    ("startup-import", "import main", False),
+    ("startup-help", "import sys, main; sys.argv = ['main.py', '--help']; main.main()", False),
+    ("startup-ffmpeg-probe-cold", "import main; main.probe_ffmpeg()", False),
+    ("startup-ffmpeg-probe-warm", "import main; main.probe_ffmpeg()", True),
+]
+
+# Median wall time of `runs` fresh processes, each with its own HOME
+def run_startup(name, code, warm, work_dir, runs):
+    times = []
+    for _ in range(runs):
+        home = Path(tempfile.mkdtemp(prefix="home-", dir=work_dir))
+        env = {**os.environ, 'HOME': str(home), 'USERPROFILE': str(home)}
+        if warm:
+            subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL)
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append(time.perf_counter() - started)
+        shutil.rmtree(home, ignore_errors=True)
+        if proc.returncode:
+            return {'name': name, 'kind': "startup", 'ok': False, 'error': proc.stderr.strip().splitlines()[-1:]}
+    return {'name': name, 'kind': "startup", 'ok': True, 'runs': runs,
+            'wall_s': round(sorted(times)[len(times) // 2], 3), 'min_s': round(min(times), 3)}
+
+# Child side: import main with the temporary HOME in place, instrument it and run the scenario
+def child(spec, result_file):
+    import resource
+    import yt_dlp
+    import main
+
+    lock = threading.Lock()
+    timings = {'extract_s': 0.0, 'postprocess_s': 0.0, 'bytes': 0, 'transfer_s': 0.0}
+    job_start, first_byte, file_start = {}, {}, {}
+
+    extract_once = main.extract_once
+    def timed_extract_once(*a, **k):
+        start = time.perf_counter()
+        try:
+            return extract_once(*a, **k)
+        finally:
+            with lock:
+                timings['extract_s'] += time.perf_counter() - start
+    main.extract_once = timed_extract_once
+
+    post_process = yt_dlp.YoutubeDL.post_process
+    def timed_post_process(self, *a, **k):
+        start = time.perf_counter()
+        try:
+            return post_process(self, *a, **k)
+        finally:
+            with lock:
+                timings['postprocess_s'] += time.perf_counter() - start
+    yt_dlp.YoutubeDL.post_process = timed_post_process
+
+    board_add = main.ProgressBoard.add
+    def timed_add(self, url, kind):
+        task = board_add(self, url, kind)
+        job_start[task] = time.perf_counter()
+        return task
+    main.ProgressBoard.add = timed_add
+
+    hook = main.ProgressTask.hook
+    def timed_hook(task, d):
+        now = time.perf_counter()
+        key = (task, d.get('filename'))
+        with lock:
+            if d['status'] == 'downloading' and d.get('downloaded_bytes'):
+                first_byte.setdefault(task, now)
+                file_start.setdefault(key, now)
+            elif d['status'] == 'finished' and key in file_start:
+                timings['transfer_s'] += now - file_start.pop(key)
+                timings['bytes'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+        return hook(task, d)
+    main.ProgressTask.hook = timed_hook
+
+    main.ASSUME_YES = True
+    config = main.load_config()
+    config.update({'use_cache': False, 'use_archive': False, **spec.get('config', {})})
+    main.POSTPROCESS.configure(config['postprocess_workers'], config['postprocess_queue'])
+    main.BANDWIDTH.configure(config)
+    main.HTTP_SESSION.configure(config)
+    if spec['kind'] == 'video':
+        job_fn = lambda job: main.download_video(job.url, 'best', config, job)
+    else:
+        job_fn = lambda job: main.download_audio(job.url, 'best', config, job, spec['audio_codec'])
+
+    wall_start = time.perf_counter()
+    results = []
+    main.run_jobs(iter(spec['urls']), job_fn, spec.get('concurrency', 1), spec.get('concurrency', 1),
+                  on_done=results.append)
+    wall = time.perf_counter() - wall_start
+
+    usage, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    ttfbs = [first_byte[task] - job_start[task] for task in first_byte]
+    mib = 1024 * 1024
+    result = {
+        'name': spec['name'],
+        'ok': all(job.status == 'ok' for job in results) and len(results) == len(spec['urls']),
+        'links': len(spec['urls']),
+        'concurrency': spec.get('concurrency', 1),
+        'wall_s': round(wall, 3),
+        # Per link, so runs with different link counts compare
+        'extract_s': round(timings['extract_s'] / len(spec['urls']), 3),
+        'ttfb_s': round(sum(ttfbs) / len(ttfbs), 3) if ttfbs else None,
+        'transfer_s': round(timings['transfer_s'], 3),
+        'bytes': timings['bytes'],
+        'throughput_mibs': round(timings['bytes'] / timings['transfer_s'] / mib, 2) if timings['transfer_s'] else None,
+        'aggregate_mibs': round(timings['bytes'] / wall / mib, 2) if wall else None,
+        'postprocess_s': round(timings['postprocess_s'] / len(spec['urls']), 3),
+        'cpu_s': round(cpu, 3),
+        'cpu_util': round(cpu / wall, 2) if wall else None,
+        'peak_rss_mb': round(max(usage.ru_maxrss, children.ru_maxrss) * rss_unit / mib, 1),
+    }
+    Path(result_file).write_text(json.dumps(result))
+
+def print_results(results):
+    print(f"{Fore.YELLOW}{'scenario':<34}{'wall':>8}{'extract':>9}{'ttfb':>8}{'MiB/s':>8}{'agg':>8}{'pp':>8}{'cpu':>6}{'rss MB':>8}{Style.RESET_ALL}")
+    fmt = lambda value, spec: format(value, spec) if value is not None else "-"
+    for r in results:
+        color = Fore.GREEN if r['ok'] else Fore.RED
+        if r.get('kind') == "startup" and r['ok']:
+            print(f"{color}{r['name']:<34}{fmt(r['wall_s'], '8.3f')}  (median of {r['runs']}, min {r['min_s']:.3f}){Style.RESET_ALL}")
+            continue
+        if 'extract_s' not in r:
+            print(f"{color}{r['name']:<34} failed: {r.get('error')}{Style.RESET_ALL}")
+            continue
+        print(f"{color}{r['name']:<34}{fmt(r['wall_s'], '8.2f')}{fmt(r['extract_s'], '9.3f')}{fmt(r['ttfb_s'], '8.3f')}"
+              f"{fmt(r['throughput_mibs'], '8.2f')}{fmt(r['aggregate_mibs'], '8.2f')}{fmt(r['postprocess_s'], '8.2f')}"
+              f"{fmt(r['cpu_util'], '6.2f')}{fmt(r['peak_rss_mb'], '8.1f')}{Style.RESET_ALL}")
+
+# Print the change of each metric against an earlier results file
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    print(f"{Fore.BLUE}Compared with {baseline_file}:{Style.RESET_ALL}")
+    for r in results:
+        old = baseline.get(r['name'])
+        if not old:
+            continue
+        changes = []
+        for metric in COMPARED_METRICS:
+            before, after = old.get(metric), r.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            better = change < 0 if metric in LOWER_IS_BETTER else change > 0
+            color = Fore.GREEN if better else Fore.RED if abs(change) >= 5 else ""
+            changes.append(f"{metric} {before:g}→{after:g} ({color}{change:+.0f}%{Style.RESET_ALL})")
+        print(f"  {r['name']}: " + ", ".join(changes))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the yt-dlp-downloader pipeline.")
+    parser.add_argument('--size-mb', type=int, default=16, help="size of the synthetic video (default: 16)")
+    parser.add_argument('--duration', type=int, default=10, help="length of the synthetic video in seconds (default: 10)")
+    parser.add_argument('--fragments', type=int, default=20, help="number of HLS fragments (default: 20)")
+    parser.add_argument('--rate-kbps', type=int, default=4096,
+                        help="speed limit per connection in KiB/s, 0 for none (default: 4096)")
+    parser.add_argument('--latency-ms', type=int, default=20, help="server delay before every response (default: 20)")
+    parser.add_argument('--sweep', type=lambda v: [int(n) for n in v.split(',')], default=[1, 2, 4, 8],
+                        help="concurrency levels of the sweep, comma-separated (default: 1,2,4,8)")
+    parser.add_argument('--sweep-links', type=int, default=8, help="links downloaded in each sweep run (default: 8)")
+    parser.add_argument('--startup-runs', type=int, default=5, help="processes started per startup scenario (default: 5)")
+    parser.add_argument('--only', action='append', metavar='TEXT', help="run only scenarios whose name contains TEXT (repeatable)")
+    parser.add_argument('--output', help="results file (default: benchmark-results/<time>.json)")
+    parser.add_argument('--compare', metavar='PATH', help="earlier results file to compare with")
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.child:
+        child(json.loads(args.child[0]), args.child[1])
+        return
+    if not shutil.which("ffmpeg"):
+        print(f"{Fore.RED}Error: FFmpeg is needed to generate the benchmark media.{Style.RESET_ALL}")
+        sys.exit(2)
+
+    import yt_dlp
+    with tempfile.TemporaryDirectory(prefix="yt-dlp-benchmark-") as work:
+        work_dir = Path(work)
+        results = []
+        for name, code, warm in STARTUP_SCENARIOS:
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            print(f"{Fore.CYAN}➤ {name}{Style.RESET_ALL}", flush=True)
+            results.append(run_startup(name, code, warm, work_dir, args.startup_runs))
+        scenarios = build_scenarios(args)
+        if scenarios:
+            generate_media(work_dir / "media", args.size_mb, args.duration, args.fragments)
+            server, base_url = start_server(work_dir / "media", args.rate_kbps * 1024, args.latency_ms / 1000)
+            for scenario in scenarios:
+                print(f"{Fore.CYAN}➤ {scenario['name']}{Style.RESET_ALL}", flush=True)
+                results.append(run_scenario(scenario, base_url, work_dir))
+            server.shutdown()
+
+    print_results(results)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'yt_dlp': yt_dlp.version.__version__,
+        'cpu_count': os.cpu_count(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('child', 'output', 'compare')},
+        'results': results,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"{Fore.GREEN}Results written to {output}{Style.RESET_ALL}")
+    if args.compare:
+        compare(results, args.compare)
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+if __name__ == "__main__":
+    main()
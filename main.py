@@ -1,34 +1,190 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
 import re
 from pathlib import Path
 import subprocess
-import yt_dlp
-from colorama import init, Fore, Style
 import shutil
-from tqdm import tqdm
 import time
+import threading
+import hashlib
+import argparse
+import zlib
+import itertools
+import collections
+import functools
+import importlib
+import contextlib
+import datetime
+import signal
+import errno
+import socket
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
 
-# Initialize colorama for colored terminal output
-init(autoreset=True)
+# yt-dlp and tqdm are most of the startup time. They are imported on first use, so --help,
+# the prompts and runs that never reach a download don't pay for them; so are the
+# database, the terminal colors and, through lazy_base, the daemon's HTTP server and client.
+# With attr, the lazy object is that attribute of the module, e.g. colorama's Fore.
+class LazyModule:
+    def __init__(self, name, attr=None):
+        self.name = name
+        self.attr = attr
+
+    def __getattr__(self, attr):
+        target = importlib.import_module(self.name)
+        if self.attr:
+            target = getattr(target, self.attr)
+        value = getattr(target, attr)
+        setattr(self, attr, value)
+        return value
+
+yt_dlp = LazyModule('yt_dlp')
+tqdm = LazyModule('tqdm')
+sqlite3 = LazyModule('sqlite3')
+colorama = LazyModule('colorama')
+Fore = LazyModule('colorama', 'Fore')
+Style = LazyModule('colorama', 'Style')
+
+# Classes built on a class from another module are declared without that base and get it
+# when first used, so defining them imports nothing. base is a dotted path inside module.
+# Calling, isinstance()/issubclass() and attribute access (e.g. a staticmethod) all go to
+# the built class.
+class LazySubclass:
+    lock = threading.Lock()
+
+    def __init__(self, cls, module, base):
+        self.cls = cls
+        self.module = module
+        self.base = base
+        self.built = None
+
+    def build(self):
+        with self.lock:
+            if self.built is None:
+                base = functools.reduce(getattr, self.base.split('.'), importlib.import_module(self.module))
+                # The class body is passed on again so the base's metaclass sees it
+                # (PostProcessor wraps run() to fire the postprocessor hooks)
+                namespace = {k: v for k, v in vars(self.cls).items() if k not in ('__dict__', '__weakref__')}
+                self.built = type(self.cls.__name__, (self.cls, base), namespace)
+        return self.built
+
+    def __call__(self, *args, **kwargs):
+        return self.build()(*args, **kwargs)
+
+    # Only reached for names the proxy itself doesn't have
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.build(), attr)
+
+    def __instancecheck__(self, obj):
+        return isinstance(obj, self.build())
+
+    def __subclasscheck__(self, cls):
+        return issubclass(cls, self.build())
+
+def lazy_base(module, base):
+    return lambda cls: LazySubclass(cls, module, base)
+
+def ytdlp_base(base):
+    return lazy_base('yt_dlp', base)
 
 # Define directories
 HOME = Path.home()
 VIDEO_DIR = HOME / "Downloads" / "YT-DLP" / "Videos"
 AUDIO_DIR = HOME / "Downloads" / "YT-DLP" / "Audios"
 CONFIG_FILE = HOME / ".yt_dlp_config.json"
+CACHE_FILE = HOME / ".yt_dlp_cache.sqlite3"
+ARCHIVE_FILE = HOME / ".yt_dlp_archive.sqlite3"
+JOURNAL_FILE = HOME / ".yt_dlp_journal.sqlite3"
+SYNC_FILE = HOME / ".yt_dlp_sync.sqlite3"
+FFMPEG_PROBE_FILE = HOME / ".yt_dlp_ffmpeg.json"
+DAEMON_SOCKET = HOME / ".yt_dlp_daemon.sock"
+WORK_FILE = HOME / ".yt_dlp_work.sqlite3"
+
+# Set on Ctrl-C; progress hooks abort in-flight downloads when they see it
+CANCEL_EVENT = threading.Event()
+# Serializes confirmation prompts coming from concurrent download jobs
+PROMPT_LOCK = threading.Lock()
+# Set by headless batch mode: every confirmation is answered with yes
+ASSUME_YES = False
+
+# Exit codes of headless batch mode
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+# ffmpeg and ffprobe paths, versions and ffmpeg's encoders. Probed once per process and
+# cached in FFMPEG_PROBE_FILE until either binary is replaced (path, size or mtime change).
+FFMPEG_PROBE = None
+FFMPEG_PROBE_LOCK = threading.Lock()
+FFMPEG_PROGRAMS = ('ffmpeg', 'ffprobe')
+
+def probe_ffmpeg():
+    global FFMPEG_PROBE
+    with FFMPEG_PROBE_LOCK:
+        if FFMPEG_PROBE is None:
+            FFMPEG_PROBE = load_ffmpeg_probe()
+        return FFMPEG_PROBE
+
+def load_ffmpeg_probe():
+    paths = {name: shutil.which(name) for name in FFMPEG_PROGRAMS}
+    stamps = {}
+    for name, path in paths.items():
+        if path:
+            stat = os.stat(path)
+            stamps[name] = [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+    try:
+        cached = json.loads(FFMPEG_PROBE_FILE.read_text())
+        if cached.get('stamps') == stamps:
+            return cached
+    except (OSError, ValueError):
+        pass
+
+    probe = {'stamps': stamps, 'paths': paths, 'versions': {}, 'features': {}, 'encoders': []}
+    if paths['ffmpeg']:
+        # yt-dlp's own parsing, so the result can be handed back to it as is
+        versions, probe['features'] = yt_dlp.postprocessor.FFmpegPostProcessor.get_versions_and_features()
+        probe['versions'] = {name: versions.get(name) for name in FFMPEG_PROGRAMS}
+        try:
+            out = subprocess.run([paths['ffmpeg'], '-hide_banner', '-encoders'],
+                                 capture_output=True, text=True, timeout=30).stdout
+            # Encoder lines follow the legend, e.g. " A....D libmp3lame  libmp3lame MP3 ..."
+            probe['encoders'] = re.findall(r'(?m)^\s*[VAS][.A-Z]{5}\s+(\S+)', out.partition('------')[2])
+        except (OSError, subprocess.SubprocessError):
+            pass
+    try:
+        FFMPEG_PROBE_FILE.write_text(json.dumps(probe))
+    except OSError:
+        pass
+    return probe
 
-# Ensure directories exist
-VIDEO_DIR.mkdir(parents=True, exist_ok=True)
-AUDIO_DIR.mkdir(parents=True, exist_ok=True)
+# Hand the cached versions to yt-dlp, which would otherwise run ffmpeg -version and
+# ffprobe -version again in every process that merges or converts
+def seed_ffmpeg_versions(probe):
+    pp = yt_dlp.postprocessor.FFmpegPostProcessor
+    for name in FFMPEG_PROGRAMS:
+        pp._version_cache.setdefault(name, probe['versions'].get(name) or False)
+    if probe['features']:
+        pp._features_cache.setdefault('ffmpeg', probe['features'])
+
+def ffmpeg_has_encoder(encoder):
+    encoders = probe_ffmpeg()['encoders']
+    # An empty list means the probe couldn't list them; don't refuse on that
+    return not encoders or encoder in encoders
 
 # Check if ffmpeg is available
 def check_ffmpeg():
-    ffmpeg_path = shutil.which("ffmpeg")
-    if not ffmpeg_path:
+    probe = probe_ffmpeg()
+    if not probe['paths']['ffmpeg']:
         print(f"{Fore.RED}Error: FFmpeg is not installed or not found in PATH. Please install FFmpeg and add it to your system PATH.{Style.RESET_ALL}")
         return False
+    seed_ffmpeg_versions(probe)
     return True
 
 # Load default settings
@@ -37,15 +193,45 @@ def load_config():
         "download_type": "1",
         "video_quality": "best",
         "audio_quality": "320",
+        "audio_codec": "mp3",
         "advanced_format": "bestvideo+bestaudio/best",
         "subtitles": False,
         "thumbnails": False,
-        "metadata": False
+        "metadata": False,
+        "concurrency": 3,
+        "per_host_limit": 2,
+        "use_cache": True,
+        "cache_ttl_hours": 168,
+        "stream_ttl_minutes": 60,
+        "cache_max_mb": 256,
+        "use_archive": True,
+        "postprocess_workers": 0,
+        "postprocess_queue": 0,
+        "segmented_downloads": True,
+        "max_segments": 8,
+        "segment_min_mb": 32,
+        "bandwidth_limit_mbps": 0,
+        "bandwidth_schedule": [],
+        "bandwidth_weights": {"high": 8, "normal": 4, "bulk": 1},
+        "priority": "auto",
+        "trace_file": "",
+        "metrics_file": "",
+        "daemon_address": "",
+        "daemon_token": "",
+        "shared_session": True,
+        "adaptive_deadline": "",
+        "adaptive_budget_gb": 0,
+        "sync_concurrency": 16,
+        "work_store": "",
+        "work_lease_seconds": 60,
+        "staging_dir": "",
+        "min_free_gb": 1
     }
     if CONFIG_FILE.exists():
         try:
             with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+                # Older config files may lack newer keys; fall back to defaults for those
+                return {**default_config, **json.load(f)}
         except json.JSONDecodeError:
             print(f"{Fore.RED}Error: Corrupted config file. Using default settings.{Style.RESET_ALL}")
     return default_config
@@ -55,20 +241,29 @@ def clean_filename(title):
     return re.sub(r'[<>:"/\\|?*]', '', title).strip()[:200]  # Basic cleaning, consider pathvalidate for more robustness
 
 # Get video info using yt-dlp
-def get_video_info(url):
+def get_video_info(url, config=None):
+    config = config or load_config()
+    # Only durable metadata is needed here, so expired stream URLs don't matter
+    if config['use_cache']:
+        info = cache_get(url, config, need_streams=False)
+        if info:
+            return info
     with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
         try:
             info = ydl.extract_info(url, download=False)
+            cache_put(url, info, config)
             return info
         except yt_dlp.DownloadError as e:
             print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
             return None
 
+URL_RE = re.compile(r'https?://.*')
+
 # Get user input for links
 def get_links():
     print(f"{Fore.GREEN}Enter YouTube video or playlist links (separated by space):{Style.RESET_ALL}")
     links = input(f"{Fore.CYAN}➤ {Style.RESET_ALL}").strip().split()
-    valid_links = [link for link in links if re.match(r'https?://.*', link)]
+    valid_links = [link for link in links if URL_RE.match(link)]
     if not valid_links:
         print(f"{Fore.RED}No valid URLs provided. Exiting.{Style.RESET_ALL}")
         return []
@@ -80,15 +275,19 @@ def choose_download_type(config):
     print(f"{Fore.GREEN}1. Video (MP4){Style.RESET_ALL}")
     print(f"{Fore.GREEN}2. Audio (MP3 / other){Style.RESET_ALL}")
     print(f"{Fore.GREEN}3. Advanced (custom format & options){Style.RESET_ALL}")
-    choice = input(f"{Fore.CYAN}➤ Enter choice (1-3, default: {config['download_type']}): {Style.RESET_ALL}").strip() or config['download_type']
-    while choice not in ['1', '2', '3']:
-        print(f"{Fore.RED}Invalid choice. Please select 1, 2, or 3.{Style.RESET_ALL}")
-        choice = input(f"{Fore.CYAN}➤ Enter choice (1-3): {Style.RESET_ALL}").strip() or config['download_type']
+    print(f"{Fore.GREEN}4. Video + Audio (audio taken from the video, no second download){Style.RESET_ALL}")
+    choice = input(f"{Fore.CYAN}➤ Enter choice (1-4, default: {config['download_type']}): {Style.RESET_ALL}").strip() or config['download_type']
+    while choice not in ['1', '2', '3', '4']:
+        print(f"{Fore.RED}Invalid choice. Please select 1, 2, 3, or 4.{Style.RESET_ALL}")
+        choice = input(f"{Fore.CYAN}➤ Enter choice (1-4): {Style.RESET_ALL}").strip() or config['download_type']
     return choice
 
 # Choose video quality
+VIDEO_QUALITIES = ["best", "360p", "480p", "720p", "1080p", "1440p", "2160p", "adaptive"]
+AUDIO_QUALITIES = ["best", "128", "192", "256", "320"]
+
 def choose_video_quality(config):
-    qualities = ["best", "360p", "480p", "720p", "1080p", "1440p", "2160p"]
+    qualities = VIDEO_QUALITIES
     print(f"{Fore.BLUE}Available video qualities:{Style.RESET_ALL}")
     print(f"{Fore.GREEN}1. Best Quality available{Style.RESET_ALL}")
     print(f"{Fore.GREEN}2. 360p{Style.RESET_ALL}")
@@ -97,15 +296,28 @@ def choose_video_quality(config):
     print(f"{Fore.GREEN}5. 1080p (FHD){Style.RESET_ALL}")
     print(f"{Fore.GREEN}6. 1440p (QHD){Style.RESET_ALL}")
     print(f"{Fore.GREEN}7. 2160p (4K){Style.RESET_ALL}")
+    print(f"{Fore.GREEN}8. Adaptive (best quality that meets a deadline / data budget){Style.RESET_ALL}")
     choice = input(f"{Fore.CYAN}➤ Select quality (1-{len(qualities)}, default: {config['video_quality']}): {Style.RESET_ALL}").strip()
-    if choice.isdigit() and 1 <= int(choice) <= len(qualities):
-        return qualities[int(choice) - 1]
-    return config['video_quality']
+    quality = qualities[int(choice) - 1] if choice.isdigit() and 1 <= int(choice) <= len(qualities) else config['video_quality']
+    if quality == "adaptive" and not (config['adaptive_deadline'] or config['adaptive_budget_gb']):
+        choose_adaptive_limits(config)
+    return quality
+
+# Ask for the deadline and data budget adaptive quality plans against
+def choose_adaptive_limits(config):
+    while True:
+        deadline = input(f"{Fore.CYAN}➤ Finish by (HH:MM or e.g. 8h, blank for none): {Style.RESET_ALL}").strip()
+        budget = input(f"{Fore.CYAN}➤ Data budget in GB (blank for none): {Style.RESET_ALL}").strip()
+        try:
+            ADAPTIVE.configure({**config, 'adaptive_deadline': deadline, 'adaptive_budget_gb': float(budget or 0)})
+            return
+        except ValueError as e:
+            print(f"{Fore.RED}Invalid input: {str(e)}{Style.RESET_ALL}")
 
 # Choose audio quality
 def choose_audio_quality(config):
-    qualities = ["best", "128", "192", "256", "320"]
-    print(f"{Fore.BLUE}Available audio qualities (MP3):{Style.RESET_ALL}")
+    qualities = AUDIO_QUALITIES
+    print(f"{Fore.BLUE}Available audio qualities (kept as-is when the source is already at or below it):{Style.RESET_ALL}")
     print(f"{Fore.GREEN}1. Best Quality Available{Style.RESET_ALL}")
     print(f"{Fore.GREEN}2. Standard Quality (128 kbps){Style.RESET_ALL}")
     print(f"{Fore.GREEN}3. High Quality (192 kbps){Style.RESET_ALL}")
@@ -116,6 +328,20 @@ def choose_audio_quality(config):
         return qualities[int(choice) - 1]
     return config['audio_quality']
 
+# Choose audio codec
+def choose_audio_codec(config):
+    print(f"{Fore.BLUE}Available audio codecs:{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}1. MP3{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}2. Original (no re-encode when possible: Opus → .opus, AAC → .m4a, Vorbis → .ogg){Style.RESET_ALL}")
+    print(f"{Fore.GREEN}3. M4A (AAC){Style.RESET_ALL}")
+    print(f"{Fore.GREEN}4. Opus{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}5. Vorbis (OGG){Style.RESET_ALL}")
+    print(f"{Fore.GREEN}6. FLAC{Style.RESET_ALL}")
+    choice = input(f"{Fore.CYAN}➤ Select codec (1-{len(AUDIO_CODECS)}, default: {config['audio_codec']}): {Style.RESET_ALL}").strip()
+    if choice.isdigit() and 1 <= int(choice) <= len(AUDIO_CODECS):
+        return AUDIO_CODECS[int(choice) - 1]
+    return config['audio_codec']
+
 # Advanced options
 def choose_advanced_options(config):
     print(f"{Fore.BLUE}Advanced download options:{Style.RESET_ALL}")
@@ -125,6 +351,13 @@ def choose_advanced_options(config):
     metadata = input(f"{Fore.CYAN}➤ Embed metadata? (y/n, default: {'y' if config['metadata'] else 'n'}): {Style.RESET_ALL}").strip().lower() == 'y'
     return format_str, subtitles, thumbnails, metadata
 
+# Ask a yes/no question; prompts from concurrent jobs never interleave
+def confirm(prompt):
+    if ASSUME_YES:
+        return True
+    with PROMPT_LOCK:
+        return input(f"{Fore.CYAN}➤ {prompt} (y/n): {Style.RESET_ALL}").strip().lower() == 'y'
+
 # Format file size
 def format_size(bytes_size):
     if not bytes_size:
@@ -143,456 +376,4028 @@ def show_pre_download_info(info, format_info, dest_path, quality):
     print(f"{Fore.MAGENTA}Chosen format: {format_info}{Style.RESET_ALL}")
     print(f"{Fore.MAGENTA}Size: {format_size(info.get('filesize') or info.get('filesize_approx'))}{Style.RESET_ALL}")
     print(f"{Fore.MAGENTA}Destination: {dest_path}{Style.RESET_ALL}")
-    return input(f"{Fore.CYAN}➤ Proceed? (y/n): {Style.RESET_ALL}").strip().lower() == 'y'
+    return confirm("Proceed?")
 
 # Progress bar for downloads
 def create_progress_bar(total_size_mb, title):
     if total_size_mb and total_size_mb > 0:
         # Use actual file size if available
-        return tqdm(total=total_size_mb, desc=f"{Fore.GREEN}Downloading {title[:30]}{Style.RESET_ALL}", unit="MiB", bar_format="{l_bar}{bar}| {n:.1f}/{total:.1f} MiB [{elapsed}<{remaining}, {postfix}]")
+        return tqdm.tqdm(total=total_size_mb, desc=f"{Fore.GREEN}Downloading {title[:30]}{Style.RESET_ALL}", unit="MiB", bar_format="{l_bar}{bar}| {n:.1f}/{total:.1f} MiB [{elapsed}<{remaining}, {postfix}]")
     else:
         # Fallback to percentage-based progress bar
-        return tqdm(total=100, desc=f"{Fore.GREEN}Downloading {title[:30]}{Style.RESET_ALL}", unit="%", bar_format="{l_bar}{bar}| {n:.1f}% [{elapsed}<{remaining}, {postfix}]")
+        return tqdm.tqdm(total=100, desc=f"{Fore.GREEN}Downloading {title[:30]}{Style.RESET_ALL}", unit="%", bar_format="{l_bar}{bar}| {n:.1f}% [{elapsed}<{remaining}, {postfix}]")
 
-# Download video
-def download_video(url, quality, config):
-    if not check_ffmpeg():
-        return False
-    
-    # Determine if URL is a playlist
-    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'extract_flat': True}) as ydl:
-        try:
-            flat_info = ydl.extract_info(url, download=False)
-            is_playlist = 'entries' in flat_info
-        except yt_dlp.DownloadError as e:
-            print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
-            return False
-    
-    format_str = "bestvideo+bestaudio/best" if quality == "best" else f"bv*[height<={quality[:-1]}]+ba/best"
-    format_display = quality if quality != "best" else "best"
-    
-    if is_playlist:
-        playlist_title = flat_info.get('title', 'Unknown Playlist')
-        num_videos = len(flat_info['entries'])
-        print(f"{Fore.BLUE}🎥 Playlist: {playlist_title}{Style.RESET_ALL}")
-        print(f"{Fore.BLUE}📋 Number of videos: {num_videos}{Style.RESET_ALL}")
-        if input(f"{Fore.CYAN}➤ Proceed with downloading playlist? (y/n): {Style.RESET_ALL}").strip().lower() != 'y':
-            return False
-        output_filename = "%(title)s (%(height)sp).%(ext)s"
-        output_path = VIDEO_DIR / output_filename
-        pbar = None
-        video_count = 0
-    else:
-        # Single video: fetch info with specified format for accurate size
-        ydl_opts_info = {
-            'format': format_str,
-            'quiet': True,
-            'no_warnings': True
-        }
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl_info:
-            try:
-                info = ydl_info.extract_info(url, download=False)
-            except yt_dlp.DownloadError as e:
-                print(f"{Fore.RED}Error fetching info for {url}: {str(e)}. Falling back to best available.{Style.RESET_ALL}")
-                ydl_opts_info['format'] = 'bestvideo+bestaudio/best'
-                with yt_dlp.YoutubeDL(ydl_opts_info) as ydl_info:
-                    info = ydl_info.extract_info(url, download=False)
-                format_str = 'bestvideo+bestaudio/best'
-                format_display = "best"
-        
-        if not info:
-            return False
-        title = clean_filename(info['title'])
-        height = info.get('height', 'best')
-        quality_display = f"{height}p" if height and format_display == "best" else format_display
-        output_filename = f"{title} ({quality_display}).%(ext)s"
-        output_path = VIDEO_DIR / output_filename
-        
-        if not show_pre_download_info(info, quality_display, str(output_path), quality):
-            return False
-        total_size_mb = (info.get('filesize') or info.get('filesize_approx') or 0) / (1024 * 1024)
-        pbar = create_progress_bar(total_size_mb, title)
-        video_count = 0
-    
-    last_update = 0
-    last_bytes = 0
-    current_title = ""
-    
-    def progress_hook(d):
-        nonlocal pbar, last_update, last_bytes, current_title, video_count
-        current_time = time.time()
+# Progress of one job, written by its yt-dlp progress hook and read by the renderer.
+# The hook runs on the download thread for every chunk, so it only stores numbers.
+class ProgressTask:
+    def __init__(self, board, url, kind):
+        self.board = board
+        self.url = url
+        self.kind = kind
+        self.title = None
+        self.count = 0
+        self.of = 0
+        self.seen = 0
+        self.more = False  # More playlist entries may follow than `of` counts
+        self.downloaded = 0
+        self.total = 0
+        self.expected_total = 0
+        self.speed = 0.0
+        self.eta = None
+        self.filename = None
+        self.priority = "normal"
+        self.allocation = None  # Bytes/s the bandwidth governor currently grants, None if unlimited
+        self.cancelled = False  # Set to stop just this download
+
+    def hook(self, d):
+        if CANCEL_EVENT.is_set() or self.cancelled:
+            raise yt_dlp.utils.DownloadCancelled()
         if d['status'] == 'downloading':
-            # Get current video title
-            title = d.get('info_dict', {}).get('title', 'Unknown')
-            total_size_mb = (d.get('info_dict', {}).get('filesize') or d.get('info_dict', {}).get('filesize_approx') or 0) / (1024 * 1024)
-            if title != current_title:
-                if pbar:
-                    pbar.close()
-                video_count += 1
-                current_title = title
-                desc = f"Video {video_count}/{num_videos}: {title[:30]}" if is_playlist else title[:30]
-                pbar = create_progress_bar(total_size_mb, desc)
-            
-            # Update every 0.1 seconds
-            if current_time - last_update >= 0.1:
-                # Strip ANSI codes from _percent_str
-                percent_str = re.sub(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])', '', d.get('_percent_str', '0%')).strip('%')
-                try:
-                    percent = float(percent_str)
-                except ValueError:
-                    percent = 0.0
-                # Calculate downloaded size in MiB
-                downloaded_bytes = d.get('downloaded_bytes', 0)
-                downloaded_mb = downloaded_bytes / (1024 * 1024)
-                # Calculate speed manually
-                time_delta = current_time - last_update if last_update else 0.1
-                speed_mb_s = (downloaded_bytes - last_bytes) / (1024 * 1024 * time_delta) if time_delta > 0 else 0.0
-                last_bytes = downloaded_bytes
-                last_update = current_time
-                # Update progress bar
-                if pbar and pbar.total > 0 and total_size_mb > 0:
-                    pbar.n = downloaded_mb
-                elif pbar:
-                    pbar.n = percent
-                # Update postfix with ETA and speed
-                eta = d.get('eta', 'Unknown')
-                eta_str = f"ETA {time.strftime('%M:%S', time.gmtime(eta))}" if eta != 'Unknown' else 'ETA Unknown'
-                if pbar:
-                    pbar.set_postfix_str(f"{eta_str}, {speed_mb_s:.2f}MiB/s")
-                    pbar.refresh()
+            title = d['info_dict'].get('title')
+            if title != self.title:
+                self.title = title
+                self.count += 1
+            downloaded = d.get('downloaded_bytes') or 0
+            if d.get('filename') != self.filename:
+                self.filename, self.downloaded = d.get('filename'), 0
+            # Waiting here holds up the downloader's read loop, which is what throttles it.
+            # Segmented downloads throttle each connection themselves.
+            if not d.get('throttled'):
+                self.throttle(max(downloaded - self.downloaded, 0))
+            self.downloaded = downloaded
+            self.total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            self.speed = d.get('speed') or 0.0
+            self.eta = d.get('eta')
         elif d['status'] == 'finished':
-            if pbar:
-                if pbar.total > 0:
-                    pbar.n = pbar.total
-                else:
-                    pbar.n = 100
-                pbar.refresh()
-                pbar.close()
-                pbar = None
-            print(f"{Fore.GREEN}✅ Download complete: {d.get('filename', 'Unknown')}{Style.RESET_ALL}")
+            self.downloaded = self.total
+            self.speed = 0.0
+            tqdm.tqdm.write(f"{Fore.GREEN}✅ Download complete: {d.get('filename', 'Unknown')}{Style.RESET_ALL}")
 
-    ydl_opts = {
-        'format': format_str,
-        'outtmpl': str(output_path),
-        'merge_output_format': 'mp4',
-        'nopostoverwrites': True,  # Prevent overwriting during post-processing
-        'ffmpeg_location': None,
-        'quiet': True,
-        'no_warnings': True,
-        'progress_hooks': [progress_hook],
-        'paths': {'home': str(VIDEO_DIR), 'temp': str(VIDEO_DIR)}
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        return True
-    except yt_dlp.DownloadError as e:
-        if not is_playlist:
-            print(f"{Fore.RED}Error downloading {url}: {str(e)}. Falling back to best available.{Style.RESET_ALL}")
-            ydl_opts['format'] = 'bestvideo+bestaudio/best'
-            ydl_opts['outtmpl'] = str(VIDEO_DIR / f"{title} ({info.get('height', 'best')}p).%(ext)s")
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-                filename = VIDEO_DIR / f"{title} ({info.get('height', 'best')}p).mp4"
-                print(f"{Fore.GREEN}✅ Download complete: {filename}{Style.RESET_ALL}")
-                return True
-            except yt_dlp.DownloadError as e:
-                print(f"{Fore.RED}Failed to download {url}: {str(e)}{Style.RESET_ALL}")
-                return False
-        else:
-            print(f"{Fore.RED}Error downloading playlist {url}: {str(e)}{Style.RESET_ALL}")
-            return False
+    def throttle(self, nbytes):
+        BANDWIDTH.consume(self, nbytes)
 
-# Download audio
-def download_audio(url, audio_quality, config):
-    if not check_ffmpeg():
-        return False
-    
-    # Check if URL is a playlist
-    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'extract_flat': True}) as ydl:
+    # Streamed playlists report their entries page by page; past the size the playlist
+    # announced (or without one), the total is a lower bound
+    def add_entries(self, n):
+        self.seen += n
+        if self.seen > self.of:
+            self.of = self.seen
+            self.more = True
+
+    def label(self):
+        title = (self.title or self.url)[:30]
+        return f"{self.kind} {self.count}/{self.of}{'+' if self.more else ''}: {title}" if self.of else title
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.board.remove(self)
+        BANDWIDTH.release(self)
+
+# Single dashboard for all running downloads. A background thread redraws it at most
+# every TTY_INTERVAL seconds, or prints plain-text lines every TEXT_INTERVAL seconds
+# when stderr is not a terminal.
+class ProgressBoard:
+    TTY_INTERVAL = 0.5
+    TEXT_INTERVAL = 10.0
+
+    def __init__(self):
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.bars = {}
+        self.total_bar = None
+
+    def add(self, url, kind):
+        task = ProgressTask(self, url, kind)
+        with self.lock:
+            self.tasks.append(task)
+        return task
+
+    def remove(self, task):
+        with self.lock:
+            if task in self.tasks:
+                self.tasks.remove(task)
+
+    # Stop the running downloads of one link at their next progress callback
+    def cancel(self, url):
+        with self.lock:
+            for task in self.tasks:
+                if task.url == url:
+                    task.cancelled = True
+
+    def start(self):
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        tty = sys.stderr.isatty()
+        last_print = time.monotonic()
+        while not self.stop_event.wait(self.TTY_INTERVAL):
+            # Bandwidth limit edits in the config file are picked up here, off the download threads
+            BANDWIDTH.reload()
+            with self.lock:
+                tasks = list(self.tasks)
+            if tty:
+                self._draw_bars(tasks)
+            elif tasks and time.monotonic() - last_print >= self.TEXT_INTERVAL:
+                last_print = time.monotonic()
+                self._print_lines(tasks)
+        for bar in self.bars.values():
+            bar.close()
+        if self.total_bar:
+            self.total_bar.close()
+        self.bars, self.total_bar = {}, None
+
+    # Aggregate throughput (bytes/s) and ETA (seconds) of the running downloads
+    @staticmethod
+    def _totals(tasks):
+        speed = sum(task.speed for task in tasks)
+        remaining = sum(max((task.total or task.expected_total) - task.downloaded, 0) for task in tasks)
+        return speed, (remaining / speed if speed else None)
+
+    @staticmethod
+    def _eta_str(eta):
+        return f"ETA {time.strftime('%M:%S', time.gmtime(eta))}" if eta is not None else 'ETA Unknown'
+
+    # What the bandwidth governor grants a task, e.g. " (bulk: 0.25MiB/s allowed)"
+    @staticmethod
+    def _allocation_str(task):
+        if task.allocation is None:
+            return ""
+        return f" ({task.priority}: {task.allocation / (1024 * 1024):.2f}MiB/s allowed)"
+
+    @staticmethod
+    def _limit_str():
+        limit = BANDWIDTH.current_limit()
+        return f" of {limit / (1024 * 1024):.2f}MiB/s limit" if limit else ""
+
+    def _draw_bars(self, tasks):
+        for task in list(self.bars):
+            if task not in tasks:
+                self.bars.pop(task).close()
+        mib = 1024 * 1024
+        for task in tasks:
+            if not task.count:
+                continue
+            bar = self.bars.get(task)
+            sized = task.total > 0
+            # Bars switch from percentage to MiB once the size is known
+            if bar is None or (bar.unit == "MiB") != sized:
+                if bar:
+                    bar.close()
+                bar = self.bars[task] = create_progress_bar(task.total / mib, task.label())
+            if sized:
+                bar.total = task.total / mib
+                bar.n = task.downloaded / mib
+            bar.set_description_str(f"{Fore.GREEN}Downloading {task.label()}{Style.RESET_ALL}", refresh=False)
+            bar.set_postfix_str(f"{self._eta_str(task.eta)}, {task.speed / mib:.2f}MiB/s{self._allocation_str(task)}", refresh=False)
+            bar.refresh()
+        if len(tasks) > 1 or BANDWIDTH.current_limit():
+            speed, eta = self._totals(tasks)
+            if self.total_bar is None:
+                self.total_bar = tqdm.tqdm(total=0, position=0, bar_format="{desc}")
+            self.total_bar.set_description_str(
+                f"{Fore.YELLOW}Total: {len(tasks)} active, {speed / mib:.2f}MiB/s{self._limit_str()}, {self._eta_str(eta)}{Style.RESET_ALL}")
+
+    def _print_lines(self, tasks):
+        mib = 1024 * 1024
+        speed, eta = self._totals(tasks)
+        lines = [f"[progress] {len(tasks)} active, {speed / mib:.2f}MiB/s{self._limit_str()}, {self._eta_str(eta)}"]
+        for task in tasks:
+            size = f"{task.downloaded / mib:.1f}/{task.total / mib:.1f} MiB" if task.total else f"{task.downloaded / mib:.1f} MiB"
+            lines.append(f"[progress]   {task.label()}: {size}, {task.speed / mib:.2f}MiB/s{self._allocation_str(task)}, {self._eta_str(task.eta)}")
+        print("\n".join(lines), file=sys.stderr, flush=True)
+
+PROGRESS = ProgressBoard()
+
+# Process-wide bandwidth governor. Every download draws from one token budget, so the
+# jobs running at once stay under bandwidth_limit_mbps together (0 = unlimited), or
+# under the limit of the bandwidth_schedule window covering the time of day, e.g.
+# [{"start": "09:00", "end": "18:00", "limit_mbps": 20}]. The budget is split between
+# the priority classes that have downloads running, in proportion to bandwidth_weights,
+# and evenly between the downloads of a class. Edits to these keys in the config file
+# take effect within seconds, without restarting running downloads; --limit-rate
+# overrides bandwidth_limit_mbps for the whole run, across those reloads.
+PRIORITIES = ["high", "normal", "bulk"]
+
+class BandwidthGovernor:
+    RELOAD_INTERVAL = 2.0
+    # A download counts towards the split while it drew bandwidth this recently (seconds)
+    ACTIVE_WINDOW = 2.0
+    # Longest single wait, so limit changes reach throttled downloads quickly
+    MAX_WAIT = 0.25
+    # Unused allowance a download may save up, in seconds of its share
+    BURST = 0.5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit_mbps = 0
+        self.cli_limit = None  # --limit-rate, kept apart from the config so reloads don't drop it
+        self.schedule = []
+        self.weights = {"high": 8, "normal": 4, "bulk": 1}
+        self.buckets = {}  # task -> [tokens, last refill, last use]
+        self.config_mtime = None
+        self.last_reload = 0.0
+
+    def configure(self, config, cli_limit=None):
+        with self.lock:
+            if cli_limit is not None:
+                self.cli_limit = cli_limit
+            self.limit_mbps = config['bandwidth_limit_mbps'] if self.cli_limit is None else self.cli_limit
+            self.schedule = config['bandwidth_schedule']
+            self.weights = {**self.weights, **config['bandwidth_weights']}
+            self.config_mtime = CONFIG_FILE.stat().st_mtime if CONFIG_FILE.exists() else None
+
+    # Re-read the limits when the config file changed since they were last loaded
+    def reload(self):
+        now = time.monotonic()
+        if now - self.last_reload < self.RELOAD_INTERVAL:
+            return
+        self.last_reload = now
         try:
-            flat_info = ydl.extract_info(url, download=False)
-            is_playlist = 'entries' in flat_info
-        except yt_dlp.DownloadError as e:
-            print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
-            return False
-    
-    quality_display = f"{audio_quality}kbps" if audio_quality != "best" else "320kbps"
-    
-    if is_playlist:
-        playlist_title = flat_info.get('title', 'Unknown Playlist')
-        num_videos = len(flat_info['entries'])
-        print(f"{Fore.BLUE}🎵 Playlist: {playlist_title}{Style.RESET_ALL}")
-        print(f"{Fore.BLUE}📋 Number of videos: {num_videos}{Style.RESET_ALL}")
-        if input(f"{Fore.CYAN}➤ Proceed with downloading playlist? (y/n): {Style.RESET_ALL}").strip().lower() != 'y':
-            return False
-        output_filename = f"%(title)s ({quality_display}).mp3"
-        output_path = AUDIO_DIR / output_filename
-        pbar = None
-        video_count = 0
-    else:
-        # Single audio: get info and show pre-download info
-        ydl_opts_info = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': audio_quality if audio_quality != 'best' else '320',
-            }],
-            'quiet': True,
-            'no_warnings': True,
-            'simulate': True
-        }
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl:
-            try:
-                info = ydl.extract_info(url, download=False)
-            except yt_dlp.DownloadError as e:
-                print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
-                return False
-        
-        title = clean_filename(info['title'])
-        output_path = AUDIO_DIR / f"{title} ({quality_display}).mp3"
-        
-        if not show_pre_download_info(info, f"mp3 ({quality_display})", str(output_path), audio_quality):
-            return False
-        total_size_mb = (info.get('filesize') or info.get('filesize_approx') or 0) / (1024 * 1024)
-        pbar = create_progress_bar(total_size_mb, title)
-        video_count = 0
-    
-    last_update = 0
-    last_bytes = 0
-    current_title = ""
-    
-    def progress_hook(d):
-        nonlocal pbar, last_update, last_bytes, current_title, video_count
-        current_time = time.time()
-        if d['status'] == 'downloading':
-            # Get current video title
-            title = d.get('info_dict', {}).get('title', 'Unknown')
-            total_size_mb = (d.get('info_dict', {}).get('filesize') or d.get('info_dict', {}).get('filesize_approx') or 0) / (1024 * 1024)
-            if title != current_title:
-                if pbar:
-                    pbar.close()
-                video_count += 1
-                current_title = title
-                desc = f"Audio {video_count}/{num_videos}: {title[:30]}" if is_playlist else title[:30]
-                pbar = create_progress_bar(total_size_mb, desc)
-            
-            # Update every 0.1 seconds
-            if current_time - last_update >= 0.1:
-                # Strip ANSI codes from _percent_str
-                percent_str = re.sub(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])', '', d.get('_percent_str', '0%')).strip('%')
-                try:
-                    percent = float(percent_str)
-                except ValueError:
-                    percent = 0.0
-                # Calculate downloaded size in MiB
-                downloaded_bytes = d.get('downloaded_bytes', 0)
-                downloaded_mb = downloaded_bytes / (1024 * 1024)
-                # Calculate speed manually
-                time_delta = current_time - last_update if last_update else 0.1
-                speed_mb_s = (downloaded_bytes - last_bytes) / (1024 * 1024 * time_delta) if time_delta > 0 else 0.0
-                last_bytes = downloaded_bytes
-                last_update = current_time
-                # Update progress bar
-                if pbar and pbar.total > 0 and total_size_mb > 0:
-                    pbar.n = downloaded_mb
-                elif pbar:
-                    pbar.n = percent
-                # Update postfix with ETA and speed
-                eta = d.get('eta', 'Unknown')
-                eta_str = f"ETA {time.strftime('%M:%S', time.gmtime(eta))}" if eta != 'Unknown' else 'ETA Unknown'
-                if pbar:
-                    pbar.set_postfix_str(f"{eta_str}, {speed_mb_s:.2f}MiB/s")
-                    pbar.refresh()
-        elif d['status'] == 'finished':
-            if pbar:
-                if pbar.total > 0:
-                    pbar.n = pbar.total
-                else:
-                    pbar.n = 100
-                pbar.refresh()
-                pbar.close()
-                pbar = None
-            print(f"{Fore.GREEN}✅ Download complete: {d.get('filename', 'Unknown')}{Style.RESET_ALL}")
+            mtime = CONFIG_FILE.stat().st_mtime
+        except OSError:
+            return
+        if mtime != self.config_mtime:
+            self.configure(load_config())
 
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': str(output_path),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': audio_quality if audio_quality != 'best' else '320',
-        }],
-        'ffmpeg_location': None,
-        'quiet': True,
-        'no_warnings': True,
-        'progress_hooks': [progress_hook],
-        'paths': {'home': str(AUDIO_DIR), 'temp': str(AUDIO_DIR)}
-    }
+    # Limit in bytes/s for the current time of day; 0 means unlimited
+    def current_limit(self):
+        if not self.schedule:
+            return self.limit_mbps * 125000
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        to_minutes = lambda hhmm: int(hhmm.split(':')[0]) * 60 + int(hhmm.split(':')[1])
+        for window in self.schedule:
+            start, end = to_minutes(window['start']), to_minutes(window['end'])
+            # Windows may wrap past midnight, e.g. 22:00-06:00
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return window['limit_mbps'] * 125000
+        return self.limit_mbps * 125000
+
+    # Bytes/s each recently active download gets; called with the lock held
+    def _shares(self, now):
+        limit = self.current_limit()
+        if not limit:
+            return {}
+        active = [task for task, bucket in self.buckets.items() if now - bucket[2] < self.ACTIVE_WINDOW]
+        if not active:
+            return {}
+        classes = Counter(task.priority for task in active)
+        total_weight = sum(self.weights.get(priority, 1) for priority in classes)
+        return {task: limit * self.weights.get(task.priority, 1) / total_weight / classes[task.priority] for task in active}
+
+    # Charge nbytes to a task and wait until its share has paid for them
+    def consume(self, task, nbytes):
+        # Unlimited: no bookkeeping at all on the download threads
+        if not self.limit_mbps and not self.schedule:
+            if task.allocation is not None:
+                task.allocation = None
+                self.release(task)
+            return
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                bucket = self.buckets.setdefault(task, [0.0, now, now])
+                bucket[2] = now
+                share = self._shares(now).get(task)
+                task.allocation = share
+                if not share:
+                    bucket[0], bucket[1] = 0.0, now
+                    return
+                bucket[0] = min(bucket[0] + share * (now - bucket[1]), share * self.BURST) - nbytes
+                bucket[1] = now
+                nbytes = 0
+                if bucket[0] >= 0:
+                    return
+                wait = -bucket[0] / share
+            if CANCEL_EVENT.is_set():
+                return
+            time.sleep(min(wait, self.MAX_WAIT))
+
+    def release(self, task):
+        with self.lock:
+            self.buckets.pop(task, None)
+
+BANDWIDTH = BandwidthGovernor()
+
+# Adaptive video quality. With the video quality "adaptive", every item gets the highest
+# quality whose estimated size still lets the rest of the batch finish by
+# adaptive_deadline and/or within adaptive_budget_gb. Sizes come from the format list
+# (filesize, filesize_approx, or tbr × duration); throughput is measured over all running
+# downloads. Each item is planned when its formats are known, with the measurements and
+# the outstanding work of that moment, so later items step up or down as they change.
+# Quality caps tried best first; 0 is the smallest format on offer
+ADAPTIVE_CAPS = [None, 2160, 1440, 1080, 720, 480, 360, 0]
+
+# Format string for a cap, the same one the fixed video qualities use
+def adaptive_format(cap):
+    if cap is None:
+        return "bestvideo+bestaudio/best"
+    return f"bv*[height<={cap}]+ba/best" if cap else "wv*+wa/w"
+
+# Expected bytes of a selected format; merged formats add up their parts
+def estimate_format_bytes(fmt, duration):
+    if fmt.get('requested_formats'):
+        parts = [estimate_format_bytes(part, duration) for part in fmt['requested_formats']]
+        return None if None in parts else sum(parts)
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 125 * duration  # tbr is in kbit/s
+    return size or None
+
+# "06:00" (the next time the clock shows it), "2026-10-17 06:00" or a duration from now
+# like "8h" / "90m"; returns epoch seconds. Raises ValueError.
+def parse_deadline(value):
+    value = str(value).strip()
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([hm])', value)
+    if match:
+        return time.time() + float(match.group(1)) * (3600 if match.group(2) == 'h' else 60)
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        return True
-    except yt_dlp.DownloadError as e:
-        print(f"{Fore.RED}Error downloading {url}: {str(e)}{Style.RESET_ALL}")
+        if re.fullmatch(r'\d{1,2}:\d{2}', value):
+            now = datetime.datetime.now()
+            hour, minute = map(int, value.split(':'))
+            deadline = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if deadline <= now:
+                deadline += datetime.timedelta(days=1)
+            return deadline.timestamp()
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"invalid deadline {value!r}; use HH:MM, YYYY-MM-DD HH:MM, or a duration like 8h or 90m") from None
+
+class QualityPlanner:
+    # Seconds of download history the throughput is measured over
+    WINDOW = 15.0
+    # Less history than this is not a measurement yet
+    MIN_HISTORY = 3.0
+    # Highest cap used against a deadline before any throughput has been measured
+    START_CAP = 720
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deadline = None
+        self.budget = None
+        self.spent = 0
+        # Items queued or listed but not planned yet
+        self.items = 0
+        # Planned items still downloading: key -> [estimate, {filename: bytes}, parts, finished]
+        self.plans = {}
+        self.files = {}
+        self.samples = collections.deque()
+        self.measuring_since = None
+
+    def configure(self, config):
+        deadline = parse_deadline(config['adaptive_deadline']) if config['adaptive_deadline'] else None
+        with self.lock:
+            self.deadline = deadline
+            self.budget = config['adaptive_budget_gb'] * 1e9 or None
+
+    def add_items(self, count):
+        with self.lock:
+            self.items += count
+
+    def drop_items(self, count):
+        with self.lock:
+            self.items = max(0, self.items - count)
+
+    # Progress hook of adaptive downloads
+    def hook(self, d):
+        filename, done = d.get('filename'), d.get('downloaded_bytes') or 0
+        info = d['info_dict']
+        now = time.monotonic()
+        with self.lock:
+            # The first report of a file may include bytes of an earlier run, so it only sets the mark
+            if filename in self.files and done > self.files[filename]:
+                self.samples.append((now, done - self.files[filename]))
+                self.spent += done - self.files[filename]
+                if self.measuring_since is None:
+                    self.measuring_since = now
+            self.files[filename] = done
+            plan = self.plans.get((info.get('extractor_key'), info.get('id')))
+            if plan:
+                plan[1][filename] = done
+            if d['status'] in ('finished', 'error'):
+                self.files.pop(filename, None)
+                if plan:
+                    plan[3] += 1
+                    if plan[3] >= plan[2] or d['status'] == 'error':
+                        self.plans.pop((info.get('extractor_key'), info.get('id')), None)
+
+    # Bytes/s over the last WINDOW seconds; None until MIN_HISTORY seconds were seen.
+    # Called with the lock held.
+    def _throughput(self, now):
+        while self.samples and now - self.samples[0][0] > self.WINDOW:
+            self.samples.popleft()
+        if self.measuring_since is None or now - self.measuring_since < self.MIN_HISTORY:
+            return None
+        return sum(nbytes for _, nbytes in self.samples) / min(self.WINDOW, now - self.measuring_since)
+
+    # Pick one of candidates [(cap, format, estimate)], best first, for the item key.
+    # Playlist entries were counted when their page was listed. Returns the candidate
+    # and a description of the reasoning.
+    def choose(self, key, candidates, listed):
+        now = time.monotonic()
+        with self.lock:
+            if listed:
+                self.items = max(0, self.items - 1)
+            outstanding = sum(max(0, estimate - sum(done.values())) for estimate, done, _, _ in self.plans.values())
+            rate = self._throughput(now)
+            allowances = []
+            if self.budget:
+                allowances.append(self.budget - self.spent - outstanding)
+            if self.deadline and rate is not None:
+                allowances.append(rate * (self.deadline - time.time()) - outstanding)
+            share = max(0, min(allowances)) / (self.items + 1) if allowances else None
+            usable = candidates
+            if self.deadline and rate is None:
+                usable = [c for c in candidates if c[0] is not None and c[0] <= self.START_CAP] or candidates
+            sized = [c for c in usable if c[2]]
+            if share is None or not sized:
+                choice = usable[0]
+            else:
+                choice = next((c for c in sized if c[2] <= share), min(sized, key=lambda c: c[2]))
+            self.plans[key] = [choice[2] or 0, {}, choice[3], 0]
+            mb = 1000 * 1000
+            reason = [f"{self.items} more queued"]
+            if rate is not None:
+                reason.append(f"{rate / mb:.2f} MB/s measured")
+            elif self.deadline:
+                reason.append("no throughput measured yet")
+            if share is not None:
+                reason.append(f"{share / mb:.0f} MB per item fits")
+            return choice, ", ".join(reason)
+
+    def forget(self, keys):
+        with self.lock:
+            for key in keys:
+                self.plans.pop(key, None)
+
+    # Plan the formats of every item a YoutubeDL instance processes until the block ends
+    @contextlib.contextmanager
+    def attach(self, ydl):
+        pp = AdaptiveFormatPP(self)
+        ydl.add_post_processor(pp, when='pre_process')
+        ydl.add_progress_hook(self.hook)
+        try:
+            yield pp
+        finally:
+            self.forget(pp.keys)
+
+ADAPTIVE = QualityPlanner()
+
+# Formats a format string picks from a format list, through the public selector. The
+# context mirrors what YoutubeDL._select_formats builds (yt-dlp 2026.08.19); keep the two
+# in step if format selection ever reads more of it.
+def select_formats(ydl, formats, fmt):
+    return list(ydl.build_format_selector(fmt)({
+        'formats': formats,
+        'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+        'incomplete_formats': (all(f.get('vcodec') == 'none' for f in formats)
+                               or all(f.get('acodec') == 'none' for f in formats)),
+    }))
+
+# Runs before format selection of every item: estimates each quality cap on the item's
+# format list and switches the instance's format to the planner's pick
+@ytdlp_base('postprocessor.PostProcessor')
+class AdaptiveFormatPP:
+    def __init__(self, planner):
+        super().__init__()
+        self.planner = planner
+        self.keys = set()
+
+    def run(self, info):
+        key = (info.get('extractor_key'), info.get('id'))
+        # Each item is planned once, even if it is processed again
+        if key in self.keys:
+            return [], info
+        ydl = self._downloader
+        formats = info.get('formats') or [info]
+        candidates, seen = [], set()
+        for cap in ADAPTIVE_CAPS:
+            fmt = adaptive_format(cap)
+            selected = select_formats(ydl, formats, fmt)
+            if not selected or selected[0].get('format_id') in seen:
+                continue
+            seen.add(selected[0].get('format_id'))
+            candidates.append((cap, fmt, estimate_format_bytes(selected[0], info.get('duration')),
+                               len(selected[0].get('requested_formats') or [None])))
+        if not candidates:
+            return [], info
+        (cap, fmt, estimate, _), reason = self.planner.choose(key, candidates, info.get('playlist_index') is not None)
+        self.keys.add(key)
+        set_format(ydl, fmt)
+        size = f"~{estimate / 1e6:.0f} MB" if estimate else "size unknown"
+        label = "best" if cap is None else f"≤{cap}p" if cap else "lowest"
+        print(f"{Fore.BLUE}📶 Adaptive quality for {info.get('title', info.get('id'))}: {label} ({size}; {reason}){Style.RESET_ALL}")
+        return [], info
+
+# Phase tracing. With trace_file set, every job writes spans (extract, format,
+# download, merge, transcode, post-process, job) as JSON lines. With metrics_file set,
+# aggregate counters and span latency histograms are kept in Prometheus textfile format
+# for node_exporter's textfile collector. Both off (the default) costs one attribute check
+# per span: no hooks are installed and span() hands out a shared no-op context.
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
         return False
 
-# Download advanced
-def download_advanced(url, format_str, subtitles, thumbnails, metadata, config):
-    if not check_ffmpeg():
+NULL_SPAN = NullSpan()
+
+class Span:
+    def __init__(self, tracer, url, name, attrs):
+        self.tracer = tracer
+        self.url = url
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = str(exc)
+        self.tracer.emit(self.url, self.name, self.ts, time.perf_counter() - self.start,
+                         "ok" if exc_type is None else "error", **self.attrs)
         return False
-    
-    # Determine if URL is a playlist
-    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'extract_flat': True}) as ydl:
-        try:
-            flat_info = ydl.extract_info(url, download=False)
-            is_playlist = 'entries' in flat_info
-        except yt_dlp.DownloadError as e:
-            print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
-            return False
-    
-    if is_playlist:
-        playlist_title = flat_info.get('title', 'Unknown Playlist')
-        num_videos = len(flat_info['entries'])
-        print(f"{Fore.BLUE}🎥 Playlist: {playlist_title}{Style.RESET_ALL}")
-        print(f"{Fore.BLUE}📋 Number of videos: {num_videos}{Style.RESET_ALL}")
-        if input(f"{Fore.CYAN}➤ Proceed with downloading playlist? (y/n): {Style.RESET_ALL}").strip().lower() != 'y':
-            return False
-        output_path = VIDEO_DIR / "%(title)s.%(ext)s"
-        pbar = None
-        video_count = 0
-    else:
-        # Single: fetch info with specified format for accurate size
-        ydl_opts_info = {
-            'format': format_str,
-            'quiet': True,
-            'no_warnings': True
-        }
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl_info:
-            info = ydl_info.extract_info(url, download=False)
-        if not info:
-            return False
-        title = clean_filename(info['title'])
-        output_path = VIDEO_DIR / f"{title}.%(ext)s"
-        
-        if not show_pre_download_info(info, format_str, str(output_path), format_str):
-            return False
-        total_size_mb = (info.get('filesize') or info.get('filesize_approx') or 0) / (1024 * 1024)
-        pbar = create_progress_bar(total_size_mb, title)
-        video_count = 0
-    
-    last_update = 0
-    last_bytes = 0
-    current_title = ""
-    
-    def progress_hook(d):
-        nonlocal pbar, last_update, last_bytes, current_title, video_count
-        current_time = time.time()
-        if d['status'] == 'downloading':
-            # Get current video title
-            title = d.get('info_dict', {}).get('title', 'Unknown')
-            total_size_mb = (d.get('info_dict', {}).get('filesize') or d.get('info_dict', {}).get('filesize_approx') or 0) / (1024 * 1024)
-            if title != current_title:
-                if pbar:
-                    pbar.close()
-                video_count += 1
-                current_title = title
-                desc = f"Video {video_count}/{num_videos}: {title[:30]}" if is_playlist else title[:30]
-                pbar = create_progress_bar(total_size_mb, desc)
-            
-            # Update every 0.1 seconds
-            if current_time - last_update >= 0.1:
-                # Strip ANSI codes from _percent_str
-                percent_str = re.sub(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])', '', d.get('_percent_str', '0%')).strip('%')
+
+# yt-dlp postprocessor names that get their own span name. None: runs inside another
+# postprocessor's span (AudioOutputPP drives KnownCodecExtractAudioPP), not traced twice
+PP_SPANS = {'Merger': 'merge', 'SinglePassMux': 'merge', 'AudioOutput': 'transcode', 'ExtractAudio': 'transcode',
+            'VideoConvertor': 'transcode', 'KnownCodecExtractAudio': None}
+
+# Per-job hooks feeding the tracer. Also installed as the YoutubeDL logger, which is where
+# yt-dlp reports retries; errors are still printed, warnings stay hidden as with no_warnings.
+class JobTrace:
+    def __init__(self, tracer, url):
+        self.tracer = tracer
+        self.url = url
+        self.files = {}  # filename -> [ts, perf_counter start, retries at start]
+        self.postprocessors = {}
+        self.retries = 0
+
+    @staticmethod
+    def _entry(info):
+        return {'entry': info.get('webpage_url') or info.get('url'), 'title': info.get('title')}
+
+    def progress_hook(self, d):
+        filename = d.get('filename')
+        if d['status'] == 'downloading' and filename not in self.files:
+            self.files[filename] = [time.time(), time.perf_counter(), self.retries]
+        elif d['status'] in ('finished', 'error') and filename in self.files:
+            ts, start, retries = self.files.pop(filename)
+            duration = time.perf_counter() - start
+            size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            self.tracer.emit(self.url, 'download', ts, duration, "ok" if d['status'] == 'finished' else "error",
+                             bytes=size, retries=self.retries - retries,
+                             bandwidth_bps=round(size / duration) if duration else None,
+                             file=filename, **self._entry(d['info_dict']))
+
+    def postprocessor_hook(self, d):
+        name = PP_SPANS.get(d['postprocessor'], 'post-process')
+        if name is None:
+            return
+        key = (d['postprocessor'], d['info_dict'].get('filepath'))
+        if d['status'] == 'started':
+            self.postprocessors[key] = (time.time(), time.perf_counter())
+        elif d['status'] == 'finished' and key in self.postprocessors:
+            ts, start = self.postprocessors.pop(key)
+            self.tracer.emit(self.url, name, ts, time.perf_counter() - start,
+                             "ok", postprocessor=d['postprocessor'], **self._entry(d['info_dict']))
+
+    def debug(self, msg):
+        if 'Retrying' in msg:
+            self.retries += 1
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        print(msg, file=sys.stderr)
+
+class Tracer:
+    HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    # The metrics file is rewritten at most this often while jobs run, and once at the end
+    METRICS_INTERVAL = 5.0
+    PREFIX = "ytdlp_downloader"
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.out = None
+        self.metrics_file = None
+        self.last_write = 0.0
+        self.jobs = Counter()
+        self.bytes = 0
+        self.retries = 0
+        self.failed_spans = Counter()
+        self.histograms = {}  # span -> [bucket counts..., sum, count]
+
+    def configure(self, trace_file, metrics_file):
+        self.close()
+        self.out = open(trace_file, 'a', buffering=1, encoding='utf-8') if trace_file else None
+        self.metrics_file = Path(metrics_file) if metrics_file else None
+        self.enabled = bool(trace_file or metrics_file)
+
+    def span(self, url, name, **attrs):
+        return Span(self, url, name, attrs) if self.enabled else NULL_SPAN
+
+    # Install the per-job hooks on a YoutubeDL instance
+    def attach(self, ydl, url):
+        if not self.enabled:
+            return
+        job_trace = JobTrace(self, url)
+        ydl.add_progress_hook(job_trace.progress_hook)
+        ydl.add_postprocessor_hook(job_trace.postprocessor_hook)
+        ydl.params['logger'] = job_trace
+
+    def emit(self, url, name, ts, duration, status="ok", **attrs):
+        record = {'ts': round(ts, 3), 'job': url, 'span': name, 'duration_s': round(duration, 4), 'status': status, **attrs}
+        with self.lock:
+            if self.out:
+                self.out.write(json.dumps(record) + "\n")
+            histogram = self.histograms.setdefault(name, [0] * (len(self.HISTOGRAM_BUCKETS) + 2))
+            for i, bound in enumerate(self.HISTOGRAM_BUCKETS):
+                if duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += duration
+            histogram[-1] += 1
+            if status != "ok":
+                self.failed_spans[name] += 1
+            if name == 'download':
+                self.bytes += attrs.get('bytes') or 0
+                self.retries += attrs.get('retries') or 0
+
+    def job_done(self, job):
+        if not self.enabled:
+            return
+        attrs = {'error': job.error} if job.error else {}
+        self.emit(job.url, 'job', time.time() - job.elapsed, job.elapsed, job.status, **attrs)
+        with self.lock:
+            self.jobs[job.status] += 1
+        self.write_metrics()
+
+    def write_metrics(self, force=False):
+        if not self.metrics_file or (not force and time.monotonic() - self.last_write < self.METRICS_INTERVAL):
+            return
+        p = self.PREFIX
+        with self.lock:
+            self.last_write = time.monotonic()
+            lines = [f"# HELP {p}_jobs_total Download jobs finished, by status.", f"# TYPE {p}_jobs_total counter"]
+            lines += [f'{p}_jobs_total{{status="{status}"}} {count}' for status, count in sorted(self.jobs.items())]
+            lines += [f"# HELP {p}_downloaded_bytes_total Bytes downloaded.", f"# TYPE {p}_downloaded_bytes_total counter",
+                      f"{p}_downloaded_bytes_total {self.bytes}",
+                      f"# HELP {p}_download_retries_total Download retries reported by yt-dlp.",
+                      f"# TYPE {p}_download_retries_total counter", f"{p}_download_retries_total {self.retries}",
+                      f"# HELP {p}_span_failures_total Spans that ended in an error, by span.",
+                      f"# TYPE {p}_span_failures_total counter"]
+            lines += [f'{p}_span_failures_total{{span="{span}"}} {count}' for span, count in sorted(self.failed_spans.items())]
+            lines += [f"# HELP {p}_span_duration_seconds Duration of job phases.", f"# TYPE {p}_span_duration_seconds histogram"]
+            for span, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.HISTOGRAM_BUCKETS, histogram):
+                    lines.append(f'{p}_span_duration_seconds_bucket{{span="{span}",le="{bound}"}} {count}')
+                lines.append(f'{p}_span_duration_seconds_bucket{{span="{span}",le="+Inf"}} {histogram[-1]}')
+                lines.append(f'{p}_span_duration_seconds_sum{{span="{span}"}} {histogram[-2]:.4f}')
+                lines.append(f'{p}_span_duration_seconds_count{{span="{span}"}} {histogram[-1]}')
+            lines += [f"# HELP {p}_last_update_timestamp_seconds When these metrics were written.",
+                      f"# TYPE {p}_last_update_timestamp_seconds gauge", f"{p}_last_update_timestamp_seconds {time.time():.0f}"]
+        # Written to a temporary file first so the collector never reads half a file
+        tmp = self.metrics_file.with_name(self.metrics_file.name + ".tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        os.replace(tmp, self.metrics_file)
+
+    def close(self):
+        self.write_metrics(force=True)
+        if self.out:
+            self.out.close()
+            self.out = None
+
+TRACE = Tracer()
+
+# Errors raised by extraction, format selection and downloading
+def ydl_errors():
+    return (yt_dlp.DownloadError, yt_dlp.utils.ExtractorError)
+
+# Switch the format selection of an existing YoutubeDL instance
+def set_format(ydl, format_str):
+    ydl.params['format'] = format_str
+    ydl.format_selector = ydl.build_format_selector(format_str)
+
+# Literal text (e.g. a title) for use inside an output template, so "%(" in it isn't expanded
+def outtmpl_escape(text):
+    return text.replace('%', '%%')
+
+# Switch the output template of an existing YoutubeDL instance. Paths inside paths.home
+# are made relative to it, or yt-dlp would write them there directly instead of staging
+# them in paths.temp.
+def set_outtmpl(ydl, output_path):
+    output_path = str(output_path)
+    home = ydl.params.get('paths', {}).get('home')
+    if home and output_path.startswith(os.path.join(home, '')):
+        output_path = os.path.relpath(output_path, home)
+    ydl.params['outtmpl']['default'] = output_path
+
+# Options that decide how requests are made; YoutubeDL instances that agree on them share a session
+SESSION_OPTS = ('http_headers', 'proxy', 'socket_timeout', 'source_address', 'nocheckcertificate',
+                'cookiefile', 'legacyserverconnect', 'impersonate')
+
+# One HTTP session for the whole run. Every YoutubeDL the download functions create uses
+# the same request director (yt-dlp's HTTP handlers with their connection pools) and cookie
+# jar, so the extraction, format selection and download requests of all links reuse
+# keep-alive connections and cookies instead of opening new ones per step. Connection
+# reuse needs the requests package; with only urllib, cookies are still shared.
+# Both the director and the cookie jar are safe to use from several threads.
+# Sharing the director relies on yt-dlp internals (checked against yt-dlp 2026.08.19):
+# the YoutubeDL._request_director cached property and RequestsRH._create_instance. If a
+# yt-dlp version lacks them, only the cookie jar is shared.
+class HttpSession:
+    def __init__(self):
+        self.enabled = False
+        self.pool_size = 10
+        self.owners = {}  # SESSION_OPTS values -> YoutubeDL that owns the director and cookie jar
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        self.enabled = config['shared_session']
+        # Connections kept open per host: every segment of every concurrent download may need one
+        segments = config['max_segments'] if config['segmented_downloads'] else 1
+        self.pool_size = max(10, config['concurrency'] * segments)
+
+    # Whether this yt-dlp still builds its request director the way sharing relies on
+    @functools.cached_property
+    def can_share_director(self):
+        supported = isinstance(vars(yt_dlp.YoutubeDL).get('_request_director'), functools.cached_property)
+        if not supported:
+            print(f"{Fore.YELLOW}Warning: this yt-dlp version can't share connections between downloads; "
+                  f"only cookies are shared.{Style.RESET_ALL}")
+        return supported
+
+    def attach(self, ydl):
+        if not self.enabled:
+            return
+        opts = {key: ydl.params[key] for key in SESSION_OPTS if ydl.params.get(key) is not None}
+        key = json.dumps(opts, sort_keys=True, default=str)
+        with self.lock:
+            owner = self.owners.get(key)
+            if owner is None:
+                owner = self.owners[key] = yt_dlp.YoutubeDL({**opts, 'quiet': True, 'no_warnings': True})
+                if self.can_share_director:
+                    self._size_pools(owner._request_director)
+        # Both are cached properties; setting them here stops the instance building its own
+        if self.can_share_director:
+            vars(ydl)['_request_director'] = owner._request_director
+        vars(ydl)['cookiejar'] = owner.cookiejar
+
+    # Called before the instance is closed, which would close the shared director too
+    def detach(self, ydl):
+        if self.enabled:
+            vars(ydl).pop('_request_director', None)
+
+    # requests keeps 10 connections per host; more than that in use at once would be
+    # closed after each request instead of returning to the pool
+    def _size_pools(self, director):
+        handler = director.handlers.get('Requests')
+        create_instance = getattr(handler, '_create_instance', None)
+        if create_instance is None:
+            return  # No requests package, or a yt-dlp that creates sessions differently
+        import requests.adapters
+
+        def create_sized_instance(**kwargs):
+            session = create_instance(**kwargs)
+            for adapter in set(session.adapters.values()):
+                adapter.init_poolmanager(requests.adapters.DEFAULT_POOLSIZE, self.pool_size,
+                                         block=requests.adapters.DEFAULT_POOLBLOCK)
+            return session
+
+        handler._create_instance = create_sized_instance
+
+    def close(self):
+        with self.lock:
+            owners, self.owners = list(self.owners.values()), {}
+        for owner in owners:
+            owner.close()
+
+HTTP_SESSION = HttpSession()
+
+# Options that differ from job to job; instances whose other options match are interchangeable
+YDL_JOB_OPTS = ('format', 'outtmpl', 'progress_hooks', 'download_archive')
+
+# YoutubeDL instances for the download functions. Normally every job gets a new one that
+# is closed afterwards. When enabled (daemon mode), finished instances are reset and kept,
+# so later jobs reuse their loaded extractors and open HTTP connections.
+class YoutubeDLPool:
+    MAX_IDLE = 8  # Per set of options
+
+    def __init__(self):
+        self.enabled = False
+        self.idle = collections.defaultdict(list)
+        self.pristine = {}  # id(ydl) -> state right after construction
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def get(self, opts):
+        if not self.enabled:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                HTTP_SESSION.attach(ydl)
                 try:
-                    percent = float(percent_str)
-                except ValueError:
-                    percent = 0.0
-                # Calculate downloaded size in MiB
-                downloaded_bytes = d.get('downloaded_bytes', 0)
-                downloaded_mb = downloaded_bytes / (1024 * 1024)
-                # Calculate speed manually
-                time_delta = current_time - last_update if last_update else 0.1
-                speed_mb_s = (downloaded_bytes - last_bytes) / (1024 * 1024 * time_delta) if time_delta > 0 else 0.0
-                last_bytes = downloaded_bytes
-                last_update = current_time
-                # Update progress bar
-                if pbar and pbar.total > 0 and total_size_mb > 0:
-                    pbar.n = downloaded_mb
-                elif pbar:
-                    pbar.n = percent
-                # Update postfix with ETA and speed
-                eta = d.get('eta', 'Unknown')
-                eta_str = f"ETA {time.strftime('%M:%S', time.gmtime(eta))}" if eta != 'Unknown' else 'ETA Unknown'
-                if pbar:
-                    pbar.set_postfix_str(f"{eta_str}, {speed_mb_s:.2f}MiB/s")
-                    pbar.refresh()
-        elif d['status'] == 'finished':
-            if pbar:
-                if pbar.total > 0:
-                    pbar.n = pbar.total
-                else:
-                    pbar.n = 100
-                pbar.refresh()
-                pbar.close()
-                pbar = None
-            print(f"{Fore.GREEN}✅ Download complete: {d.get('filename', 'Unknown')}{Style.RESET_ALL}")
+                    yield ydl
+                finally:
+                    HTTP_SESSION.detach(ydl)
+            return
+        key = json.dumps({k: v for k, v in opts.items() if k not in YDL_JOB_OPTS}, sort_keys=True, default=str)
+        with self.lock:
+            ydl = self.idle[key].pop() if self.idle[key] else None
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL({**opts, 'progress_hooks': [], 'download_archive': None})
+            HTTP_SESSION.attach(ydl)
+            self.pristine[id(ydl)] = {
+                'params': {**ydl.params, 'outtmpl': dict(ydl.params['outtmpl'])},
+                'pps': {when: list(pps) for when, pps in ydl._pps.items()},
+                'progress_hooks': list(ydl._progress_hooks),
+                'postprocessor_hooks': list(ydl._postprocessor_hooks),
+                'post_hooks': list(ydl._post_hooks),
+            }
+        self._prepare(ydl, opts)
+        try:
+            yield ydl
+        except BaseException:
+            # Whatever state it was left in, it is not reused
+            self._discard(ydl)
+            raise
+        # Deferred post-processing still runs on this instance; release it afterwards
+        pending = [f for f in getattr(vars(ydl).get('post_process'), 'futures', ()) if not f.done()]
+        if not pending:
+            self._release(key, ydl)
+            return
+        remaining = [len(pending)]
+        def done(_):
+            with self.lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                self._release(key, ydl)
+        for future in pending:
+            future.add_done_callback(done)
 
-    ydl_opts = {
-        'format': format_str,
-        'outtmpl': str(output_path),
-        'merge_output_format': 'mp4',
-        'ffmpeg_location': None,
-        'writesubtitles': subtitles,
-        'writethumbnail': thumbnails,
-        'embedthumbnail': thumbnails and metadata,
-        'addmetadata': metadata,
-        'quiet': True,
-        'no_warnings': True,
-        'progress_hooks': [progress_hook],
-        'paths': {'home': str(VIDEO_DIR), 'temp': str(VIDEO_DIR)}
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        print(f"{Fore.GREEN}✅ Download complete: {output_path}{Style.RESET_ALL}")
-        return True
-    except yt_dlp.DownloadError as e:
-        print(f"{Fore.RED}Error downloading {url}: {str(e)}{Style.RESET_ALL}")
-        return False
+    def _release(self, key, ydl):
+        with self.lock:
+            if len(self.idle[key]) < self.MAX_IDLE:
+                self.idle[key].append(ydl)
+                return
+        self._discard(ydl)
 
-# Main function
-def main():
-    config = load_config()
-    links = get_links()
-    if not links:
+    # Put an instance back into its just-constructed state, then apply the job's options
+    def _prepare(self, ydl, opts):
+        state = self.pristine[id(ydl)]
+        ydl.params = {**state['params'], 'outtmpl': dict(state['params']['outtmpl'])}
+        for when, pps in state['pps'].items():
+            ydl._pps[when][:] = pps
+        ydl._progress_hooks[:] = state['progress_hooks']
+        ydl._postprocessor_hooks[:] = state['postprocessor_hooks']
+        ydl._post_hooks = list(state['post_hooks'])
+        # Per-job overrides installed on the instance (deferred post-processing, segmented
+        # post-processing, segmented downloads, background side assets, staged moves, playlist pages)
+        for name in ('post_process', 'record_download_archive', 'dl', '_write_subtitles', '_write_thumbnails',
+                     'run_pp', 'process_ie_result'):
+            vars(ydl).pop(name, None)
+        set_format(ydl, opts['format'])
+        set_outtmpl(ydl, opts['outtmpl'])
+        ydl.params['download_archive'] = opts.get('download_archive')
+        ydl.archive = opts.get('download_archive') or set()
+        for hook in opts.get('progress_hooks', []):
+            ydl.add_progress_hook(hook)
+
+    def _discard(self, ydl):
+        self.pristine.pop(id(ydl), None)
+        HTTP_SESSION.detach(ydl)
+        ydl.close()
+
+    def close(self):
+        with self.lock:
+            instances = [ydl for pool in self.idle.values() for ydl in pool]
+            self.idle.clear()
+        for ydl in instances:
+            self._discard(ydl)
+
+YDL_POOL = YoutubeDLPool()
+
+# Open SQLite connections, one per database file and process, shared between worker
+# threads. Every statement runs under _db_lock so transactions from threads never mix.
+_db_conns = {}
+_db_lock = threading.RLock()
+
+# Open (and create) a SQLite database; WAL lets several processes of one host share the
+# file. Files shared between hosts need the rollback journal (journal_mode="DELETE").
+# upgrade(conn) brings files written by older versions up to the schema.
+def open_db(path, schema, journal_mode="WAL", upgrade=None):
+    with _db_lock:
+        if path not in _db_conns:
+            conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+            conn.execute(f"PRAGMA journal_mode={journal_mode}")
+            conn.executescript(schema)
+            if upgrade:
+                upgrade(conn)
+            _db_conns[path] = conn
+        return _db_conns[path]
+
+# On-disk metadata cache (zlib-compressed JSON). Rows are keyed by "<extractor>:<video id>";
+# the alias table maps the URLs we were given to that key.
+CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS info (
+        key TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        fetched REAL NOT NULL,
+        streams_expire REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS info_last_used ON info (last_used);
+    CREATE TABLE IF NOT EXISTS alias (
+        url TEXT PRIMARY KEY,
+        key TEXT NOT NULL
+    );
+"""
+_id_extractors = None
+
+def open_cache():
+    return open_db(CACHE_FILE, CACHE_SCHEMA)
+
+# Canonical "<extractor>:<id>" for a URL, worked out offline from the extractor regexes
+def canonical_key(url):
+    global _id_extractors
+    if _id_extractors is None:
+        # The generic extractor matches everything and has no usable ID
+        _id_extractors = [ie for ie in yt_dlp.extractor.gen_extractor_classes() if ie.ie_key() != 'Generic']
+    for ie in _id_extractors:
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{video_id}" if video_id else None
+    return None
+
+# Earliest expiry of the signed stream URLs in an info dict
+STREAM_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+def streams_expire_at(info, config):
+    default = time.time() + config['stream_ttl_minutes'] * 60
+    stamps = []
+    for fmt in info.get('formats') or [info]:
+        match = STREAM_EXPIRE_RE.search(fmt.get('url') or fmt.get('manifest_url') or '')
+        if match:
+            stamps.append(int(match.group(1)))
+    # Leave a margin so a download doesn't start on a URL that is about to die
+    return min(stamps) - 300 if stamps else default
+
+# Look up cached info for a URL. With need_streams=False an entry whose signed stream
+# URLs have expired is still returned, since title/duration/format list stay valid.
+def cache_get(url, config, need_streams=True):
+    key = canonical_key(url)
+    now = time.time()
+    with _db_lock:
+        try:
+            conn = open_cache()
+            row = None
+            if key:
+                row = conn.execute("SELECT key, data, fetched, streams_expire FROM info WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                row = conn.execute(
+                    "SELECT info.key, data, fetched, streams_expire FROM alias JOIN info ON alias.key = info.key WHERE alias.url = ?",
+                    (url,)).fetchone()
+            if row is None:
+                return None
+            key, data, fetched, streams_expire = row
+            if now - fetched > config['cache_ttl_hours'] * 3600:
+                with conn:
+                    conn.execute("DELETE FROM info WHERE key = ?", (key,))
+                return None
+            if need_streams and now >= streams_expire:
+                return None
+            with conn:
+                conn.execute("UPDATE info SET last_used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            print(f"{Fore.RED}Warning: metadata cache unavailable - {str(e)}{Style.RESET_ALL}")
+            return None
+    return json.loads(zlib.decompress(data))
+
+# Store a single video's info dict and evict least recently used rows over the size cap
+def cache_put(url, info, config):
+    if not info or info.get('_type', 'video') != 'video' or info.get('is_live'):
         return
-    
-    download_type = choose_download_type(config)
-    
-    if download_type == '1':
-        quality = choose_video_quality(config)
-    elif download_type == '2':
-        audio_quality = choose_audio_quality(config)
-    else:
-        format_str, subtitles, thumbnails, metadata = choose_advanced_options(config)
-    
-    successes = 0
-    for url in links:
-        print(f"{Fore.YELLOW}Processing: {url}{Style.RESET_ALL}")
-        success = False
-        if download_type == '1':
-            success = download_video(url, quality, config)
-        elif download_type == '2':
-            success = download_audio(url, audio_quality, config)
-        else:
-            success = download_advanced(url, format_str, subtitles, thumbnails, metadata, config)
-        successes += 1 if success else 0
-    
+    key = f"{info.get('extractor_key')}:{info.get('id')}"
+    data = zlib.compress(json.dumps(yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)).encode('utf-8'))
+    now = time.time()
+    aliases = {url, info.get('webpage_url'), info.get('original_url')} - {None}
+    with _db_lock:
+        try:
+            conn = open_cache()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, data, len(data), now, streams_expire_at(info, config), now))
+                conn.executemany("INSERT OR REPLACE INTO alias VALUES (?, ?)", [(alias, key) for alias in aliases])
+                budget = config['cache_max_mb'] * 1024 * 1024
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM info").fetchone()[0]
+                if total > budget:
+                    for old_key, size in conn.execute("SELECT key, size FROM info ORDER BY last_used").fetchall():
+                        if total <= budget:
+                            break
+                        conn.execute("DELETE FROM info WHERE key = ?", (old_key,))
+                        total -= size
+                    conn.execute("DELETE FROM alias WHERE key NOT IN (SELECT key FROM info)")
+        except sqlite3.Error as e:
+            print(f"{Fore.RED}Warning: could not update metadata cache - {str(e)}{Style.RESET_ALL}")
+
+# Download archive: one row per finished file, keyed by yt-dlp's archive id
+# ("<extractor> <video id>") and the output profile it was produced with
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS archive (
+        archive_id TEXT NOT NULL,
+        profile TEXT NOT NULL,
+        url TEXT,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        checksum TEXT NOT NULL,
+        recorded REAL NOT NULL,
+        PRIMARY KEY (archive_id, profile)
+    );
+    CREATE INDEX IF NOT EXISTS archive_url ON archive (url, profile);
+    CREATE INDEX IF NOT EXISTS archive_path ON archive (path);
+    CREATE INDEX IF NOT EXISTS archive_checksum ON archive (checksum, size);
+"""
+# Extended attribute carrying "<archive id>\n<profile>" so --rebuild-archive can re-adopt files
+ARCHIVE_XATTR = "user.yt_dlp_downloader.archive"
+
+# SHA-256 of a file, read in 1 MiB chunks
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The archive seen through one output profile. yt-dlp takes it as its download_archive
+# and checks membership before extracting single links and playlist entries.
+class DownloadArchive:
+    def __init__(self, profile):
+        self.profile = profile
+
+    def _db(self):
+        return open_db(ARCHIVE_FILE, ARCHIVE_SCHEMA)
+
+    # Return the recorded path if it is still on disk, dropping the row otherwise
+    def _existing(self, row):
+        if row is None:
+            return None
+        archive_id, path = row
+        if os.path.exists(path):
+            return path
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.execute("DELETE FROM archive WHERE archive_id = ? AND profile = ?", (archive_id, self.profile))
+        return None
+
+    def __contains__(self, archive_id):
+        with _db_lock:
+            row = self._db().execute(
+                "SELECT archive_id, path FROM archive WHERE archive_id = ? AND profile = ?",
+                (archive_id, self.profile)).fetchone()
+        return self._existing(row) is not None
+
+    # yt-dlp calls this after each download; the row itself is written by ArchiveRecorderPP
+    def add(self, archive_id):
+        pass
+
+    # Look a link up without touching the network
+    def lookup_url(self, url):
+        archive_id = offline_archive_id(url)
+        row = None
+        with _db_lock:
+            if archive_id:
+                row = self._db().execute(
+                    "SELECT archive_id, path FROM archive WHERE archive_id = ? AND profile = ?",
+                    (archive_id, self.profile)).fetchone()
+            if row is None:
+                row = self._db().execute(
+                    "SELECT archive_id, path FROM archive WHERE url = ? AND profile = ?",
+                    (url, self.profile)).fetchone()
+        return self._existing(row)
+
+    def record(self, info):
+        self.record_file(yt_dlp.utils.make_archive_id(info['extractor_key'], info['id']),
+                         info['filepath'], info.get('original_url') or info.get('webpage_url'))
+
+    def record_file(self, archive_id, path, url):
+        checksum = file_checksum(path)
+        # The xattr lives on the inode, which a hardlinked duplicate shares with its original
+        linked = link_duplicate(path, checksum)
+        stat = os.stat(path)
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (archive_id, self.profile, url, os.path.abspath(path),
+                              stat.st_size, stat.st_mtime, checksum, time.time()))
+        if hasattr(os, 'setxattr') and not linked:
+            try:
+                os.setxattr(path, ARCHIVE_XATTR, f"{archive_id}\n{self.profile}".encode('utf-8'))
+            except OSError:
+                pass
+
+# Replace a newly finished file with a hardlink to an archived file of identical content
+# (e.g. the same audio stream copied out under two quality profiles). Returns True if linked.
+def link_duplicate(path, checksum):
+    path = os.path.abspath(path)
+    with _db_lock:
+        rows = open_db(ARCHIVE_FILE, ARCHIVE_SCHEMA).execute(
+            "SELECT path FROM archive WHERE checksum = ? AND size = ? AND path != ?",
+            (checksum, os.path.getsize(path), path)).fetchall()
+    for (other,) in rows:
+        try:
+            if os.path.samefile(other, path):
+                return True
+            staged = f"{path}.link"
+            os.link(other, staged)
+            os.replace(staged, path)
+            return True
+        except OSError:
+            # Gone, or a filesystem without hardlinks: keep the separate copy
+            continue
+    return False
+
+# Video files in the archive for an archive id, under any video or advanced profile,
+# newest first, as (path, profile) pairs
+def archived_videos(archive_id):
+    with _db_lock:
+        rows = open_db(ARCHIVE_FILE, ARCHIVE_SCHEMA).execute(
+            "SELECT path, profile FROM archive WHERE archive_id = ? "
+            "AND (profile LIKE 'video:%' OR profile LIKE 'advanced:%') ORDER BY recorded DESC",
+            (archive_id,)).fetchall()
+    return [(path, profile) for path, profile in rows if os.path.exists(path)]
+
+# Records each finished file in the download archive once yt-dlp has moved it into place
+@ytdlp_base('postprocessor.PostProcessor')
+class ArchiveRecorderPP:
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def run(self, info):
+        # Deferred post-processing records the file once every later step has succeeded too
+        if '__archive_pending' in info:
+            info['__archive_pending'].append(self.archive)
+        else:
+            self.archive.record(info)
+        return [], info
+
+# yt-dlp's archive id for a link, worked out offline; None if no extractor claims the link
+def offline_archive_id(url):
+    key = canonical_key(url)
+    return yt_dlp.utils.make_archive_id(*key.split(':', 1)) if key else None
+
+# Remembers the finished files of one run by archive id, so a later step of the same job
+# can reuse them whether or not the download archive is enabled
+@ytdlp_base('postprocessor.PostProcessor')
+class FinishedFilesPP:
+    def __init__(self, files):
+        super().__init__()
+        self.files = files
+
+    def run(self, info):
+        self.files[yt_dlp.utils.make_archive_id(info['extractor_key'], info['id'])] = info['filepath']
+        return [], info
+
+# Check the archive before any network work; True if the link can be skipped
+def already_downloaded(archive, url):
+    if archive is None:
+        return False
+    path = archive.lookup_url(url)
+    if path:
+        print(f"{Fore.GREEN}✅ Already downloaded: {path}{Style.RESET_ALL}")
+        return True
+    return False
+
+# Rebuild the archive index from the output directories: drop rows whose files are gone,
+# re-hash files that changed and re-adopt files tagged with the archive xattr
+def rebuild_archive():
+    conn = open_db(ARCHIVE_FILE, ARCHIVE_SCHEMA)
+    rows = {path: (archive_id, profile, size, mtime)
+            for archive_id, profile, path, size, mtime in conn.execute(
+                "SELECT archive_id, profile, path, size, mtime FROM archive")}
+    seen = set()
+    added = updated = untracked = 0
+    with conn:
+        for directory in (VIDEO_DIR, AUDIO_DIR):
+            for entry in directory.rglob('*'):
+                if not entry.is_file() or entry.suffix in ('.part', '.ytdl', '.json'):
+                    continue
+                path = str(entry.resolve())
+                stat = entry.stat()
+                seen.add(path)
+                if path in rows:
+                    archive_id, profile, size, mtime = rows[path]
+                    if (size, mtime) != (stat.st_size, stat.st_mtime):
+                        conn.execute("UPDATE archive SET size = ?, mtime = ?, checksum = ? WHERE archive_id = ? AND profile = ?",
+                                     (stat.st_size, stat.st_mtime, file_checksum(path), archive_id, profile))
+                        updated += 1
+                    continue
+                try:
+                    archive_id, profile = os.getxattr(path, ARCHIVE_XATTR).decode('utf-8').split('\n', 1)
+                except (AttributeError, OSError, ValueError):
+                    untracked += 1
+                    continue
+                conn.execute("INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (archive_id, profile, None, path, stat.st_size, stat.st_mtime, file_checksum(path), time.time()))
+                added += 1
+        removed = [(archive_id, profile) for path, (archive_id, profile, _, _) in rows.items() if path not in seen]
+        conn.executemany("DELETE FROM archive WHERE archive_id = ? AND profile = ?", removed)
+    print(f"{Fore.GREEN}Archive rebuilt: {added} added, {updated} updated, {len(removed)} removed, {untracked} untracked file(s).{Style.RESET_ALL}")
+
+# Job journal: every link and every expanded playlist entry of a batch with its state,
+# so an interrupted run can be resumed. States: pending, downloading, post-processing,
+# done, failed. Each batch belongs to the process running it (owner, "host:pid") and the
+# mode it was started in (interactive, batch, sync). The owner renews its heartbeat while
+# it runs, so only batches whose owner has stopped are offered for resuming.
+JOURNAL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        profile TEXT NOT NULL,
+        created REAL NOT NULL,
+        mode TEXT,
+        owner TEXT,
+        heartbeat REAL NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS jobs (
+        batch INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        parent TEXT,
+        seq INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        part_path TEXT,
+        error TEXT,
+        updated REAL NOT NULL,
+        PRIMARY KEY (batch, url)
+    );
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs (batch, parent, state);
+"""
+JOURNAL_MAX_ATTEMPTS = 3
+
+# Journals from before batches had owners; their batches count as abandoned, in any mode
+def upgrade_journal(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(batches)")}
+    with conn:
+        for column, decl in (('mode', 'TEXT'), ('owner', 'TEXT'), ('heartbeat', 'REAL NOT NULL DEFAULT 0')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE batches ADD COLUMN {column} {decl}")
+
+class JobJournal:
+    # State changes are buffered and written in one transaction at most this often
+    FLUSH_INTERVAL = 2.0
+    FLUSH_SIZE = 50
+    # The owner renews its batch this often; a batch not renewed for OWNER_TIMEOUT is abandoned
+    HEARTBEAT_INTERVAL = 5.0
+    OWNER_TIMEOUT = 20.0
+
+    def __init__(self, batch_id, profile):
+        self.batch_id = batch_id
+        self.profile = profile
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.buffer = {}
+        self.last_flush = time.monotonic()
+        with _db_lock:
+            self.next_seq = self._db().execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM jobs WHERE batch = ? AND parent IS NULL", (batch_id,)).fetchone()[0]
+        self.stop_event = threading.Event()
+        threading.Thread(target=self._keep_alive, name="journal-heartbeat", daemon=True).start()
+
+    @staticmethod
+    def _db():
+        return open_db(JOURNAL_FILE, JOURNAL_SCHEMA, upgrade=upgrade_journal)
+
+    def _keep_alive(self):
+        while not self.stop_event.wait(self.HEARTBEAT_INTERVAL):
+            with _db_lock:
+                conn = self._db()
+                with conn:
+                    conn.execute("UPDATE batches SET heartbeat = ? WHERE id = ? AND owner = ?",
+                                 (time.time(), self.batch_id, self.owner))
+
+    # Start a new, empty batch for the given download profile, owned by this process
+    @classmethod
+    def start(cls, profile, mode):
+        now = time.time()
+        with _db_lock:
+            conn = cls._db()
+            with conn:
+                batch_id = conn.execute("INSERT INTO batches (profile, created, mode, owner, heartbeat) VALUES (?, ?, ?, ?, ?)",
+                                        (json.dumps(profile), now, mode, f"{socket.gethostname()}:{os.getpid()}", now)).lastrowid
+        return cls(batch_id, profile)
+
+    # Record links as the scheduler takes them in; links already journaled keep their state
+    def add_links(self, urls):
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO jobs (batch, url, parent, seq, state, updated) VALUES (?, ?, NULL, ?, 'pending', ?)",
+                                 [(self.batch_id, url, self.next_seq + i, now) for i, url in enumerate(urls)])
+            self.next_seq += len(urls)
+
+    # The most recent abandoned batch of a mode that still has links to finish, with those
+    # links. This process takes it over, so no other one offers it at the same time.
+    @classmethod
+    def unfinished(cls, mode):
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        with _db_lock:
+            conn = cls._db()
+            for batch_id, profile in conn.execute(
+                    "SELECT id, profile FROM batches WHERE (mode = ? OR mode IS NULL) AND heartbeat < ? ORDER BY id DESC",
+                    (mode, time.time() - cls.OWNER_TIMEOUT)).fetchall():
+                urls = [url for url, in conn.execute(
+                    "SELECT url FROM jobs WHERE batch = ? AND parent IS NULL AND (state IN ('pending', 'downloading', 'post-processing') "
+                    "OR (state = 'failed' AND attempts < ?)) ORDER BY seq",
+                    (batch_id, JOURNAL_MAX_ATTEMPTS))]
+                if not urls:
+                    continue
+                now = time.time()
+                with conn:
+                    claimed = conn.execute("UPDATE batches SET mode = ?, owner = ?, heartbeat = ? WHERE id = ? AND heartbeat < ?",
+                                           (mode, owner, now, batch_id, now - cls.OWNER_TIMEOUT)).rowcount
+                if claimed:
+                    return cls(batch_id, json.loads(profile)), urls
+        return None, []
+
+    # Record the entries of an expanded playlist; entries already journaled keep their state
+    def add_entries(self, parent, urls, start=0):
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO jobs (batch, url, parent, seq, state, updated) VALUES (?, ?, ?, ?, 'pending', ?)",
+                                 [(self.batch_id, url, parent, seq, now) for seq, url in enumerate(urls, start)])
+
+    def update(self, url, state, part_path=None, error=None, attempt=False, flush=False):
+        with _db_lock:
+            _, old_part, _, old_attempt = self.buffer.get(url, (None, None, None, False))
+            self.buffer[url] = (state, part_path or old_part, error, attempt or old_attempt)
+            if flush or len(self.buffer) >= self.FLUSH_SIZE or time.monotonic() - self.last_flush >= self.FLUSH_INTERVAL:
+                self.flush()
+
+    def flush(self):
+        with _db_lock:
+            if self.buffer:
+                now = time.time()
+                conn = self._db()
+                with conn:
+                    conn.executemany(
+                        "UPDATE jobs SET state = ?, part_path = COALESCE(?, part_path), error = ?, "
+                        "attempts = attempts + ?, updated = ? WHERE batch = ? AND url = ?",
+                        [(state, part_path, error, int(attempt), now, self.batch_id, url)
+                         for url, (state, part_path, error, attempt) in self.buffer.items()])
+                self.buffer.clear()
+            self.last_flush = time.monotonic()
+
+    def state(self, url):
+        with _db_lock:
+            if url in self.buffer:
+                return self.buffer[url][0]
+            row = self._db().execute("SELECT state FROM jobs WHERE batch = ? AND url = ?", (self.batch_id, url)).fetchone()
+        return row[0] if row else None
+
+    def part_path(self, url):
+        with _db_lock:
+            row = self._db().execute("SELECT part_path FROM jobs WHERE batch = ? AND url = ?", (self.batch_id, url)).fetchone()
+        return row[0] if row else None
+
+    # Forget the batch once nothing in it is left to resume (or right away with discard).
+    # A batch that is kept is released, so the next run can offer it right away.
+    def close(self, discard=False):
+        self.stop_event.set()
+        self.flush()
+        with _db_lock:
+            conn = self._db()
+            left = conn.execute("SELECT COUNT(*) FROM jobs WHERE batch = ? AND state != 'done'", (self.batch_id,)).fetchone()[0]
+            with conn:
+                # Only while this process still owns it
+                if not conn.execute("UPDATE batches SET heartbeat = 0 WHERE id = ? AND owner = ?",
+                                    (self.batch_id, self.owner)).rowcount:
+                    return
+                if discard or not left:
+                    conn.execute("DELETE FROM jobs WHERE batch = ?", (self.batch_id,))
+                    conn.execute("DELETE FROM batches WHERE id = ?", (self.batch_id,))
+
+# Marks a journaled entry done once its final file is in place
+@ytdlp_base('postprocessor.PostProcessor')
+class JournalPP:
+    def __init__(self, journal, key_fn):
+        super().__init__()
+        self.journal = journal
+        self.key_fn = key_fn
+
+    def run(self, info):
+        self.journal.update(self.key_fn(info), 'done')
+        return [], info
+
+# Track a download in the job journal. Playlist entries are recorded as children of the
+# playlist link and entries finished in an earlier run are skipped before extraction,
+# unless skip_done is off.
+def track_in_journal(ydl, journal, url, info, is_playlist, skip_done=True):
+    if is_playlist:
+        # Entries themselves are journaled page by page as the playlist streams in
+        entry_url = playlist_entry_url
+        def match_filter(entry, incomplete=False):
+            if journal.state(entry_url(entry)) == 'done':
+                return 'already finished in an earlier run'
+        if skip_done:
+            ydl.params['match_filter'] = match_filter
+    else:
+        entry_url = lambda _: url
+    part = journal.part_path(url)
+    if part and os.path.exists(part):
+        print(f"{Fore.YELLOW}Resuming from partial file: {part}{Style.RESET_ALL}")
+    started = set()
+
+    def progress_hook(d):
+        key = entry_url(d['info_dict'])
+        if d['status'] == 'downloading' and key not in started:
+            started.add(key)
+            # The link itself was already counted as an attempt by run_job. Written straight
+            # away so a crash still leaves the .part path behind; other changes are batched.
+            journal.update(key, 'downloading', part_path=d.get('tmpfilename'), attempt=key != url, flush=True)
+        elif d['status'] == 'error':
+            journal.update(key, 'failed', error='download error')
+
+    def postprocessor_hook(d):
+        if d['status'] == 'started':
+            journal.update(entry_url(d['info_dict']), 'post-processing')
+
+    ydl.add_progress_hook(progress_hook)
+    ydl.add_postprocessor_hook(postprocessor_hook)
+    ydl.add_post_processor(JournalPP(journal, entry_url), when='after_move')
+
+# Playlist entries handed to yt-dlp at a time. Only one page of flat entries is held
+# in memory, and the first download starts as soon as the first page is in.
+PLAYLIST_PAGE_SIZE = 50
+
+# URL a flat playlist entry is journaled under
+def playlist_entry_url(entry):
+    return entry.get('original_url') or entry.get('webpage_url') or entry.get('url')
+
+# Number of entries a playlist reports before it is read, or None if unknown
+def playlist_size(info):
+    entries = info.get('entries')
+    return len(entries) if isinstance(entries, list) else info.get('playlist_count')
+
+# Indexing a PagedList fetches a page per item; slicing fetches each page once
+def iter_paged_list(paged, page_size):
+    for start in itertools.count(0, page_size):
+        page = paged.getslice(start, start + page_size)
+        if not page:
+            return
+        yield from page
+
+# Read a playlist's entries lazily, in pages. Extractors hand entries over as
+# generators or paged lists; neither is expanded beyond the current page.
+def iter_playlist_pages(info, page_size=PLAYLIST_PAGE_SIZE):
+    entries = info['entries']
+    if isinstance(entries, yt_dlp.utils.PagedList):
+        entries = iter_paged_list(entries, page_size)
+    entries = iter(entries)
+    while True:
+        page = list(itertools.islice(entries, page_size))
+        if not page:
+            return
+        page = [entry for entry in page if entry]
+        if page:
+            yield page
+
+# Page callback for download_info: journals each page's entries and keeps the progress
+# total growing while the playlist length is still unknown
+def playlist_page_tracker(url, task, journal=None):
+    seen = 0
+    def on_page(page):
+        nonlocal seen
+        if journal:
+            journal.add_entries(url, [playlist_entry_url(entry) for entry in page], start=seen)
+        seen += len(page)
+        task.add_entries(len(page))
+    return on_page
+
+# Fetch a URL's metadata exactly once. Single videos come back unprocessed so format
+# selection can be re-run on them locally; playlists come back with their entries still
+# unread, so huge channels are streamed by download_info instead of listed up front.
+# Videos seen recently are served from the metadata cache unless use_cache is off.
+def extract_once(ydl, url, config):
+    if config['use_cache']:
+        info = cache_get(url, config)
+        if info:
+            return info, False
+    info = ydl.extract_info(url, download=False, process=False)
+    # Short links and channel handles point at another page; follow them here
+    while info.get('_type') in ('url', 'url_transparent'):
+        target = ydl.extract_info(info['url'], ie_key=info.get('ie_key'), download=False, process=False)
+        if info['_type'] == 'url_transparent':
+            skip = {'_type', 'url', 'ie_key', 'id', 'extractor', 'extractor_key'}
+            target.update({k: v for k, v in info.items() if v is not None and k not in skip})
+        info = target
+    if info.get('_type') in ('playlist', 'multi_video'):
+        return info, True
+    # Bypassing the cache still refreshes it
+    cache_put(url, info, config)
+    return info, False
+
+# Post-processing stage. yt-dlp's post_process step (format merge, audio extraction,
+# thumbnail/metadata embedding, moving into place) is handed to its own pool so the
+# download slot can fetch the next file while ffmpeg works. The pool threads only wait on
+# ffmpeg child processes, so the pool size is the number of ffmpeg processes run at once.
+class PostProcessStage:
+    def __init__(self):
+        self.workers = os.cpu_count() or 1
+        self.queue_size = self.workers * 2
+        self.executor = None
+        self.slots = None
+        self.lock = threading.Lock()
+
+    def configure(self, workers, queue_size):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or self.workers * 2
+
+    # Queue a call; blocks the calling download thread while the queue is full
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="postprocess")
+                self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+            executor, slots = self.executor, self.slots
+        slots.acquire()
+        future = executor.submit(fn, *args)
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+POSTPROCESS = PostProcessStage()
+
+# Make a YoutubeDL instance queue its post-processing on POSTPROCESS instead of running
+# it inline; the futures are collected in the given list. yt-dlp would run its post hooks
+# and write its archive entry as soon as post_process returns, on the file before
+# post-processing; both happen in the future instead, and only once every step succeeded.
+def defer_postprocessing(ydl, futures):
+    post_process = ydl.post_process
+    post_hooks, ydl._post_hooks = ydl._post_hooks, []
+    record_download_archive = ydl.record_download_archive
+
+    def process(filename, info, files_to_move):
+        # ArchiveRecorderPP leaves its archives here instead of recording straight away
+        info = post_process(filename, {**info, '__archive_pending': []}, files_to_move)
+        for hook in post_hooks:
+            hook(info['filepath'])
+        for archive in info.pop('__archive_pending', []):
+            archive.record(info)
+        if ydl.params.get('download_archive') is not None:
+            record_download_archive(info)
+        return info
+
+    def deferred(filename, info, files_to_move=None):
+        # yt-dlp keeps using its own info dict after this returns, so hand over a copy
+        futures.append(POSTPROCESS.submit(process, filename, dict(info), dict(files_to_move or {})))
+        return info
+
+    # YDL_POOL keeps the instance out of circulation until these are done
+    deferred.futures = futures
+    ydl.post_process = deferred
+    ydl.record_download_archive = lambda info: None
+
+# Worker mode: finished files are moved into the library (and archived) only while the
+# job's lease is still held. lease() checks it; once another node has taken the job over,
+# files not yet moved are deleted and the job stops, leaving the result to that node.
+# Files already at their library path are left alone, since that node writes the same ones.
+def guard_lease(ydl, lease):
+    run_pp = ydl.run_pp
+
+    def guarded_run_pp(pp, info):
+        if pp.pp_key() == 'MoveFiles':
+            # What MoveFiles would move: the file into __finaldir, plus the side files
+            final_dir = info.get('__finaldir') or os.path.dirname(info['filepath'])
+            moves = {**(info.get('__files_to_move') or {}), info['filepath']: None}
+            check_lease(lease, [src for src, dst in moves.items() if os.path.abspath(src)
+                                != os.path.abspath(dst or os.path.join(final_dir, os.path.basename(src)))])
+        return run_pp(pp, info)
+
+    guarded_run_pp.lease = lease
+    ydl.run_pp = guarded_run_pp
+
+# Raise DownloadCancelled, deleting files first, unless lease() confirms the lease
+def check_lease(lease, files=()):
+    try:
+        held = lease()
+    except sqlite3.Error:
+        held = False  # Can't be confirmed, so another node may have it
+    if not held:
+        for path in files:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        raise yt_dlp.utils.DownloadCancelled("lease taken over by another node")
+
+# Advanced mode: subtitles and thumbnails are fetched on SIDE_ASSETS while the media
+# downloads, instead of one after the other before it starts
+# The pool's threads are only started by the first side asset
+class SideAssetPool:
+    WORKERS = 4
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix="side-asset")
+            executor = self.executor
+        return executor.submit(fn, *args)
+
+SIDE_ASSETS = SideAssetPool()
+
+class SideAssets:
+    def __init__(self, ydl):
+        self.pending = {}
+        write_subtitles, write_thumbnails = ydl._write_subtitles, ydl._write_thumbnails
+
+        # yt-dlp moves the files these return into place; collect() hands them over later
+        def subtitles(info_dict, filename):
+            self._start(info_dict, write_subtitles, info_dict, filename)
+            return []
+
+        def thumbnails(label, info_dict, filename, thumb_filename_base=None):
+            if label != 'video':
+                return write_thumbnails(label, info_dict, filename, thumb_filename_base)
+            self._start(info_dict, write_thumbnails, label, info_dict, filename, thumb_filename_base)
+            return []
+
+        ydl._write_subtitles = subtitles
+        ydl._write_thumbnails = thumbnails
+
+    def _start(self, info, write, *args):
+        self.pending.setdefault(info.get('id'), []).append(SIDE_ASSETS.submit(write, *args))
+
+    # Wait for an item's side assets; returns their (file, final path) pairs
+    def collect(self, info):
+        files = []
+        for future in self.pending.pop(info.get('id'), []):
+            try:
+                files.extend(future.result() or [])
+            except Exception as e:
+                print(f"{Fore.YELLOW}Warning: could not fetch subtitles/thumbnail for {info.get('title')}: {str(e)}{Style.RESET_ALL}")
+        return files
+
+# Subtitle codec per output container; containers not listed get no subtitle tracks
+MUX_SUBTITLE_CODECS = {'mp4': 'mov_text', 'm4v': 'mov_text', 'mov': 'mov_text', 'mkv': 'copy', 'webm': 'webvtt'}
+# Containers that take cover art; Matroska only as a JPEG/PNG attachment
+MUX_COVER_EXTS = ('mp4', 'm4v', 'mov', 'mkv')
+
+# One ffmpeg run that writes the final file: the downloaded formats, subtitle tracks, the
+# thumbnail as cover art, tags and chapters, all stream-copied (only a non-JPEG/PNG cover
+# is re-encoded). It takes the place of yt-dlp's merge, metadata and thumbnail passes,
+# each of which would rewrite the whole file.
+@ytdlp_base('postprocessor.FFmpegMetadataPP')
+class SinglePassMuxPP:
+    def __init__(self, downloader, side_assets, subtitles, cover, metadata):
+        super().__init__(downloader, add_metadata=metadata, add_chapters=metadata, add_infojson=False)
+        self.side_assets = side_assets
+        self.subtitles = subtitles
+        self.cover = cover
+
+    def run(self, info):
+        info['__files_to_move'].update(self.side_assets.collect(info))
+        filename, ext = info['filepath'], info['ext']
+        parts = info.get('__files_to_merge') or []
+        formats = info['requested_formats'] if parts else [info]
+        inputs = list(parts) or [filename]
+        options = ['-c', 'copy']
+        audio_streams = video_streams = 0
+        for i, fmt in enumerate(formats):
+            if fmt.get('acodec') != 'none':
+                options += ['-map', f'{i}:a:0']
+                if parts and fmt['protocol'].startswith('m3u8') and self.get_audio_codec(fmt['filepath']) == 'aac':
+                    options += [f'-bsf:a:{audio_streams}', 'aac_adtstoasc']
+                audio_streams += 1
+            if fmt.get('vcodec') != 'none':
+                options += ['-map', f'{i}:v:0']
+                video_streams += 1
+
+        subtitle_codec = MUX_SUBTITLE_CODECS.get(ext) if self.subtitles else None
+        subtitles = [(lang, sub) for lang, sub in (info.get('requested_subtitles') or {}).items()
+                     if subtitle_codec and sub.get('filepath') and os.path.exists(sub['filepath'])
+                     and (subtitle_codec != 'webvtt' or sub.get('ext') == 'vtt')]
+        for n, (lang, sub) in enumerate(subtitles):
+            options += ['-map', f'{len(inputs)}:0', f'-metadata:s:s:{n}', f"language={yt_dlp.utils.ISO639Utils.short2long(lang) or lang}"]
+            inputs.append(sub['filepath'])
+        if subtitles:
+            options += ['-c:s', subtitle_codec]
+
+        thumbnail = next((t['filepath'] for t in reversed(info.get('thumbnails') or [])
+                          if t.get('filepath') and os.path.exists(t['filepath'])), None) if self.cover else None
+        thumbnail_ext = thumbnail and thumbnail.rpartition('.')[2].lower()
+        if thumbnail and ext == 'mkv' and thumbnail_ext in ('jpg', 'jpeg', 'png'):
+            # Matroska carries cover art as an attachment
+            options += ['-attach', thumbnail, '-metadata:s:t:0', f"mimetype=image/{'png' if thumbnail_ext == 'png' else 'jpeg'}",
+                        '-metadata:s:t:0', f'filename=cover.{thumbnail_ext}']
+        elif thumbnail and ext in MUX_COVER_EXTS and ext != 'mkv':
+            options += ['-map', f'{len(inputs)}:0', f'-c:v:{video_streams}', 'copy' if thumbnail_ext in ('jpg', 'jpeg', 'png') else 'mjpeg',
+                        f'-disposition:v:{video_streams}', 'attached_pic']
+            inputs.append(thumbnail)
+        else:
+            thumbnail = None
+
+        files_to_delete = []
+        if self._add_metadata:
+            self._fixup_chapters(info)
+            if info.get('chapters'):
+                chapters_file = yt_dlp.utils.replace_extension(filename, 'meta')
+                list(self._get_chapter_opts(info['chapters'], chapters_file))
+                options += ['-map_metadata', str(len(inputs))]
+                inputs.append(chapters_file)
+                files_to_delete.append(chapters_file)
+            options += [arg for opt in self._get_metadata_opts(info) for arg in opt]
+
+        if not parts and not subtitles and not thumbnail and not self._add_metadata:
+            return [], info
+        temp_filename = yt_dlp.utils.prepend_extension(filename, 'temp')
+        self.to_screen(f'Writing "{filename}" in one pass')
+        self.run_ffmpeg_multiple_files(inputs, temp_filename, options)
+        self._delete_downloaded_files(*files_to_delete)
+        os.replace(temp_filename, filename)
+        return parts, info
+
+# Hand the merge of an advanced download to SinglePassMuxPP, which also takes over
+# subtitle, cover art and metadata embedding; must run before defer_postprocessing
+def mux_in_one_pass(ydl, subtitles, cover, metadata):
+    pp = SinglePassMuxPP(ydl, SideAssets(ydl), subtitles, cover, metadata)
+    post_process = ydl.post_process
+
+    def single_pass(filename, info, files_to_move=None):
+        pps = info.get('__postprocessors') or []
+        merger = next((i for i, p in enumerate(pps) if p.pp_key() == 'Merger'), None)
+        # Fixups queued after the merge still see the finished file
+        info['__postprocessors'] = pps[:merger] + [pp] + pps[merger + 1:] if merger is not None else [*pps, pp]
+        # Not registered through add_post_processor, so pick up the ydl's hooks here
+        for hook in ydl._postprocessor_hooks:
+            if hook not in pp._progress_hooks:
+                pp.add_progress_hook(hook)
+        return post_process(filename, info, files_to_move)
+    ydl.post_process = single_pass
+
+# Staging and disk admission control. With staging_dir set (e.g. a tmpfs or NVMe path),
+# .part files, fragments and every post-processing step (merging, conversion, embedding)
+# are written there, and only the finished file goes to the library folder. That move is
+# a rename on one filesystem. Across filesystems the file is copied under a temporary name
+# next to its destination and then renamed, so the library never holds a half-copied
+# file. Before a file downloads, the space it will take is reserved on both disks. Its
+# size comes from the selected formats, and the staging disk reserves
+# STAGING_WRITE_FACTOR times that, because post-processing writes a new file next to the
+# downloaded ones. The download only starts once every disk can take its share on top of
+# what running downloads still have reserved, with min_free_gb to spare. So concurrent
+# jobs never fill a disk halfway through.
+STAGING_WRITE_FACTOR = 2
+STAGING_POLL_INTERVAL = 1.0
+
+# Space held for one file: bytes per device, less what its download has already written
+# to the staging disk
+class SpaceReservation:
+    def __init__(self, needs, staging_device):
+        self.needs = needs
+        self.staging_device = staging_device
+        self.written = {}  # Downloaded bytes per file
+
+    def outstanding(self, device):
+        need = self.needs.get(device, 0)
+        if device == self.staging_device:
+            need -= sum(self.written.values())
+        return max(need, 0)
+
+# The file a reservation is held for
+def staged_item_key(info):
+    return (info.get('extractor_key'), info.get('id'))
+
+class StagingArea:
+    def __init__(self):
+        self.root = None
+        self.headroom = 0
+        self.reservations = []
+        self.cond = threading.Condition()
+
+    def configure(self, config):
+        self.root = Path(config['staging_dir']).expanduser() if config['staging_dir'] else None
+        self.headroom = max(0, config['min_free_gb']) * 1024 ** 3
+
+    # yt-dlp's 'paths' for downloads into a library folder
+    def paths(self, library):
+        temp = self.root / library.name if self.root else library
+        temp.mkdir(parents=True, exist_ok=True)
+        return {'home': str(library), 'temp': str(temp)}
+
+    # Wait until size bytes fit on the staging and library disks and reserve them. Raises
+    # DownloadError if they don't fit even with no other download holding space.
+    def reserve(self, paths, size, title):
+        where = {os.stat(paths['temp']).st_dev: paths['temp']}
+        needs = {next(iter(where)): size * STAGING_WRITE_FACTOR}
+        library_device = os.stat(paths['home']).st_dev
+        # On the staging disk itself the move is a rename and needs no extra space
+        if library_device not in where:
+            where[library_device] = paths['home']
+            needs[library_device] = size
+        reservation = SpaceReservation(needs, next(iter(where)))
+        waiting = False
+        with self.cond:
+            while True:
+                short = []
+                for device, need in needs.items():
+                    available = (shutil.disk_usage(where[device]).free - self.headroom
+                                 - sum(other.outstanding(device) for other in self.reservations))
+                    if need > available:
+                        short.append((where[device], need, max(available, 0)))
+                if not short:
+                    self.reservations.append(reservation)
+                    return reservation
+                path, need, available = short[0]
+                if not self.reservations:
+                    detail = (f"needs {format_size(need)}, {format_size(available) if available else 'nothing'} "
+                              f"available beyond min_free_gb" if need else "less than min_free_gb free")
+                    raise yt_dlp.utils.DownloadError(f"not enough disk space for {title} in {path}: {detail}")
+                if not waiting:
+                    waiting = True
+                    print(f"{Fore.YELLOW}💾 Waiting for disk space for {title} in {path} "
+                          f"({format_size(need)} needed){Style.RESET_ALL}")
+                if CANCEL_EVENT.is_set():
+                    raise yt_dlp.utils.DownloadCancelled()
+                self.cond.wait(STAGING_POLL_INTERVAL)
+
+    def release(self, reservation):
+        with self.cond:
+            if reservation in self.reservations:
+                self.reservations.remove(reservation)
+                self.cond.notify_all()
+
+    # Reserve space for every file a YoutubeDL instance downloads, move finished files into
+    # the library atomically and release their space once they are there
+    @contextlib.contextmanager
+    def attach(self, ydl):
+        held = {}
+
+        def moved(info):
+            reservation = held.pop(staged_item_key(info), None)
+            if reservation:
+                self.release(reservation)
+
+        def hook(d):
+            reservation = held.get(staged_item_key(d['info_dict']))
+            if reservation and d['status'] in ('downloading', 'finished'):
+                reservation.written[d.get('filename')] = d.get('downloaded_bytes') or 0
+
+        run_pp = ydl.run_pp
+        def staged_run_pp(pp, info):
+            if pp.pp_key() == 'MoveFiles':
+                pp = StagedMovePP(ydl, pp._downloaded, moved)
+            return run_pp(pp, info)
+
+        ydl.add_post_processor(SpaceReservationPP(self, held), when='before_dl')
+        ydl.add_progress_hook(hook)
+        ydl.run_pp = staged_run_pp
+        try:
+            yield
+        finally:
+            # Space of files that never got moved goes back once nothing can still move them
+            leftover = list(held.values())
+            pending = [f for f in getattr(vars(ydl).get('post_process'), 'futures', ()) if not f.done()]
+            def release_leftover(_=None):
+                if all(future.done() for future in pending):
+                    for reservation in leftover:
+                        self.release(reservation)
+            for future in pending:
+                future.add_done_callback(release_leftover)
+            release_leftover()
+
+STAGING = StagingArea()
+
+# Reserves a file's space before its download starts
+@ytdlp_base('postprocessor.PostProcessor')
+class SpaceReservationPP:
+    def __init__(self, staging, held):
+        super().__init__()
+        self.staging = staging
+        self.held = held
+
+    def run(self, info):
+        key = staged_item_key(info)
+        if key not in self.held:
+            size = estimate_format_bytes(info, info.get('duration')) or 0
+            self.held[key] = self.staging.reserve(self._downloader.params['paths'], size,
+                                                  info.get('title') or info.get('id'))
+        return [], info
+
+# Move a finished file into the library, so that it shows up there whole or not at all
+def move_into_library(src, dst):
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    partial = f"{dst}.staging"
+    try:
+        shutil.copy2(src, partial)
+        with open(partial, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(partial, dst)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(partial)
+        raise
+    os.unlink(src)
+
+# yt-dlp's final move out of paths.temp, with move_into_library doing the moving.
+# on_moved is called with the info dict once the files are in place.
+@ytdlp_base('postprocessor.MoveFilesAfterDownloadPP')
+class StagedMovePP:
+    def __init__(self, downloader, downloaded, on_moved):
+        super().__init__(downloader, downloaded)
+        self.on_moved = on_moved
+
+    def run(self, info):
+        finaldir = info.get('__finaldir', os.path.dirname(info['filepath']))
+        finalpath = os.path.join(finaldir, os.path.basename(info['filepath']))
+        if self._downloaded:
+            info['__files_to_move'][info['filepath']] = finalpath
+        for old, new in info['__files_to_move'].items():
+            new = new or os.path.join(finaldir, os.path.basename(old))
+            if os.path.abspath(old) == os.path.abspath(new):
+                continue
+            if not os.path.exists(old):
+                self.report_warning(f'File "{old}" cannot be found')
+                continue
+            if os.path.exists(new) and not self.get_param('overwrites', True):
+                self.report_warning(f'Cannot move file "{old}" out of temporary directory since "{new}" already exists. ')
+                continue
+            try:
+                os.makedirs(os.path.dirname(new), exist_ok=True)
+            except OSError as e:
+                raise yt_dlp.utils.PostProcessingError(f'Unable to create directory: {e}') from e
+            self.to_screen(f'Moving file "{old}" to "{new}"')
+            move_into_library(old, new)
+        info['filepath'] = finalpath
+        self.on_moved(info)
+        return [], info
+
+# Segmented downloads. A large progressive file is fetched as byte ranges over several
+# connections at once, so a per-connection throttle no longer caps the transfer. Every
+# range is written straight to its offset in the .part file, so nothing is reassembled.
+# Connections are added one per SEGMENT_RAMP_INTERVAL while each new one still adds about
+# a connection's worth of speed; once it doesn't, the link is the limit and ramping stops.
+SEGMENT_RAMP_INTERVAL = 1.0
+# Share of one connection's speed a new connection must add for ramping to go on
+SEGMENT_RAMP_GAIN = 0.5
+SEGMENT_PIECE_MIN = 1024 * 1024
+SEGMENT_PIECE_MAX = 32 * 1024 * 1024
+SEGMENT_BLOCK = 64 * 1024
+# Connection count the last segmented download settled on, per host. Later files from the
+# host start there, and DASH/HLS downloads use it for concurrent fragments.
+SEGMENT_HISTORY = {}
+
+@ytdlp_base('downloader.http.HttpFD')
+class SegmentedHttpFD:
+    def __init__(self, ydl, params, max_segments, min_bytes, throttle=None):
+        super().__init__(ydl, params)
+        self.max_segments = max_segments
+        self.min_bytes = min_bytes
+        self.throttle = throttle or (lambda nbytes: None)
+
+    def real_download(self, filename, info_dict):
+        url = info_dict['url']
+        # Byte offsets only line up with an uncompressed body, as in HttpFD
+        headers = {**(info_dict.get('http_headers') or {}), 'Accept-Encoding': 'identity'}
+        known_size = info_dict.get('filesize') or info_dict.get('filesize_approx')
+        total = None if known_size and known_size < self.min_bytes else self.probe_size(url, headers)
+        if not total or total < self.min_bytes:
+            return super().real_download(filename, info_dict)
+        return self.download_segmented(filename, info_dict, url, headers, total)
+
+    # Total size if the server honors range requests, else None
+    def probe_size(self, url, headers):
+        try:
+            with self.ydl.urlopen(yt_dlp.networking.Request(url, headers={**headers, 'Range': 'bytes=0-0'})) as response:
+                match = re.match(r'bytes 0-0/(\d+)', response.headers.get('Content-Range') or '')
+                return int(match.group(1)) if response.status == 206 and match else None
+        except yt_dlp.networking.exceptions.RequestError:
+            return None
+
+    # Where each piece got to in an earlier, interrupted run: from the .segments file kept
+    # next to the .part file, or the prefix a plain sequential download left behind. A
+    # .part of the full size without a state file was pre-allocated by a segmented run
+    # that died before saving any state, so nothing in it can be trusted.
+    @staticmethod
+    def load_progress(tmpfilename, state_file, pieces, piece_size):
+        fresh = [start for start, _ in pieces]
+        if not os.path.exists(tmpfilename):
+            return fresh
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            if state['piece_size'] == piece_size and len(state['reached']) == len(pieces):
+                return state['reached']
+            return fresh
+        except (OSError, ValueError, KeyError):
+            prefix = os.path.getsize(tmpfilename)
+            if prefix >= pieces[-1][1]:
+                return fresh
+            return [min(max(prefix, start), end) for start, end in pieces]
+
+    # Fetch one piece from reached[index] on, recording every block written
+    def fetch_range(self, url, headers, index, end, reached, counter, out, lock, stop):
+        pos = reached[index]
+        with self.ydl.urlopen(yt_dlp.networking.Request(url, headers={**headers, 'Range': f'bytes={pos}-{end - 1}'})) as response:
+            if response.status != 206:
+                raise yt_dlp.networking.exceptions.RequestError('server ignored the range request')
+            out.seek(pos)
+            while pos < end and not stop.is_set():
+                block = response.read(min(SEGMENT_BLOCK, end - pos))
+                if not block:
+                    break
+                out.write(block)
+                pos += len(block)
+                with lock:
+                    reached[index] = pos
+                    counter[0] += len(block)
+                self.throttle(len(block))
+
+    def download_segmented(self, filename, info_dict, url, headers, total):
+        tmpfilename = self.temp_name(filename)
+        state_file = tmpfilename + '.segments'
+        piece_size = min(max(total // (self.max_segments * 4), SEGMENT_PIECE_MIN), SEGMENT_PIECE_MAX)
+        pieces = [(start, min(start + piece_size, total)) for start in range(0, total, piece_size)]
+        if self.params.get('continuedl', True):
+            reached = self.load_progress(tmpfilename, state_file, pieces, piece_size)
+        else:
+            reached = [start for start, _ in pieces]
+
+        def save_state():
+            with open(state_file, 'w') as f:
+                json.dump({'piece_size': piece_size, 'reached': reached}, f)
+
+        # The state goes down before the .part grows to full size, so a crash in between
+        # can't leave a full-size file that looks like a finished sequential prefix
+        save_state()
+        with open(tmpfilename, 'ab') as out:
+            out.truncate(total)
+        pending = collections.deque((index, end, 0) for index, (_, end) in enumerate(pieces) if reached[index] < end)
+        counter = [sum(pos - start for pos, (start, _) in zip(reached, pieces))]
+        lock = threading.Lock()
+        stop = threading.Event()
+        errors = []
+        retries = self.params.get('retries', 10)
+
+        def worker():
+            with open(tmpfilename, 'r+b') as out:
+                while not stop.is_set():
+                    with lock:
+                        if not pending:
+                            return
+                        index, end, attempt = pending.popleft()
+                    error = None
+                    try:
+                        self.fetch_range(url, headers, index, end, reached, counter, out, lock, stop)
+                    except (yt_dlp.networking.exceptions.RequestError, OSError) as e:
+                        error = e
+                    with lock:
+                        if reached[index] >= end:
+                            save_state()
+                        elif stop.is_set():
+                            return
+                        elif attempt >= retries:
+                            errors.append(error or 'connection closed early')
+                            stop.set()
+                        else:
+                            # Resume the piece where it stopped, on whichever connection is free next
+                            pending.append((index, end, attempt + 1))
+
+        threads = []
+        def add_connection():
+            thread = threading.Thread(target=worker, name="segment", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        self.report_destination(filename)
+        host = urlparse(url).hostname
+        for _ in range(min(SEGMENT_HISTORY.get(host, 1), len(pending))):
+            add_connection()
+        started = last_time = time.monotonic()
+        last_bytes = counter[0]
+        speed, previous_speed, per_connection = None, 0, None
+        ramping, added = True, False
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.25)
+                now = time.monotonic()
+                downloaded = counter[0]
+                if now - last_time >= SEGMENT_RAMP_INTERVAL:
+                    speed = (downloaded - last_bytes) / (now - last_time)
+                    connections = sum(thread.is_alive() for thread in threads)
+                    # Compare the speed gained by the last connection with what each
+                    # connection carried on average before it was added
+                    if ramping and added and speed - previous_speed < SEGMENT_RAMP_GAIN * per_connection:
+                        # The last connection barely helped: the link, not the server, is the limit
+                        ramping = False
+                        SEGMENT_HISTORY[host] = max(connections - 1, 1)
+                    per_connection, previous_speed, added = speed / max(connections, 1), speed, False
+                    if ramping and connections >= self.max_segments:
+                        ramping = False
+                        SEGMENT_HISTORY[host] = connections
+                    elif ramping and pending:
+                        add_connection()
+                        added = True
+                    else:
+                        # Out of pieces before the limit was found; nothing learned
+                        ramping = False
+                    last_time, last_bytes = now, downloaded
+                self._hook_progress({
+                    'status': 'downloading',
+                    'downloaded_bytes': downloaded,
+                    'total_bytes': total,
+                    'tmpfilename': tmpfilename,
+                    'filename': filename,
+                    'speed': speed,
+                    'eta': (total - downloaded) / speed if speed else None,
+                    'elapsed': now - started,
+                    'throttled': True,  # Every connection is throttled on its own
+                }, info_dict)
+        except BaseException:
+            # Cancelled from a progress hook: let the connections wind down and keep the pieces
+            stop.set()
+            for thread in threads:
+                thread.join()
+            save_state()
+            raise
+        if errors or any(pos < end for pos, (_, end) in zip(reached, pieces)):
+            save_state()
+            self.report_error(f'segmented download failed: {errors[0] if errors else "incomplete"}')
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(state_file)
+        self.try_rename(tmpfilename, filename)
+        self._hook_progress({
+            'status': 'finished',
+            'downloaded_bytes': total,
+            'total_bytes': total,
+            'filename': filename,
+            'elapsed': time.monotonic() - started,
+        }, info_dict)
+        return True
+
+# Send a YoutubeDL instance's progressive HTTP downloads through SegmentedHttpFD, and let
+# its DASH/HLS downloads fetch as many fragments at once as segmenting settled on.
+# throttle is called with the size of every block the connections receive.
+def enable_segmented_downloads(ydl, config, throttle=None):
+    plain_dl = ydl.dl
+    min_bytes = config['segment_min_mb'] * 1024 * 1024
+
+    def dl(name, info, subtitle=False, test=False):
+        # Missing URLs, POST bodies and impersonation are left to yt-dlp's own handling
+        if (subtitle or test or name == '-' or info.get('is_live') or not info.get('url')
+                or info.get('request_data') or info.get('impersonate')):
+            return plain_dl(name, info, subtitle, test)
+        if yt_dlp.downloader.get_suitable_downloader(info, ydl.params) is not yt_dlp.downloader.http.HttpFD:
+            host = urlparse(info.get('fragment_base_url') or info.get('url') or '').hostname
+            ydl.params['concurrent_fragment_downloads'] = SEGMENT_HISTORY.get(host, config['max_segments'])
+            return plain_dl(name, info, subtitle, test)
+        fd = SegmentedHttpFD(ydl, ydl.params, config['max_segments'], min_bytes, throttle)
+        for hook in ydl._progress_hooks:
+            fd.add_progress_hook(hook)
+        # The same preparation YoutubeDL.dl does before handing the info to a downloader
+        info = ydl._copy_infodict(info)
+        if info.get('http_headers') is None:
+            info['http_headers'] = ydl._calc_headers(info)
+        return fd.download(name, info)
+
+    ydl.dl = dl
+
+# Bandwidth priority class of a download: the configured one, or with "auto", bulk for
+# playlists so single videos started alongside them get ahead
+def job_priority(config, is_playlist):
+    if config['priority'] != 'auto':
+        return config['priority']
+    return 'bulk' if is_playlist else 'normal'
+
+# Download (and post-process) an info dict returned by extract_once. Playlists are
+# downloaded one page at a time; on_page sees each page before it is downloaded.
+# yt-dlp sees every page as a playlist of its own, so the entries are renumbered
+# across the whole playlist and the playlist's own files (info JSON, description,
+# thumbnail) are written with the first page only.
+def download_info(ydl, info, on_page=None):
+    # Playlist entries must be fully resolved from here on
+    ydl.params['extract_flat'] = False
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        ydl.process_ie_result(info, download=True)
+        return
+    offset, total, page = 0, playlist_size(info), []
+    process_ie_result = ydl.process_ie_result
+
+    def process_entry(ie_result, download=True, extra_info=None):
+        # Only the page's own entries, once, and not the entries of playlists nested in them
+        if extra_info and 'playlist_index' in extra_info and any(ie_result is entry for entry in page):
+            extra_info = {**extra_info, 'playlist_index': offset + extra_info['playlist_index'],
+                          'playlist_autonumber': offset + extra_info['playlist_autonumber'],
+                          'n_entries': total, 'playlist_count': total}
+        return process_ie_result(ie_result, download=download, extra_info=extra_info)
+    ydl.process_ie_result = process_entry
+    try:
+        for page in iter_playlist_pages(info):
+            if on_page:
+                on_page(page)
+            process_ie_result({**info, 'entries': page}, download=True)
+            ydl.params['allow_playlist_files'] = False
+            offset += len(page)
+    finally:
+        del ydl.process_ie_result
+
+# Entries of a listed page still to be downloaded count towards the adaptive plan
+def count_adaptive_entries(ydl, on_page):
+    def counting(page):
+        on_page(page)
+        ADAPTIVE.add_items(sum(1 for entry in page if not ydl.in_download_archive(entry)))
+    return counting
+
+# Download video
+def download_video(url, quality, config, job=None, finished=None):
+    if not check_ffmpeg():
+        return False
+    VIDEO_DIR.mkdir(parents=True, exist_ok=True)
+    archive = DownloadArchive(f"video:{quality}") if config['use_archive'] else None
+    if already_downloaded(archive, url):
+        return True
+    
+    format_str = "bestvideo+bestaudio/best" if quality in ("best", "adaptive") else f"bv*[height<={quality[:-1]}]+ba/best"
+    format_display = quality if quality != "best" else "best"
+    task = PROGRESS.add(url, "Video")
+    ydl_opts = {
+        'format': format_str,
+        'outtmpl': "%(title)s (%(height)sp).%(ext)s",  # Under paths.home
+        'merge_output_format': 'mp4',
+        'nopostoverwrites': True,  # Prevent overwriting during post-processing
+        'ffmpeg_location': None,
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,  # Progress is drawn by PROGRESS instead
+        'extract_flat': 'in_playlist',
+        'download_archive': archive,  # Skips archived playlist entries before they are extracted
+        'progress_hooks': [task.hook],
+        'paths': STAGING.paths(VIDEO_DIR)
+    }
+    adaptive = quality == "adaptive"
+    with YDL_POOL.get(ydl_opts) as ydl, task, STAGING.attach(ydl), \
+            ADAPTIVE.attach(ydl) if adaptive else contextlib.nullcontext():
+        if archive:
+            ydl.add_post_processor(ArchiveRecorderPP(archive), when='after_move')
+        if finished is not None:
+            ydl.add_post_processor(FinishedFilesPP(finished), when='after_move')
+        if job is not None:
+            defer_postprocessing(ydl, job.postprocessing)
+            if job.lease:
+                guard_lease(ydl, job.lease)
+        if config['segmented_downloads']:
+            enable_segmented_downloads(ydl, config, task.throttle)
+        TRACE.attach(ydl, url)
+        # The page is fetched once here; everything below reuses this info dict
+        try:
+            with TRACE.span(url, 'extract'):
+                info, is_playlist = extract_once(ydl, url, config)
+        except ydl_errors() as e:
+            print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
+            return False
+        if job and job.journal:
+            track_in_journal(ydl, job.journal, url, info, is_playlist)
+        task.priority = job_priority(config, is_playlist)
+        
+        if is_playlist:
+            playlist_title = info.get('title', 'Unknown Playlist')
+            num_videos = task.of = playlist_size(info) or 0
+            print(f"{Fore.BLUE}🎥 Playlist: {playlist_title}{Style.RESET_ALL}")
+            print(f"{Fore.BLUE}📋 Number of videos: {num_videos or f'unknown yet, streamed {PLAYLIST_PAGE_SIZE} at a time'}{Style.RESET_ALL}")
+            if not confirm("Proceed with downloading playlist?"):
+                return False
+        else:
+            # Single video: run format selection on the cached info for accurate size
+            try:
+                with TRACE.span(url, 'format'):
+                    info = ydl.process_ie_result(info, download=False)
+            except ydl_errors() as e:
+                print(f"{Fore.RED}Error fetching info for {url}: {str(e)}. Falling back to best available.{Style.RESET_ALL}")
+                format_str = 'bestvideo+bestaudio/best'
+                format_display = "best"
+                set_format(ydl, format_str)
+                try:
+                    info = ydl.process_ie_result(info, download=False)
+                except ydl_errors() as e:
+                    print(f"{Fore.RED}Failed to download {url}: {str(e)}{Style.RESET_ALL}")
+                    return False
+            
+            title = clean_filename(info['title'])
+            height = info.get('height', 'best')
+            quality_display = f"{height}p" if height and format_display in ("best", "adaptive") else format_display
+            output_path = VIDEO_DIR / f"{title} ({quality_display}).%(ext)s"
+            set_outtmpl(ydl, VIDEO_DIR / f"{outtmpl_escape(title)} ({quality_display}).%(ext)s")
+            
+            if not show_pre_download_info(info, quality_display, str(output_path), quality):
+                return False
+            task.expected_total = info.get('filesize') or info.get('filesize_approx') or 0
+        
+        try:
+            on_page = playlist_page_tracker(url, task, job and job.journal)
+            if adaptive and is_playlist:
+                on_page = count_adaptive_entries(ydl, on_page)
+            download_info(ydl, info, on_page)
+            return True
+        except ydl_errors() as e:
+            if not is_playlist:
+                print(f"{Fore.RED}Error downloading {url}: {str(e)}. Falling back to best available.{Style.RESET_ALL}")
+                # Re-select formats on the cached info instead of extracting again
+                set_format(ydl, 'bestvideo+bestaudio/best')
+                set_outtmpl(ydl, VIDEO_DIR / f"{outtmpl_escape(title)} ({info.get('height', 'best')}p).%(ext)s")
+                try:
+                    download_info(ydl, info)
+                    filename = VIDEO_DIR / f"{title} ({info.get('height', 'best')}p).mp4"
+                    print(f"{Fore.GREEN}✅ Download complete: {filename}{Style.RESET_ALL}")
+                    return True
+                except ydl_errors() as e:
+                    print(f"{Fore.RED}Failed to download {url}: {str(e)}{Style.RESET_ALL}")
+                    return False
+            else:
+                print(f"{Fore.RED}Error downloading playlist {url}: {str(e)}{Style.RESET_ALL}")
+                return False
+
+# Audio output codecs; "original" keeps whatever codec the source stream has
+AUDIO_CODECS = ["mp3", "original", "m4a", "opus", "vorbis", "flac"]
+# Lossless sources are never re-encoded just to meet a bitrate
+LOSSLESS_CODECS = ('flac', 'alac', 'wav')
+# Encoder quality used for "best" when a transcode is unavoidable (highest VBR setting).
+# MP3 keeps the 320kbps CBR it always had.
+BEST_VBR_QUALITY = '0'
+BEST_MP3_QUALITY = '320'
+
+# Quality part of audio file names, e.g. "192kbps"; MP3 "best" keeps its "320kbps" label
+def audio_quality_label(codec, quality):
+    if quality != "best":
+        return f"{quality}kbps"
+    return "320kbps" if codec == "mp3" else "best"
+
+# Codec of the source audio stream from the format metadata, e.g. "mp4a.40.2" -> "aac"
+def source_audio_codec(info):
+    acodec = (info.get('acodec') or '').split('.')[0].lower()
+    acodec = 'aac' if acodec == 'mp4a' else acodec
+    return acodec if acodec in yt_dlp.postprocessor.ffmpeg.ACODECS else None
+
+# Decide how a downloaded audio stream becomes the output file. Returns the
+# FFmpegExtractAudio target ("best" copies the stream into a matching container),
+# the encoder quality (None when copying), the codec to report instead of running
+# ffprobe, and whether to transcode even though the source is already in the target codec.
+def plan_audio_output(info, codec, quality):
+    source = source_audio_codec(info)
+    abr = info.get('abr')
+    bitrate = None if quality == 'best' else float(quality)
+    if codec == 'original' and source is None:
+        return 'best', None, None, False  # Unknown codec: let ffprobe decide
+    if source is not None and codec in ('original', source, 'm4a' if source == 'aac' else source):
+        # Re-encoding to a higher bitrate cannot add quality, so only a lower one is honored
+        if bitrate is None or source in LOSSLESS_CODECS or (abr and abr <= bitrate * 1.05):
+            return 'best', None, source, False
+        return ('m4a' if source == 'aac' else source), bitrate, source, True
+    best = BEST_MP3_QUALITY if codec == 'mp3' else BEST_VBR_QUALITY
+    return codec, bitrate or best, source, False
+
+# Extension of the output file for a plan, for paths shown before the download
+def planned_audio_ext(info, plan):
+    target, _, source, _ = plan
+    acodecs = yt_dlp.postprocessor.ffmpeg.ACODECS
+    if target != 'best':
+        return acodecs[target][0]
+    if source is None or info.get('ext') in yt_dlp.postprocessor.FFmpegExtractAudioPP.COMMON_AUDIO_EXTS:
+        return info.get('ext')
+    return acodecs[source][0] if source in acodecs else 'mp3'
+
+# One-line description of a plan, e.g. "opus 160kbps (copied, no re-encode)"
+def describe_audio_plan(info, plan):
+    target, bitrate, source, _ = plan
+    abr = info.get('abr')
+    src = f"{source or info.get('acodec') or 'unknown'}" + (f" {abr:.0f}kbps" if abr else "")
+    if target == 'best':
+        return f"{src} (copied, no re-encode)" if source else f"{src} (copied when possible)"
+    quality = f"{float(bitrate):.0f}kbps" if float(bitrate) > 10 else "best VBR"
+    return f"{src} → {target} {quality}"
+
+# FFmpegExtractAudio that takes the source codec from the format metadata, so no ffprobe
+# call is needed. With transcode, a stream already in the target codec is encoded again
+# (at a lower bitrate) where FFmpegExtractAudio would copy it.
+@ytdlp_base('postprocessor.FFmpegExtractAudioPP')
+class KnownCodecExtractAudioPP:
+    def __init__(self, downloader, target, quality, source, transcode=False):
+        super().__init__(downloader, preferredcodec=target, preferredquality=quality)
+        self.source = source
+        self.transcode = transcode
+
+    def get_audio_codec(self, path):
+        return self.source or super().get_audio_codec(path)
+
+    def run(self, info):
+        if not self.transcode:
+            return super().run(info)
+        path = info['filepath']
+        extension, acodec, _ = yt_dlp.postprocessor.ffmpeg.ACODECS[self.mapping]
+        if acodec == 'aac' and self.get_versions_and_features(self._downloader)[1].get('fdk'):
+            acodec = 'libfdk_aac'
+        new_path = yt_dlp.utils.replace_extension(path, extension, info['ext'])
+        temp_path = yt_dlp.utils.prepend_extension(new_path, 'temp')
+        orig_path = yt_dlp.utils.prepend_extension(path, 'orig') if new_path == path else path
+        self.to_screen(f'Destination: {new_path}')
+        self.run_ffmpeg(path, temp_path, acodec, self._quality_args(acodec))
+        os.replace(path, orig_path)
+        os.replace(temp_path, new_path)
+        info['filepath'], info['ext'] = new_path, extension
+        return [orig_path], info
+
+# Audio output mode: every file is planned on its own, since playlist entries can differ in codec
+@ytdlp_base('postprocessor.PostProcessor')
+class AudioOutputPP:
+    def __init__(self, codec, quality):
+        super().__init__()
+        self.codec = codec
+        self.quality = quality
+
+    def run(self, info):
+        pp = KnownCodecExtractAudioPP(self._downloader, *plan_audio_output(info, self.codec, self.quality))
+        return pp.run(info)
+
+# Codec and bitrate (kb/s) of a local file's first audio stream from ffprobe's JSON
+# stream listing. Without ffprobe, yt-dlp's own probe supplies the codec alone. None if
+# the file has no audio stream.
+def probe_audio_stream(path):
+    ffprobe = probe_ffmpeg()['paths']['ffprobe']
+    if not ffprobe:
+        try:
+            codec = yt_dlp.postprocessor.FFmpegPostProcessor().get_audio_codec(str(path))
+        except yt_dlp.utils.PostProcessingError:
+            return None
+        return {'acodec': codec, 'abr': None} if codec else None
+    try:
+        out = subprocess.run([ffprobe, '-v', 'error', '-select_streams', 'a:0', '-show_streams', '-of', 'json',
+                              str(path)], capture_output=True, text=True, timeout=60).stdout
+        streams = json.loads(out or '{}').get('streams')
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+    if not streams:
+        return None
+    bitrate = streams[0].get('bit_rate')
+    return {'acodec': streams[0].get('codec_name'), 'abr': int(bitrate) / 1000 if bitrate else None}
+
+# Write the audio of a local video file to "<stem>.<ext>" with the same plan a download
+# would get. The video is hardlinked under the output name so ffmpeg writes straight into
+# the audio folder; the video itself is never touched. Returns the output path.
+def extract_local_audio(ydl, video, stem, plan):
+    source = Path(video)
+    staged = Path(f"{stem}{source.suffix}")
+    try:
+        os.link(source, staged)
+    except OSError:
+        staged = source  # Output lands next to the video and is moved below
+    try:
+        pp = KnownCodecExtractAudioPP(ydl, *plan)
+        output = Path(pp.run({'filepath': str(staged), 'ext': source.suffix[1:]})[1]['filepath'])
+    except BaseException:
+        if staged != source:
+            staged.unlink(missing_ok=True)
+        raise
+    final = Path(f"{stem}{output.suffix}")
+    if output == source:
+        # Already a plain audio file (an audio-only advanced download) that could not be linked
+        shutil.copy2(source, final)
+    elif output != staged:
+        if staged != source:
+            staged.unlink(missing_ok=True)
+        if output != final:
+            shutil.move(output, final)
+    return final
+
+# Title a video was saved under, from its file name, e.g. "Title (720p).mp4" -> "Title"
+def title_from_video(path):
+    return re.sub(r' \((?:\d+p|best|bestp|Nonep|NAp)\)$', '', Path(path).stem)
+
+# Take the audio from a video of the same id that is already on disk instead of fetching
+# it again: an archived one, or one downloaded earlier in the same job (local_videos,
+# archive id -> path). Without a title the video's file name supplies it. Returns True
+# when the audio file was written (and archived).
+def audio_from_local_video(ydl, archive, archive_id, url, title, audio_codec, audio_quality, local_videos=None):
+    if not archive_id:
+        return False
+    quality_display = audio_quality_label(audio_codec, audio_quality)
+    videos = archived_videos(archive_id)
+    local = (local_videos or {}).get(archive_id)
+    if local and os.path.exists(local):
+        videos.insert(0, (local, "this job"))
+    for video, profile in videos:
+        stream = probe_audio_stream(video)
+        if stream is None:
+            continue  # e.g. a video-only advanced format
+        plan = plan_audio_output(stream, audio_codec, audio_quality)
+        print(f"{Fore.BLUE}🎵 Taking audio from the downloaded video ({profile}): {video}{Style.RESET_ALL}")
+        print(f"{Fore.BLUE}   {describe_audio_plan(stream, plan)}{Style.RESET_ALL}")
+        try:
+            with TRACE.span(url, 'transcode'):
+                output = extract_local_audio(ydl, video, AUDIO_DIR / f"{clean_filename(title or title_from_video(video))} ({quality_display})", plan)
+        except (yt_dlp.utils.PostProcessingError, OSError) as e:
+            print(f"{Fore.YELLOW}Could not extract audio from {video}: {str(e)}. Downloading it instead.{Style.RESET_ALL}")
+            return False
+        lease = getattr(vars(ydl).get('run_pp'), 'lease', None)
+        if lease:
+            check_lease(lease)
+        if archive:
+            archive.record_file(archive_id, str(output), url)
+        print(f"{Fore.GREEN}✅ Download complete: {output}{Style.RESET_ALL}")
+        return True
+    return False
+
+# Playlist entries whose video is already on disk get their audio from it and are then
+# skipped by yt-dlp. Flat entries are checked before their page is even fetched.
+def derive_entries_from_local_videos(ydl, archive, job, audio_codec, audio_quality, local_videos=None):
+    previous = ydl.params.get('match_filter')
+
+    def match_filter(entry, incomplete=False):
+        reason = previous(entry, incomplete=incomplete) if previous else None
+        if reason is not None or not entry.get('title'):
+            return reason
+        if audio_from_local_video(ydl, archive, ydl._make_archive_id(entry), playlist_entry_url(entry),
+                                  entry['title'], audio_codec, audio_quality, local_videos):
+            if job and job.journal:
+                job.journal.update(playlist_entry_url(entry), 'done')
+            return 'audio taken from the downloaded video'
+        return None
+    ydl.params['match_filter'] = match_filter
+
+# Download audio
+def download_audio(url, audio_quality, config, job=None, audio_codec=None, local_videos=None):
+    if not check_ffmpeg():
+        return False
+    audio_codec = audio_codec or config['audio_codec']
+    encoder = yt_dlp.postprocessor.ffmpeg.ACODECS.get(audio_codec, (None, None))[1]
+    if encoder and not ffmpeg_has_encoder(encoder):
+        print(f"{Fore.RED}Error: this FFmpeg build has no {encoder} encoder, needed for {audio_codec} output.{Style.RESET_ALL}")
+        return False
+    AUDIO_DIR.mkdir(parents=True, exist_ok=True)
+    # MP3 keeps the profile name it had before other codecs existed
+    profile = f"audio:{audio_quality}" if audio_codec == 'mp3' else f"audio:{audio_codec}:{audio_quality}"
+    archive = DownloadArchive(profile) if config['use_archive'] else None
+    if already_downloaded(archive, url):
+        return True
+    
+    quality_display = audio_quality_label(audio_codec, audio_quality)
+    task = PROGRESS.add(url, "Audio")
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': f"%(title)s ({quality_display}).%(ext)s",  # Under paths.home
+        'ffmpeg_location': None,
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,  # Progress is drawn by PROGRESS instead
+        'extract_flat': 'in_playlist',
+        'download_archive': archive,  # Skips archived playlist entries before they are extracted
+        'progress_hooks': [task.hook],
+        'paths': STAGING.paths(AUDIO_DIR)
+    }
+    with YDL_POOL.get(ydl_opts) as ydl, task, STAGING.attach(ydl):
+        ydl.add_post_processor(AudioOutputPP(audio_codec, audio_quality))
+        if archive:
+            ydl.add_post_processor(ArchiveRecorderPP(archive), when='after_move')
+        if job is not None:
+            defer_postprocessing(ydl, job.postprocessing)
+            if job.lease:
+                guard_lease(ydl, job.lease)
+        TRACE.attach(ydl, url)
+        # A video of this link already on disk is found offline, before any extraction
+        if audio_from_local_video(ydl, archive, offline_archive_id(url), url, None,
+                                  audio_codec, audio_quality, local_videos):
+            return True
+        # The page is fetched once here; everything below reuses this info dict
+        try:
+            with TRACE.span(url, 'extract'):
+                info, is_playlist = extract_once(ydl, url, config)
+        except ydl_errors() as e:
+            print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
+            return False
+        if job and job.journal:
+            # In a video + audio job the video step has already journaled the entries as done
+            track_in_journal(ydl, job.journal, url, info, is_playlist, skip_done=local_videos is None)
+        task.priority = job_priority(config, is_playlist)
+        if is_playlist:
+            derive_entries_from_local_videos(ydl, archive, job, audio_codec, audio_quality, local_videos)
+        elif audio_from_local_video(ydl, archive, ydl._make_archive_id(info), url,
+                                    info.get('title') or info.get('id'), audio_codec, audio_quality, local_videos):
+            return True
+        
+        if is_playlist:
+            playlist_title = info.get('title', 'Unknown Playlist')
+            num_videos = task.of = playlist_size(info) or 0
+            print(f"{Fore.BLUE}🎵 Playlist: {playlist_title}{Style.RESET_ALL}")
+            print(f"{Fore.BLUE}📋 Number of videos: {num_videos or f'unknown yet, streamed {PLAYLIST_PAGE_SIZE} at a time'}{Style.RESET_ALL}")
+            if not confirm("Proceed with downloading playlist?"):
+                return False
+        else:
+            # Single audio: select the format on the cached info and show pre-download info
+            try:
+                with TRACE.span(url, 'format'):
+                    info = ydl.process_ie_result(info, download=False)
+            except ydl_errors() as e:
+                print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
+                return False
+            
+            plan = plan_audio_output(info, audio_codec, audio_quality)
+            title = clean_filename(info['title'])
+            output_path = AUDIO_DIR / f"{title} ({quality_display}).{planned_audio_ext(info, plan)}"
+            set_outtmpl(ydl, AUDIO_DIR / f"{outtmpl_escape(title)} ({quality_display}).%(ext)s")
+            
+            if not show_pre_download_info(info, describe_audio_plan(info, plan), str(output_path), audio_quality):
+                return False
+            task.expected_total = info.get('filesize') or info.get('filesize_approx') or 0
+        
+        try:
+            download_info(ydl, info, playlist_page_tracker(url, task, job and job.journal))
+            return True
+        except ydl_errors() as e:
+            print(f"{Fore.RED}Error downloading {url}: {str(e)}{Style.RESET_ALL}")
+            return False
+
+# Video plus its audio as a separate file. The audio step extracts from the video files
+# this job just wrote (or archived ones), so the media is fetched only once, with or
+# without the download archive.
+def download_video_and_audio(url, quality, audio_quality, audio_codec, config, job=None):
+    videos = {}
+    if not download_video(url, quality, config, job, videos):
+        return False
+    if job is not None:
+        # The merge may still be running on the post-processing pool; the video is
+        # recorded only once it has finished
+        wait(job.postprocessing)
+    return download_audio(url, audio_quality, config, job, audio_codec, videos)
+
+# Download advanced
+def download_advanced(url, format_str, subtitles, thumbnails, metadata, config, job=None):
+    if not check_ffmpeg():
+        return False
+    VIDEO_DIR.mkdir(parents=True, exist_ok=True)
+    archive = DownloadArchive(f"advanced:{format_str}") if config['use_archive'] else None
+    if already_downloaded(archive, url):
+        return True
+    
+    task = PROGRESS.add(url, "Video")
+    ydl_opts = {
+        'format': format_str,
+        'outtmpl': "%(title)s.%(ext)s",  # Under paths.home
+        'merge_output_format': 'mp4',
+        'ffmpeg_location': None,
+        'writesubtitles': subtitles,
+        'writethumbnail': thumbnails,  # Embedding is done by SinglePassMuxPP
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,  # Progress is drawn by PROGRESS instead
+        'extract_flat': 'in_playlist',
+        'download_archive': archive,  # Skips archived playlist entries before they are extracted
+        'progress_hooks': [task.hook],
+        'paths': STAGING.paths(VIDEO_DIR)
+    }
+    with YDL_POOL.get(ydl_opts) as ydl, task, STAGING.attach(ydl):
+        if archive:
+            ydl.add_post_processor(ArchiveRecorderPP(archive), when='after_move')
+        mux_in_one_pass(ydl, subtitles, thumbnails and metadata, metadata)
+        if job is not None:
+            defer_postprocessing(ydl, job.postprocessing)
+            if job.lease:
+                guard_lease(ydl, job.lease)
+        if config['segmented_downloads']:
+            enable_segmented_downloads(ydl, config, task.throttle)
+        TRACE.attach(ydl, url)
+        # The page is fetched once here; everything below reuses this info dict
+        try:
+            with TRACE.span(url, 'extract'):
+                info, is_playlist = extract_once(ydl, url, config)
+        except ydl_errors() as e:
+            print(f"{Fore.RED}Error: Invalid link {url} - {str(e)}{Style.RESET_ALL}")
+            return False
+        if job and job.journal:
+            track_in_journal(ydl, job.journal, url, info, is_playlist)
+        task.priority = job_priority(config, is_playlist)
+        
+        if is_playlist:
+            playlist_title = info.get('title', 'Unknown Playlist')
+            num_videos = task.of = playlist_size(info) or 0
+            print(f"{Fore.BLUE}🎥 Playlist: {playlist_title}{Style.RESET_ALL}")
+            print(f"{Fore.BLUE}📋 Number of videos: {num_videos or f'unknown yet, streamed {PLAYLIST_PAGE_SIZE} at a time'}{Style.RESET_ALL}")
+            if not confirm("Proceed with downloading playlist?"):
+                return False
+            output_path = VIDEO_DIR / "%(title)s.%(ext)s"
+        else:
+            # Single: select the format on the cached info for accurate size
+            try:
+                with TRACE.span(url, 'format'):
+                    info = ydl.process_ie_result(info, download=False)
+            except ydl_errors() as e:
+                print(f"{Fore.RED}Error fetching info for {url}: {str(e)}{Style.RESET_ALL}")
+                return False
+            title = clean_filename(info['title'])
+            output_path = VIDEO_DIR / f"{title}.%(ext)s"
+            set_outtmpl(ydl, VIDEO_DIR / f"{outtmpl_escape(title)}.%(ext)s")
+            
+            if not show_pre_download_info(info, format_str, str(output_path), format_str):
+                return False
+            task.expected_total = info.get('filesize') or info.get('filesize_approx') or 0
+        
+        try:
+            download_info(ydl, info, playlist_page_tracker(url, task, job and job.journal))
+            print(f"{Fore.GREEN}✅ Download complete: {output_path}{Style.RESET_ALL}")
+            return True
+        except ydl_errors() as e:
+            print(f"{Fore.RED}Error downloading {url}: {str(e)}{Style.RESET_ALL}")
+            return False
+
+# One link handed to the scheduler; its outcome feeds the final summary
+@dataclass
+class Job:
+    url: str
+    status: str = "pending"  # pending, ok, failed, cancelled
+    elapsed: float = 0.0
+    error: str = ""
+    journal: object = None
+    started: float = 0.0
+    # Futures of post-processing handed to POSTPROCESS while the job downloaded
+    postprocessing: list = field(default_factory=list)
+    # Daemon mode: the job's ID, its own download profile and whether it has been settled
+    id: str = ""
+    profile: dict = None
+    finished: bool = False
+    # Worker mode: returns whether this node still holds the job's lease
+    lease: object = None
+
+# Hosts that share one backend and therefore one throttling budget
+HOST_ALIASES = {
+    "youtu.be": "youtube.com",
+    "m.youtube.com": "youtube.com",
+    "music.youtube.com": "youtube.com",
+}
+
+# Key used for the per-host concurrency cap
+def host_key(url):
+    host = (urlparse(url).hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return HOST_ALIASES.get(host, host)
+
+# Run the download part of one job on a worker thread
+def run_job(job, job_fn):
+    if CANCEL_EVENT.is_set():
+        job.status = "cancelled"
+        return job
+    print(f"{Fore.YELLOW}Processing: {job.url}{Style.RESET_ALL}")
+    ADAPTIVE.drop_items(1)
+    if job.journal:
+        job.journal.update(job.url, 'downloading', attempt=True, flush=True)
+    job.started = time.monotonic()
+    try:
+        job.status = "ok" if job_fn(job) else "failed"
+    except yt_dlp.utils.DownloadCancelled:
+        job.status = "cancelled"
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        print(f"{Fore.RED}Unexpected error for {job.url}: {str(e)}{Style.RESET_ALL}")
+    return job
+
+# Record a job's outcome once its downloads and post-processing have all finished
+def finish_job(job, on_done):
+    for future in job.postprocessing:
+        if job.status != "ok":
+            break
+        if future.cancelled():
+            job.status = "cancelled"
+        elif future.exception():
+            job.status = "failed"
+            job.error = str(future.exception())
+            print(f"{Fore.RED}Post-processing failed for {job.url}: {job.error}{Style.RESET_ALL}")
+    if job.started:
+        job.elapsed = time.monotonic() - job.started
+    if job.journal:
+        # Cancelled links go back to pending so the next run resumes them
+        state = {"ok": "done", "failed": "failed"}.get(job.status, "pending")
+        job.journal.update(job.url, state, error=job.error or None, flush=True)
+    TRACE.job_done(job)
+    if on_done:
+        on_done(job)
+
+# Download links on a bounded worker pool, honouring the per-host cap. Links may be any
+# iterable; it is only read while fewer than PENDING_PER_WORKER jobs per worker are queued,
+# so ingestion never runs far ahead of the downloads. on_done is called with each finished job.
+# A live source (daemon mode) yields Job objects, and None whenever nothing is queued;
+# it is then polled every LIVE_POLL_INTERVAL seconds and never runs out.
+PENDING_PER_WORKER = 4
+LIVE_POLL_INTERVAL = 0.1
+
+def run_jobs(links, job_fn, concurrency, per_host_limit, journal=None, on_done=None):
+    concurrency = max(1, int(concurrency))
+    per_host_limit = max(1, int(per_host_limit))
+    links = iter(links)
+    exhausted = False
+    pending = []
+    active = {}
+    # Post-processing futures of jobs whose download slot has already been released
+    finishing = {}
+    host_counts = Counter()
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="download")
+    PROGRESS.start()
+    
+    def settle(job):
+        unfinished = [future for future in job.postprocessing if not future.done()]
+        for future in unfinished:
+            finishing[future] = job
+        if not unfinished:
+            finish_job(job, on_done)
+    
+    try:
+        while True:
+            # Top up the queue from the link source
+            polling = False
+            if not exhausted and len(pending) < concurrency * PENDING_PER_WORKER:
+                new = []
+                for url in links:
+                    if url is None:
+                        polling = True
+                        break
+                    new.append(url if isinstance(url, Job) else Job(url, journal=journal))
+                    if len(pending) + len(new) >= concurrency * PENDING_PER_WORKER:
+                        break
+                else:
+                    exhausted = True
+                if journal and new:
+                    journal.add_links([job.url for job in new])
+                pending.extend(new)
+                ADAPTIVE.add_items(len(new))
+            if exhausted and not pending and not active and not finishing:
+                break
+            # Start the oldest pending jobs whose host still has a free slot
+            i = 0
+            while i < len(pending) and len(active) < concurrency:
+                host = host_key(pending[i].url)
+                if host_counts[host] >= per_host_limit:
+                    i += 1
+                    continue
+                job = pending.pop(i)
+                host_counts[host] += 1
+                active[executor.submit(run_job, job, job_fn)] = (job, host)
+            if polling and not active and not finishing:
+                time.sleep(LIVE_POLL_INTERVAL)
+                continue
+            done, _ = wait(list(active) + list(finishing), timeout=LIVE_POLL_INTERVAL if polling else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in active:
+                    job, host = active.pop(future)
+                    host_counts[host] -= 1
+                    settle(job)
+                else:
+                    job = finishing.pop(future)
+                    if job not in finishing.values():
+                        finish_job(job, on_done)
+    except KeyboardInterrupt:
+        CANCEL_EVENT.set()
+        print(f"{Fore.RED}Interrupted. Cancelling {len(active)} running and {len(pending)} queued job(s)...{Style.RESET_ALL}")
+        # Progress hooks raise DownloadCancelled on their next callback
+        wait(active)
+        jobs = [job for job, _ in active.values()] + list(set(finishing.values()))
+        for job in jobs:
+            for future in job.postprocessing:
+                future.cancel()
+            wait(job.postprocessing)
+            finish_job(job, on_done)
+        for job in pending:
+            job.status = "cancelled"
+            finish_job(job, on_done)
+    finally:
+        executor.shutdown(wait=True)
+        POSTPROCESS.shutdown()
+        PROGRESS.stop()
+        TRACE.write_metrics(force=True)
+        if journal:
+            journal.flush()
+
+# Print the per-job result summary
+def print_summary(results):
+    colors = {"ok": Fore.GREEN, "failed": Fore.RED, "cancelled": Fore.YELLOW}
+    print(f"{Fore.YELLOW}{'='*24}{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}--- Summary ---{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}{'='*24}{Style.RESET_ALL}")
-    print(f"{Fore.GREEN}Completed: {successes}/{len(links)} links downloaded successfully.{Style.RESET_ALL}")
+    for job in results:
+        color = colors.get(job.status, Fore.MAGENTA)
+        error = f" - {job.error}" if job.error else ""
+        print(f"{color}[{job.status.upper():^9}] {job.url} ({job.elapsed:.1f}s){error}{Style.RESET_ALL}")
+    successes = sum(1 for job in results if job.status == "ok")
+    print(f"{Fore.GREEN}Completed: {successes}/{len(results)} links downloaded successfully.{Style.RESET_ALL}")
+
+# Totals for a headless batch; only links that did not finish are kept individually
+class BatchSummary:
+    def __init__(self):
+        self.counts = Counter()
+        self.unfinished = []
+        self.started = time.time()
+
+    def add(self, job):
+        self.counts[job.status] += 1
+        if job.status != "ok":
+            self.unfinished.append({"url": job.url, "status": job.status, "error": job.error,
+                                    "elapsed": round(job.elapsed, 3)})
+
+    def exit_code(self):
+        if CANCEL_EVENT.is_set():
+            return EXIT_INTERRUPTED
+        return EXIT_FAILURES if self.counts["failed"] or self.counts["cancelled"] else EXIT_OK
+
+    def to_json(self):
+        return json.dumps({
+            "exit_code": self.exit_code(),
+            "total": sum(self.counts.values()),
+            "ok": self.counts["ok"],
+            "failed": self.counts["failed"],
+            "cancelled": self.counts["cancelled"],
+            "elapsed": round(time.time() - self.started, 3),
+            "unfinished": self.unfinished,
+        })
+
+# Yield URLs one per line from files, directories of files or stdin ("-"), lazily
+def iter_urls(sources):
+    for source in sources:
+        if source == '-':
+            yield from (line.strip() for line in sys.stdin if URL_RE.match(line.strip()))
+            continue
+        path = Path(source)
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+        for file in files:
+            with open(file, 'r', encoding='utf-8', errors='replace') as f:
+                yield from (line.strip() for line in f if URL_RE.match(line.strip()))
+
+# Config keys that make up a download profile; daemon job requests use the same names
+PROFILE_FIELDS = ('download_type', 'video_quality', 'audio_quality', 'audio_codec',
+                  'advanced_format', 'subtitles', 'thumbnails', 'metadata')
+
+# Download profile from config-style settings
+def profile_from_config(config):
+    download_type = config['download_type']
+    if download_type == '1':
+        return {'download_type': '1', 'quality': config['video_quality']}
+    elif download_type == '2':
+        return {'download_type': '2', 'audio_quality': config['audio_quality'], 'audio_codec': config['audio_codec']}
+    elif download_type == '4':
+        return {'download_type': '4', 'quality': config['video_quality'],
+                'audio_quality': config['audio_quality'], 'audio_codec': config['audio_codec']}
+    return {'download_type': '3', 'format': config['advanced_format'], 'subtitles': config['subtitles'],
+            'thumbnails': config['thumbnails'], 'metadata': config['metadata']}
+
+# Reject profile settings the prompts and flags could not have produced; raises ValueError
+def validate_profile_fields(fields):
+    allowed = {'download_type': ('1', '2', '3', '4'), 'video_quality': VIDEO_QUALITIES,
+               'audio_quality': AUDIO_QUALITIES, 'audio_codec': AUDIO_CODECS}
+    for key, value in fields.items():
+        if key not in PROFILE_FIELDS:
+            raise ValueError(f"unknown profile field {key!r}")
+        if key in allowed and value not in allowed[key]:
+            raise ValueError(f"{key} must be one of {', '.join(allowed[key])}")
+        if key in ('subtitles', 'thumbnails', 'metadata') and not isinstance(value, bool):
+            raise ValueError(f"{key} must be true or false")
+        if key == 'advanced_format' and not (isinstance(value, str) and value):
+            raise ValueError("advanced_format must be a yt-dlp format string")
+
+# Profile settings given as command-line flags
+def profile_fields_from_args(args):
+    fields = {'download_type': {'video': '1', 'audio': '2', 'advanced': '3', 'both': '4'}.get(args.type),
+              'video_quality': args.quality, 'audio_quality': args.audio_quality, 'audio_codec': args.audio_codec,
+              'advanced_format': args.format, 'subtitles': args.subtitles, 'thumbnails': args.thumbnails,
+              'metadata': args.metadata}
+    return {key: value for key, value in fields.items() if value is not None}
+
+# Download profile from command-line flags, falling back to the config file
+def profile_from_args(args, config):
+    return profile_from_config({**config, **profile_fields_from_args(args)})
+
+# Headless batch mode: no prompts, links streamed from --input, JSON summary at the end
+def run_batch(args, config):
+    global ASSUME_YES
+    ASSUME_YES = True
+    if args.resume:
+        journal, links = JobJournal.unfinished('batch')
+        if not journal:
+            print(f"{Fore.YELLOW}Nothing to resume.{Style.RESET_ALL}", file=sys.stderr)
+            return EXIT_OK
+        profile = journal.profile
+    else:
+        profile = profile_from_args(args, config)
+        journal = JobJournal.start(profile, 'batch')
+        links = iter_urls(args.input or ['-'])
+    
+    summary = BatchSummary()
+    run_jobs(links, make_job_fn(profile, config), config['concurrency'], config['per_host_limit'], journal, summary.add)
+    journal.close()
+    if args.summary_json == '-':
+        print(summary.to_json())
+    else:
+        with open(args.summary_json, 'w') as f:
+            f.write(summary.to_json() + "\n")
+    return summary.exit_code()
+
+# Incremental sync of playlists and channels. Per source, SYNC_FILE keeps the IDs of the
+# entries already fetched and a high-water mark (the newest of them). A check lists the
+# source in its own order, newest first for channels and feeds, and stops at the first
+# known entry, so only the pages with new entries are read. Sources that append new
+# entries at the end instead (playlists in oldest-first order) show up as a known first
+# entry with a grown entry count; those are listed in full from then on. Entries are only
+# marked as seen once their download succeeded, so failures are picked up again next time.
+SYNC_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sources (
+        url TEXT PRIMARY KEY,
+        title TEXT,
+        high_water TEXT,
+        appends INTEGER NOT NULL DEFAULT 0,
+        checked REAL
+    );
+    CREATE TABLE IF NOT EXISTS seen (
+        source TEXT NOT NULL,
+        entry TEXT NOT NULL,
+        recorded REAL NOT NULL,
+        PRIMARY KEY (source, entry)
+    );
+"""
+# Entries read from a source at a time while looking for a known one
+SYNC_PAGE_SIZE = 10
+
+class SyncStore:
+    def _db(self):
+        return open_db(SYNC_FILE, SYNC_SCHEMA)
+
+    # (high-water mark, appends) of a source; (None, False) if it was never synced
+    def source(self, url):
+        with _db_lock:
+            row = self._db().execute("SELECT high_water, appends FROM sources WHERE url = ?", (url,)).fetchone()
+        return (row[0], bool(row[1])) if row else (None, False)
+
+    # The entries of a source among ids that were already fetched
+    def known(self, url, ids):
+        with _db_lock:
+            rows = self._db().execute(
+                f"SELECT entry FROM seen WHERE source = ? AND entry IN ({','.join('?' * len(ids))})",
+                (url, *ids)).fetchall()
+        return {entry for (entry,) in rows}
+
+    def count(self, url):
+        with _db_lock:
+            return self._db().execute("SELECT COUNT(*) FROM seen WHERE source = ?", (url,)).fetchone()[0]
+
+    def checked(self, url, title, appends):
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.execute("INSERT INTO sources (url, title, appends, checked) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (url) DO UPDATE SET title = excluded.title, appends = excluded.appends, "
+                             "checked = excluded.checked", (url, title, int(appends), time.time()))
+
+    # Record entries as fetched; newest moves the high-water mark
+    def mark(self, url, ids, newest=None):
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?, ?)", [(url, entry, now) for entry in ids])
+                if newest:
+                    conn.execute("UPDATE sources SET high_water = ? WHERE url = ?", (newest, url))
+
+# Identity of an entry within its source: yt-dlp's archive id, or its URL without one
+def sync_entry_id(entry):
+    extractor = entry.get('ie_key') or entry.get('extractor_key')
+    if extractor and entry.get('id'):
+        return yt_dlp.utils.make_archive_id(extractor, entry['id'])
+    return playlist_entry_url(entry)
+
+# A channel's root page lists its tabs (Videos, Shorts, Live) as playlists under the
+# channel URL rather than its uploads. Returns the URL of the tab to sync instead, the
+# Videos tab if there is one, or None if the page is not a list of tabs.
+def channel_tab_url(info, page):
+    root = (info.get('webpage_url') or '').rstrip('/') + '/'
+    tabs = [entry.get('url') or '' for entry in page]
+    if root == '/' or not all(entry.get('_type') in ('url', 'url_transparent')
+                              and entry.get('ie_key') == info.get('extractor_key')
+                              and tab.startswith(root) for entry, tab in zip(page, tabs)):
+        return None
+    return next((tab for tab in tabs if tab.rstrip('/').endswith('/videos')), tabs[0])
+
+# List a source up to its first known entry. Returns its title and the new entries as
+# (id, url) pairs, newest first.
+def check_source(ydl, store, url, config):
+    info, is_playlist = extract_once(ydl, url, config)
+    if not is_playlist:
+        info = {'title': info.get('title'), 'entries': [{**info, 'url': url}]}
+    pages = iter_playlist_pages(info, SYNC_PAGE_SIZE)
+    first = next(pages, None)
+    tab = channel_tab_url(info, first) if is_playlist and first else None
+    if tab:
+        # The source keeps its channel URL and title; only the listing comes from the tab
+        tab_info, is_playlist = extract_once(ydl, tab, config)
+        info = {**tab_info, 'title': info.get('title') or tab_info.get('title')}
+        pages = iter_playlist_pages(info, SYNC_PAGE_SIZE) if is_playlist else iter(())
+    elif first:
+        pages = itertools.chain([first], pages)
+    _, appends = store.source(url)
+    size = playlist_size(info) if is_playlist else None
+    new = []
+    for i, page in enumerate(pages):
+        ids = [sync_entry_id(entry) for entry in page]
+        known = store.known(url, ids)
+        if i == 0 and ids[0] in known and not appends and size and size > store.count(url):
+            appends = True
+        reached = next((j for j, entry_id in enumerate(ids) if entry_id in known), None) if not appends else None
+        new.extend((entry_id, playlist_entry_url(entry)) for entry_id, entry in zip(ids[:reached], page[:reached])
+                   if entry_id not in known)
+        if reached is not None:
+            break
+    store.checked(url, info.get('title'), appends)
+    return info.get('title') or url, new
+
+# Check the sources, at most sync_concurrency at once, and yield the URLs of their new
+# entries as the checks finish (None while checks are still running). wanted maps every
+# yielded URL to its (source, entry id, newest) records; with mark_only the new entries
+# are recorded as seen instead of yielded.
+def sync_links(sources, store, config, wanted, mark_only=False):
+    import queue
+    found = queue.Queue()
+    opts = {'format': 'best', 'outtmpl': '%(id)s', 'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'}
+
+    def check(url):
+        try:
+            with YDL_POOL.get(opts) as ydl:
+                found.put((url, *check_source(ydl, store, url, config)))
+        except Exception as e:
+            # Every check must report back, or the link source would wait for it forever
+            found.put((url, None, str(e)))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, int(config['sync_concurrency'])), thread_name_prefix="sync")
+    remaining = 0
+    try:
+        for url in sources:
+            executor.submit(check, url)
+            remaining += 1
+        while remaining:
+            try:
+                url, title, new = found.get(timeout=LIVE_POLL_INTERVAL)
+            except queue.Empty:
+                yield None
+                continue
+            remaining -= 1
+            if title is None:
+                print(f"{Fore.RED}Error: could not check {url} - {new}{Style.RESET_ALL}")
+                continue
+            print(f"{Fore.BLUE}🔄 {title}: {len(new)} new{Style.RESET_ALL}")
+            if mark_only:
+                store.mark(url, [entry_id for entry_id, _ in new], new[0][0] if new else None)
+                continue
+            # Oldest first, so a channel's new uploads download in the order they came out
+            for i, (entry_id, entry_url) in reversed(list(enumerate(new))):
+                wanted.setdefault(entry_url, []).append((url, entry_id, i == 0))
+                yield entry_url
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Sync mode: check every source for new entries and download only those
+def run_sync(args, config):
+    global ASSUME_YES
+    ASSUME_YES = True
+    YDL_POOL.enabled = True
+    store = SyncStore()
+    sources = list(dict.fromkeys(iter_urls(args.input or ['-'])))
+    wanted = {}
+    if args.mark_seen:
+        for _ in sync_links(sources, store, config, wanted, mark_only=True):
+            pass
+        YDL_POOL.close()
+        return EXIT_OK
+
+    profile = profile_from_args(args, config)
+    journal = JobJournal.start(profile, 'sync')
+    summary = BatchSummary()
+
+    def on_done(job):
+        summary.add(job)
+        if job.status == "ok":
+            for source, entry_id, newest in wanted.get(job.url, ()):
+                store.mark(source, [entry_id], entry_id if newest else None)
+
+    try:
+        run_jobs(sync_links(sources, store, config, wanted), make_job_fn(profile, config),
+                 config['concurrency'], config['per_host_limit'], journal, on_done)
+    finally:
+        YDL_POOL.close()
+    # Sync batches are never resumed: entries that didn't finish aren't marked as seen, so
+    # the next sync picks them up again
+    journal.close(discard=True)
+    if args.summary_json == '-':
+        print(summary.to_json())
+    else:
+        with open(args.summary_json, 'w') as f:
+            f.write(summary.to_json() + "\n")
+    return summary.exit_code()
+
+# Daemon mode: one long-running process keeps yt-dlp loaded, YoutubeDL instances warm
+# (YDL_POOL) and the scheduler running. Jobs are submitted and queried over a small JSON
+# HTTP API on a Unix socket, or on localhost TCP where Unix sockets are not available:
+#   POST /jobs       {"urls": [...], <PROFILE_FIELDS...>} -> the queued jobs
+#   GET  /jobs       all queued, running and recently finished jobs
+#   GET  /jobs/<id>  one job, with live progress while it runs
+# With daemon_token set, every request must send "Authorization: Bearer <token>". TCP
+# addresses other hosts can reach are refused without one.
+DAEMON_DEFAULT_PORT = 8717
+DAEMON_HISTORY = 1000  # Finished jobs kept for status queries
+
+# Where the daemon listens: a Path for a Unix socket, or a (host, port) pair.
+# daemon_address is empty for the default, "host:port" for TCP, or a socket path.
+def daemon_address(config):
+    address = config['daemon_address']
+    if not address:
+        return DAEMON_SOCKET if hasattr(socket, 'AF_UNIX') else ('127.0.0.1', DAEMON_DEFAULT_PORT)
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return Path(address).expanduser()
+
+# Whether every address a host name resolves to is local to this machine
+def loopback_host(host):
+    import ipaddress
+    try:
+        return all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback
+                   for info in socket.getaddrinfo(host, None))
+    except (OSError, ValueError):
+        return False
+
+class DownloadDaemon:
+    def __init__(self, config):
+        self.config = config
+        self.queue = collections.deque()
+        self.jobs = {}  # id -> Job, in submission order
+        self.finished = collections.deque()  # IDs of finished jobs, oldest first
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    # Queue the URLs of a request; raises ValueError for invalid requests
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("the request must be a JSON object")
+        urls = request.get('urls') or ([request['url']] if request.get('url') else [])
+        if not isinstance(urls, list) or not all(isinstance(url, str) and URL_RE.match(url) for url in urls) or not urls:
+            raise ValueError("urls must be a non-empty list of http(s) URLs")
+        fields = {key: value for key, value in request.items() if key not in ('url', 'urls')}
+        validate_profile_fields(fields)
+        profile = profile_from_config({**self.config, **fields})
+        with self.lock:
+            jobs = [Job(url, id=str(next(self.ids)), profile=profile) for url in urls]
+            for job in jobs:
+                self.jobs[job.id] = job
+        self.queue.extend(jobs)
+        return [self.status(job) for job in jobs]
+
+    # Live link source for run_jobs
+    def links(self):
+        while True:
+            try:
+                yield self.queue.popleft()
+            except IndexError:
+                yield None
+
+    def run_job(self, job):
+        return make_job_fn(job.profile, self.config)(job)
+
+    def on_done(self, job):
+        with self.lock:
+            job.finished = True
+            self.finished.append(job.id)
+            while len(self.finished) > DAEMON_HISTORY:
+                self.jobs.pop(self.finished.popleft(), None)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def all(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def status(self, job):
+        done = job.finished
+        state = job.status if done else "running" if job.started else "queued"
+        status = {'id': job.id, 'url': job.url, 'state': state, 'profile': job.profile,
+                  'elapsed': round(job.elapsed if done else time.monotonic() - job.started if job.started else 0.0, 3)}
+        if job.error:
+            status['error'] = job.error
+        if state == "running":
+            with PROGRESS.lock:
+                task = next((task for task in PROGRESS.tasks if task.url == job.url), None)
+            if task:
+                status['progress'] = {'title': task.title, 'item': task.count, 'items': task.of,
+                                      'downloaded_bytes': task.downloaded, 'total_bytes': task.total or task.expected_total,
+                                      'speed': round(task.speed), 'eta': task.eta}
+        return status
+
+@lazy_base('http.server', 'BaseHTTPRequestHandler')
+class DaemonRequestHandler:
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        import hmac
+        token = self.server.token
+        if not token or hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                                            f"Bearer {token}".encode('utf-8')):
+            return True
+        self._reply(401, {'error': 'missing or wrong daemon token'})
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        daemon = self.server.downloader
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/jobs':
+            self._reply(200, {'jobs': [daemon.status(job) for job in daemon.all()]})
+        elif path.startswith('/jobs/') and daemon.get(path[len('/jobs/'):]):
+            self._reply(200, daemon.status(daemon.get(path[len('/jobs/'):])))
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            self._reply(202, {'jobs': self.server.downloader.submit(request)})
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+
+@lazy_base('socketserver', 'ThreadingUnixStreamServer')
+class UnixHTTPServer:
+    daemon_threads = True
+
+# Raised in the main thread on SIGTERM so the scheduler cancels and cleans up as on Ctrl-C
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_daemon(config):
+    global ASSUME_YES
+    ASSUME_YES = True
+    YDL_POOL.enabled = True
+    address = daemon_address(config)
+    if isinstance(address, Path):
+        if address.exists():
+            try:
+                daemon_request(config, 'GET', '/jobs')
+                print(f"{Fore.RED}Error: a daemon is already listening on {address}.{Style.RESET_ALL}", file=sys.stderr)
+                return EXIT_FAILURES
+            except OSError:
+                address.unlink()  # Left behind by a daemon that didn't shut down cleanly
+        server = UnixHTTPServer(str(address), DaemonRequestHandler.build())
+    else:
+        if not config['daemon_token'] and not loopback_host(address[0]):
+            print(f"{Fore.RED}Error: set daemon_token to listen on {address[0]}:{address[1]}, "
+                  f"which other hosts can reach.{Style.RESET_ALL}", file=sys.stderr)
+            return EXIT_USAGE
+        import http.server
+        server = http.server.ThreadingHTTPServer(address, DaemonRequestHandler.build())
+    daemon = DownloadDaemon(config)
+    server.downloader = daemon
+    server.token = config['daemon_token']
+    # Pay for the yt-dlp import and the ffmpeg probe now rather than in the first job
+    warm_up()
+    threading.Thread(target=server.serve_forever, name="daemon-api", daemon=True).start()
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    print(f"{Fore.GREEN}Daemon listening on {address if isinstance(address, Path) else '%s:%d' % address}. Press Ctrl-C to stop.{Style.RESET_ALL}")
+    try:
+        run_jobs(daemon.links(), daemon.run_job, config['concurrency'], config['per_host_limit'], on_done=daemon.on_done)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if isinstance(address, Path):
+            address.unlink(missing_ok=True)
+        YDL_POOL.close()
+        HTTP_SESSION.close()
+    return EXIT_OK
+
+# Thin client side
+@lazy_base('http.client', 'HTTPConnection')
+class UnixHTTPConnection:
+    def __init__(self, socket_path, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(str(self.socket_path))
+
+# One API call; returns (HTTP status, JSON body). Raises OSError when no daemon is reachable.
+def daemon_request(config, method, path, body=None):
+    address = daemon_address(config)
+    if isinstance(address, Path):
+        conn = UnixHTTPConnection(address)
+    else:
+        import http.client
+        conn = http.client.HTTPConnection(*address, timeout=30)
+    headers = {'Content-Type': 'application/json'}
+    if config['daemon_token']:
+        headers['Authorization'] = f"Bearer {config['daemon_token']}"
+    try:
+        conn.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        conn.close()
+
+# Final job states reported by the daemon
+DAEMON_FINAL_STATES = ("ok", "failed", "cancelled")
+DAEMON_POLL_INTERVAL = 0.5
+
+# Submit links to a running daemon (--submit). With --wait, poll until they have all finished
+# and print the same JSON summary as batch mode.
+def run_submit(args, config):
+    urls = list(iter_urls(args.input or ['-']))
+    if not urls:
+        print(f"{Fore.RED}No valid URLs provided.{Style.RESET_ALL}", file=sys.stderr)
+        return EXIT_USAGE
+    summary = BatchSummary()
+    try:
+        status, reply = daemon_request(config, 'POST', '/jobs', {'urls': urls, **profile_fields_from_args(args)})
+        if status != 202:
+            print(f"{Fore.RED}Error: {reply.get('error')}{Style.RESET_ALL}", file=sys.stderr)
+            return EXIT_USAGE
+        if not args.wait:
+            print(json.dumps(reply))
+            return EXIT_OK
+        ids = {job['id'] for job in reply['jobs']}
+        while True:
+            time.sleep(DAEMON_POLL_INTERVAL)
+            _, reply = daemon_request(config, 'GET', '/jobs')
+            jobs = [job for job in reply['jobs'] if job['id'] in ids]
+            if all(job['state'] in DAEMON_FINAL_STATES for job in jobs):
+                break
+    except OSError as e:
+        print(f"{Fore.RED}Error: no daemon reachable at {daemon_address(config)} ({e}). Start one with --daemon.{Style.RESET_ALL}", file=sys.stderr)
+        return EXIT_FAILURES
+    except KeyboardInterrupt:
+        # The jobs keep running in the daemon
+        return EXIT_INTERRUPTED
+    for job in jobs:
+        summary.add(Job(job['url'], status=job['state'], elapsed=job['elapsed'], error=job.get('error', "")))
+    print(summary.to_json())
+    return summary.exit_code()
+
+# Print the daemon's jobs, or one of them (--status [ID])
+def run_status(args, config):
+    try:
+        status, reply = daemon_request(config, 'GET', f"/jobs/{args.status}" if args.status else '/jobs')
+    except OSError as e:
+        print(f"{Fore.RED}Error: no daemon reachable at {daemon_address(config)} ({e}).{Style.RESET_ALL}", file=sys.stderr)
+        return EXIT_FAILURES
+    print(json.dumps(reply, indent=2))
+    return EXIT_OK if status == 200 else EXIT_FAILURES
+
+# Multi-node worker mode. Worker processes on this host or on others share the jobs of one
+# work store: a SQLite file on storage they can all reach (work_store, --work-store).
+# Links are added with --enqueue. Each --worker claims queued jobs as its own download
+# slots free up, by taking a lease on them. While a job runs, its lease is renewed every
+# third of work_lease_seconds (the heartbeat). When a worker dies or loses the store, its
+# leases expire and the next claim puts those jobs back in the queue. A job can only be
+# claimed in a write transaction and settled by the holder of its lease, and a worker
+# stops any download whose lease was taken over. So no entry is downloaded by two
+# workers. The worker that claims a playlist link lists it and queues the entries as jobs
+# of their own, so one playlist spreads over all workers. Links enqueued with --affinity
+# pin their entries to that worker instead, for as long as it stays alive. The store uses
+# SQLite's rollback journal, because WAL only works within one host. The shared
+# filesystem must support file locks (e.g. NFSv4 or SMB).
+WORK_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS work (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        profile TEXT NOT NULL,
+        parent INTEGER,
+        affinity INTEGER NOT NULL DEFAULT 0,
+        pinned TEXT,
+        state TEXT NOT NULL,
+        node TEXT,
+        token TEXT,
+        lease_until REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        updated REAL NOT NULL,
+        UNIQUE (url, profile)
+    );
+    CREATE INDEX IF NOT EXISTS work_state ON work (state, id);
+    CREATE TABLE IF NOT EXISTS nodes (
+        name TEXT PRIMARY KEY,
+        seen REAL NOT NULL,
+        running INTEGER NOT NULL DEFAULT 0
+    );
+"""
+WORK_MAX_ATTEMPTS = 3
+# Seconds between claims while the store has nothing this worker may take
+WORK_POLL_INTERVAL = 1.0
+
+def work_store_path(config):
+    return Path(config['work_store']).expanduser() if config['work_store'] else WORK_FILE
+
+# Jobs are (url, profile) pairs. States: queued, leased, done, failed. Links have no
+# parent; playlist entries point at the link they were listed from. affinity marks links
+# whose entries stay on one node, pinned names that node on the entries.
+class WorkStore:
+    def __init__(self, path, node=None, lease=60):
+        self.path = path
+        self.node = node
+        self.lease = lease
+
+    def _db(self):
+        return open_db(self.path, WORK_SCHEMA, journal_mode="DELETE")
+
+    # Queue links under a download profile and return how many were queued. Links that
+    # failed for good are queued again; any other link already in the store is left alone.
+    def enqueue(self, urls, profile, affinity=False):
+        profile = json.dumps(profile, sort_keys=True)
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT INTO work (url, profile, affinity, state, updated) VALUES (?, ?, ?, 'queued', ?) "
+                    "ON CONFLICT (url, profile) DO UPDATE SET state = 'queued', attempts = 0, error = NULL, "
+                    "affinity = excluded.affinity, updated = excluded.updated WHERE state = 'failed'",
+                    ((url, profile, int(affinity), now) for url in urls))
+                return conn.total_changes - before
+
+    # Queue the entries of a listed playlist; entries already in the store keep their state
+    def add_entries(self, parent, urls, profile, pinned=None):
+        profile = json.dumps(profile, sort_keys=True)
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO work (url, profile, parent, pinned, state, updated) "
+                                 "VALUES (?, ?, ?, ?, 'queued', ?)",
+                                 [(url, profile, parent, pinned, now) for url in urls])
+
+    # Lease up to n queued jobs to this node, oldest first, after putting expired leases
+    # back in the queue. Entries pinned to another live node are skipped. Returns the
+    # lease token (fresh per claim, so a reused node name can't settle old leases) and the claimed (id, url, profile, parent, affinity) rows.
+    def claim(self, n):
+        now = time.time()
+        token = os.urandom(8).hex()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                # Taken before reading, so two nodes can't pick the same rows
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("UPDATE work SET state = 'failed', error = 'lease expired', token = NULL, updated = ? "
+                             "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, WORK_MAX_ATTEMPTS))
+                conn.execute("UPDATE work SET state = 'queued', token = NULL, updated = ? "
+                             "WHERE state = 'leased' AND lease_until < ?", (now, now))
+                ids = [job_id for job_id, in conn.execute(
+                    "SELECT id FROM work WHERE state = 'queued' AND (pinned IS NULL OR pinned = ? "
+                    "OR pinned NOT IN (SELECT name FROM nodes WHERE seen >= ?)) ORDER BY id LIMIT ?",
+                    (self.node, now - self.lease, n))]
+                conn.executemany("UPDATE work SET state = 'leased', node = ?, token = ?, lease_until = ?, "
+                                 "attempts = attempts + 1, updated = ? WHERE id = ?",
+                                 [(self.node, token, now + self.lease, now, job_id) for job_id in ids])
+                rows = conn.execute("SELECT id, url, profile, parent, affinity FROM work WHERE token = ? ORDER BY id",
+                                    (token,)).fetchall()
+        return token, rows
+
+    # Mark this node alive and renew the leases it holds ({job id: token}). Returns the
+    # IDs of the jobs whose lease was taken over by another node meanwhile.
+    def heartbeat(self, held):
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.execute("INSERT INTO nodes (name, seen, running) VALUES (?, ?, ?) ON CONFLICT (name) "
+                             "DO UPDATE SET seen = excluded.seen, running = excluded.running", (self.node, now, len(held)))
+                return [job_id for job_id, token in held.items() if not conn.execute(
+                    "UPDATE work SET lease_until = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                    (now + self.lease, job_id, token)).rowcount]
+
+    # Settle a job by its outcome, unless its lease was lost. Failed jobs go back to the
+    # queue for any node until WORK_MAX_ATTEMPTS; cancelled ones are released without
+    # counting as an attempt. Returns the job's new state, or None if the lease was lost.
+    def finish(self, job_id, token, status, error=None):
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                if not conn.execute(
+                    "UPDATE work SET state = CASE WHEN ? = 'ok' THEN 'done' WHEN ? = 'failed' AND attempts >= ? "
+                    "THEN 'failed' ELSE 'queued' END, attempts = attempts - (? = 'cancelled'), error = ?, "
+                    "token = NULL, lease_until = NULL, updated = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                    (status, status, WORK_MAX_ATTEMPTS, status, error, time.time(), job_id, token)).rowcount:
+                    return None
+                return conn.execute("SELECT state FROM work WHERE id = ?", (job_id,)).fetchone()[0]
+
+    # Whether this node still holds a job's lease under the token it was claimed with
+    def holds(self, job_id, token):
+        with _db_lock:
+            return self._db().execute(
+                "SELECT 1 FROM work WHERE id = ? AND token = ? AND state = 'leased' AND lease_until >= ?",
+                (job_id, token, time.time())).fetchone() is not None
+
+    # Remove this node, so entries pinned to it can go to the others right away
+    def leave(self):
+        with _db_lock:
+            conn = self._db()
+            with conn:
+                conn.execute("DELETE FROM nodes WHERE name = ?", (self.node,))
+
+    # Jobs still to run: queued, or leased to some node
+    def unsettled(self):
+        with _db_lock:
+            return self._db().execute("SELECT COUNT(*) FROM work WHERE state IN ('queued', 'leased')").fetchone()[0]
+
+    def status(self):
+        now = time.time()
+        with _db_lock:
+            conn = self._db()
+            states = dict(conn.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+            nodes = conn.execute("SELECT name, running, seen FROM nodes WHERE seen >= ? ORDER BY name",
+                                 (now - self.lease,)).fetchall()
+            failed = conn.execute("SELECT url, error FROM work WHERE state = 'failed' ORDER BY id").fetchall()
+        return {'jobs': {state: states.get(state, 0) for state in ('queued', 'leased', 'done', 'failed')},
+                'nodes': [{'name': name, 'running': running, 'seen': round(now - seen, 1)} for name, running, seen in nodes],
+                'failed': [{'url': url, 'error': error} for url, error in failed]}
+
+# One worker process: claims jobs from the store as download slots free up, runs them on
+# the scheduler and keeps their leases alive from a heartbeat thread
+class WorkNode:
+    def __init__(self, store, config, drain=False):
+        self.store = store
+        self.config = config
+        self.drain = drain
+        self.concurrency = max(1, int(config['concurrency']))
+        self.held = {}  # job id -> (lease token, claimed row), for the jobs on this node
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.beat()
+        self.thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.store.leave()
+
+    def _run(self):
+        while not self.stop_event.wait(self.store.lease / 3):
+            self.beat()
+
+    def beat(self):
+        with self.lock:
+            held = {job_id: token for job_id, (token, _) in self.held.items()}
+        try:
+            lost = self.store.heartbeat(held)
+        except sqlite3.Error as e:
+            print(f"{Fore.RED}Warning: could not renew leases in {self.store.path}: {str(e)}{Style.RESET_ALL}")
+            return
+        for job_id in lost:
+            with self.lock:
+                claimed = self.held.get(job_id)
+            if claimed:
+                url = claimed[1][1]
+                print(f"{Fore.YELLOW}Lease on {url} was taken over by another node; stopping it here.{Style.RESET_ALL}")
+                PROGRESS.cancel(url)
+
+    # Live link source for run_jobs: claims only as many jobs as there are free slots, so
+    # queued work stays available to the other nodes. Ends once the store is drained (--drain).
+    def links(self):
+        next_claim = 0.0
+        while True:
+            with self.lock:
+                free = self.concurrency - len(self.held)
+            rows = []
+            if free > 0 and time.monotonic() >= next_claim:
+                try:
+                    token, rows = self.store.claim(free)
+                    # Jobs leased here count as unsettled too, so this waits for them
+                    if self.drain and not rows and not self.store.unsettled():
+                        return
+                except sqlite3.Error as e:
+                    print(f"{Fore.RED}Warning: could not claim jobs from {self.store.path}: {str(e)}{Style.RESET_ALL}")
+                if not rows:
+                    next_claim = time.monotonic() + WORK_POLL_INTERVAL
+            for row in rows:
+                with self.lock:
+                    self.held[row[0]] = (token, row)
+                yield Job(row[1], id=str(row[0]), profile=json.loads(row[2]),
+                          lease=functools.partial(self.store.holds, row[0], token))
+            yield None
+
+    def run_job(self, job):
+        _, (_, _, _, parent, affinity) = self.held[int(job.id)]
+        if parent is None:
+            listed = self.list_playlist(job, affinity)
+            if listed is not None:
+                return listed
+        return make_job_fn(job.profile, self.config)(job)
+
+    # Queue the entries of a playlist link as jobs of their own. Returns None if the link
+    # is a single video, to be downloaded right here.
+    def list_playlist(self, job, affinity):
+        opts = {'format': 'best', 'outtmpl': '%(id)s', 'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'}
+        with YDL_POOL.get(opts) as ydl:
+            try:
+                info, is_playlist = extract_once(ydl, job.url, self.config)
+            except ydl_errors() as e:
+                print(f"{Fore.RED}Error: Invalid link {job.url} - {str(e)}{Style.RESET_ALL}")
+                return False
+            if not is_playlist:
+                return None
+            count = 0
+            for page in iter_playlist_pages(info):
+                self.store.add_entries(int(job.id), [playlist_entry_url(entry) for entry in page], job.profile,
+                                       self.store.node if affinity else None)
+                count += len(page)
+        print(f"{Fore.BLUE}📋 {info.get('title') or job.url}: {count} entries queued{Style.RESET_ALL}")
+        return True
+
+    def on_done(self, job, summary):
+        with self.lock:
+            token, _ = self.held.pop(int(job.id))
+        try:
+            state = self.store.finish(int(job.id), token, job.status, job.error or None)
+        except sqlite3.Error as e:
+            # The lease runs out and the job is retried
+            print(f"{Fore.RED}Warning: could not record {job.url} in {self.store.path}: {str(e)}{Style.RESET_ALL}")
+            return
+        # Failures still to be retried and jobs taken over by other nodes aren't outcomes yet
+        if state and not (job.status == "failed" and state == "queued"):
+            summary.add(job)
+
+def default_node_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# Worker mode (--worker): download jobs from the work store until interrupted, or until
+# the store has none left (--drain), then print the summary of the jobs run here
+def run_worker(args, config):
+    global ASSUME_YES
+    ASSUME_YES = True
+    YDL_POOL.enabled = True
+    store = WorkStore(work_store_path(config), args.node or default_node_name(), max(3, int(config['work_lease_seconds'])))
+    node = WorkNode(store, config, args.drain)
+    summary = BatchSummary()
+    warm_up()
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    print(f"{Fore.GREEN}Worker {store.node} taking jobs from {store.path}.{Style.RESET_ALL}")
+    node.start()
+    try:
+        run_jobs(node.links(), node.run_job, config['concurrency'], config['per_host_limit'],
+                 on_done=lambda job: node.on_done(job, summary))
+    finally:
+        node.stop()
+        YDL_POOL.close()
+        HTTP_SESSION.close()
+    if args.summary_json == '-':
+        print(summary.to_json())
+    else:
+        with open(args.summary_json, 'w') as f:
+            f.write(summary.to_json() + "\n")
+    return summary.exit_code()
+
+# Add the links (as read by --input) to the work store for the workers (--enqueue)
+def run_enqueue(args, config):
+    store = WorkStore(work_store_path(config))
+    queued = store.enqueue(iter_urls(args.input or ['-']), profile_from_args(args, config), args.affinity)
+    print(json.dumps({'queued': queued}))
+    return EXIT_OK
+
+# Print the job counts, live workers and failed jobs of the work store (--work-status)
+def run_work_status(args, config):
+    store = WorkStore(work_store_path(config), lease=max(3, int(config['work_lease_seconds'])))
+    print(json.dumps(store.status(), indent=2))
+    return EXIT_OK
+
+# Command-line flags
+def parse_args():
+    parser = argparse.ArgumentParser(description="Interactive YouTube downloader built on yt-dlp.")
+    parser.add_argument('--rebuild-archive', action='store_true',
+                        help="rebuild the download archive index from the output directories and exit")
+    parser.add_argument('--no-cache', action='store_true', help="bypass the metadata cache")
+    parser.add_argument('--concurrency', type=int, help="number of links downloaded at once")
+    parser.add_argument('--per-host-limit', type=int, help="number of links downloaded at once from one site")
+    parser.add_argument('--limit-rate', type=float, metavar='MBPS',
+                        help="total bandwidth for all downloads in Mbit/s (0 = unlimited); bandwidth_schedule still applies")
+    parser.add_argument('--priority', choices=['auto', *PRIORITIES],
+                        help="bandwidth priority class (auto: bulk for playlists, normal for single videos)")
+    parser.add_argument('--deadline', metavar='TIME',
+                        help="with --quality adaptive: finish the batch by TIME (HH:MM, YYYY-MM-DD HH:MM, or e.g. 8h / 90m)")
+    parser.add_argument('--byte-budget', type=float, metavar='GB',
+                        help="with --quality adaptive: download at most GB gigabytes in total")
+    parser.add_argument('--staging-dir', metavar='PATH',
+                        help="download and post-process in PATH (e.g. tmpfs or NVMe), then move finished files into the library")
+    parser.add_argument('--trace', metavar='PATH', help="append per-phase spans of every job to PATH as JSON lines")
+    parser.add_argument('--metrics', metavar='PATH', help="keep Prometheus textfile metrics (counters, phase latencies) in PATH")
+    batch = parser.add_argument_group("headless batch mode")
+    batch.add_argument('--batch', action='store_true', help="run without prompts; settings come from flags and the config file")
+    batch.add_argument('--input', '-i', action='append', metavar='PATH',
+                       help="file or directory of files with one URL per line, or - for stdin (repeatable, default: stdin)")
+    batch.add_argument('--resume', action='store_true', help="resume the last unfinished batch instead of reading input")
+    batch.add_argument('--type', choices=['video', 'audio', 'advanced', 'both'],
+                       help="download type; both = video plus its audio extracted locally")
+    batch.add_argument('--quality', choices=VIDEO_QUALITIES, help="video quality")
+    batch.add_argument('--audio-quality', choices=AUDIO_QUALITIES, help="audio bitrate (kbps)")
+    batch.add_argument('--audio-codec', choices=AUDIO_CODECS, help="audio codec; original copies the source stream when possible")
+    batch.add_argument('--format', help="yt-dlp format for advanced downloads")
+    for name in ('subtitles', 'thumbnails', 'metadata'):
+        batch.add_argument(f'--{name}', dest=name, action='store_true', default=None,
+                           help=f"advanced downloads: {name} (--no-{name} to turn off)")
+        batch.add_argument(f'--no-{name}', dest=name, action='store_false', help=argparse.SUPPRESS)
+    batch.add_argument('--sync', action='store_true',
+                       help="treat the input URLs as playlists/channels and download only entries not fetched before")
+    batch.add_argument('--sync-concurrency', type=int, metavar='N', help="sources checked at once in --sync mode")
+    batch.add_argument('--mark-seen', action='store_true',
+                       help="with --sync: record the current entries as fetched without downloading them")
+    batch.add_argument('--summary-json', default='-', metavar='PATH', help="where to write the JSON summary (default: stdout)")
+    daemon = parser.add_argument_group("daemon mode")
+    daemon.add_argument('--daemon', action='store_true', help="run as a daemon that takes jobs over a local API")
+    daemon.add_argument('--submit', action='store_true',
+                        help="send the links (as read by --input) to the daemon instead of downloading them here")
+    daemon.add_argument('--wait', action='store_true', help="with --submit: wait for the jobs and print the JSON summary")
+    daemon.add_argument('--status', nargs='?', const='', metavar='ID', help="show the daemon's jobs, or one job")
+    daemon.add_argument('--daemon-address', metavar='ADDR',
+                        help="Unix socket path or host:port of the daemon (default: ~/.yt_dlp_daemon.sock)")
+    work = parser.add_argument_group("worker mode")
+    work.add_argument('--worker', action='store_true', help="download jobs from the shared work store until interrupted")
+    work.add_argument('--drain', action='store_true', help="with --worker: exit once the work store has no jobs left to run")
+    work.add_argument('--enqueue', action='store_true',
+                      help="add the links (as read by --input) to the work store for the workers")
+    work.add_argument('--affinity', action='store_true',
+                      help="with --enqueue: download all entries of a playlist on the worker that lists it")
+    work.add_argument('--work-status', action='store_true', help="show the job counts and live workers of the work store")
+    work.add_argument('--work-store', metavar='PATH',
+                      help="SQLite file shared by all workers (default: ~/.yt_dlp_work.sqlite3)")
+    work.add_argument('--node', metavar='NAME', help="this worker's name in the work store (default: host:pid)")
+    return parser.parse_args()
+
+# Ask for the download profile: the download type plus its options
+def choose_profile(config):
+    download_type = choose_download_type(config)
+    if download_type == '1':
+        return {'download_type': '1', 'quality': choose_video_quality(config)}
+    elif download_type == '2':
+        return {'download_type': '2', 'audio_codec': choose_audio_codec(config), 'audio_quality': choose_audio_quality(config)}
+    elif download_type == '4':
+        return {'download_type': '4', 'quality': choose_video_quality(config),
+                'audio_codec': choose_audio_codec(config), 'audio_quality': choose_audio_quality(config)}
+    format_str, subtitles, thumbnails, metadata = choose_advanced_options(config)
+    return {'download_type': '3', 'format': format_str, 'subtitles': subtitles,
+            'thumbnails': thumbnails, 'metadata': metadata}
+
+# Build the function the scheduler runs for each job of a profile
+def make_job_fn(profile, config):
+    if profile['download_type'] == '1':
+        return lambda job: download_video(job.url, profile['quality'], config, job)
+    elif profile['download_type'] == '2':
+        # Journals written before audio codecs existed always meant MP3
+        return lambda job: download_audio(job.url, profile['audio_quality'], config, job, profile.get('audio_codec', 'mp3'))
+    elif profile['download_type'] == '4':
+        return lambda job: download_video_and_audio(job.url, profile['quality'], profile['audio_quality'],
+                                                    profile['audio_codec'], config, job)
+    return lambda job: download_advanced(job.url, profile['format'], profile['subtitles'],
+                                         profile['thumbnails'], profile['metadata'], config, job)
+
+# Load what the first download needs ahead of time
+def warm_up():
+    importlib.import_module('yt_dlp')
+    probe_ffmpeg()
+
+# Main function
+def main():
+    # Initialize colorama for colored terminal output
+    colorama.init(autoreset=True)
+    args = parse_args()
+    if args.rebuild_archive:
+        rebuild_archive()
+        return
+    config = load_config()
+    if args.no_cache:
+        config['use_cache'] = False
+    if args.concurrency:
+        config['concurrency'] = args.concurrency
+    if args.per_host_limit:
+        config['per_host_limit'] = args.per_host_limit
+    if args.priority:
+        config['priority'] = args.priority
+    if args.deadline:
+        config['adaptive_deadline'] = args.deadline
+    if args.byte_budget is not None:
+        config['adaptive_budget_gb'] = args.byte_budget
+    try:
+        ADAPTIVE.configure(config)
+    except ValueError as e:
+        print(f"{Fore.RED}Error: {str(e)}{Style.RESET_ALL}")
+        sys.exit(EXIT_USAGE)
+    if args.staging_dir is not None:
+        config['staging_dir'] = args.staging_dir
+    STAGING.configure(config)
+    POSTPROCESS.configure(config['postprocess_workers'], config['postprocess_queue'])
+    BANDWIDTH.configure(config, cli_limit=args.limit_rate)
+    HTTP_SESSION.configure(config)
+    if args.trace:
+        config['trace_file'] = args.trace
+    if args.metrics:
+        config['metrics_file'] = args.metrics
+    TRACE.configure(config['trace_file'], config['metrics_file'])
+    if args.daemon_address:
+        config['daemon_address'] = args.daemon_address
+    if args.submit:
+        sys.exit(run_submit(args, config))
+    if args.status is not None:
+        sys.exit(run_status(args, config))
+    if args.daemon:
+        sys.exit(run_daemon(config))
+    if args.work_store:
+        config['work_store'] = args.work_store
+    if args.enqueue:
+        sys.exit(run_enqueue(args, config))
+    if args.work_status:
+        sys.exit(run_work_status(args, config))
+    if args.worker:
+        sys.exit(run_worker(args, config))
+    if args.sync_concurrency:
+        config['sync_concurrency'] = args.sync_concurrency
+    if args.sync:
+        sys.exit(run_sync(args, config))
+    if args.batch:
+        sys.exit(run_batch(args, config))
+    
+    # Import yt-dlp and probe ffmpeg in the background while the prompts wait for input
+    threading.Thread(target=warm_up, daemon=True).start()
+    journal, links = JobJournal.unfinished('interactive')
+    if links and confirm(f"Resume {len(links)} unfinished link(s) from the previous run? Answering n discards them."):
+        profile = journal.profile
+    else:
+        if journal:
+            journal.close(discard=True)
+        links = get_links()
+        if not links:
+            return
+        profile = choose_profile(config)
+        journal = JobJournal.start(profile, 'interactive')
+    
+    results = []
+    run_jobs(links, make_job_fn(profile, config), config['concurrency'], config['per_host_limit'], journal, results.append)
+    journal.close()
+    results.sort(key=lambda job: links.index(job.url))
+    print_summary(results)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
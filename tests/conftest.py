@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# main.py places its config, archive and download folders under the home directory when
+# it is imported, so the tests get a home of their own
+os.environ['HOME'] = tempfile.mkdtemp(prefix='yt-dlp-tests-')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
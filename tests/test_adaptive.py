@@ -0,0 +1,80 @@
+import pytest
+
+import main
+
+MB = 1000 * 1000
+
+
+def planner(deadline='', budget_gb=0):
+    planner = main.QualityPlanner()
+    planner.configure({'adaptive_deadline': deadline, 'adaptive_budget_gb': budget_gb})
+    return planner
+
+
+def candidates(*sizes):
+    # (cap, format, estimate, parts), best first
+    return [(cap, main.adaptive_format(cap), size, 2) for cap, size in zip(main.ADAPTIVE_CAPS, sizes)]
+
+
+def test_budget_is_shared_with_the_queued_items():
+    plan = planner(budget_gb=1)
+    plan.add_items(1)
+    (cap, _, estimate, _), reason = plan.choose('a', candidates(2000 * MB, 1200 * MB, 800 * MB, 400 * MB), False)
+    assert (cap, estimate) == (1080, 400 * MB)
+    assert "500 MB per item fits" in reason
+
+
+def test_planned_items_count_against_the_budget():
+    plan = planner(budget_gb=1)
+    plan.choose('a', candidates(600 * MB, 300 * MB), False)
+    (cap, _, _, _), _ = plan.choose('b', candidates(600 * MB, 300 * MB), False)
+    assert cap == 2160
+
+
+def test_smallest_when_nothing_fits():
+    plan = planner(budget_gb=0.1)
+    (cap, _, _, _), _ = plan.choose('a', candidates(900 * MB, 500 * MB, 200 * MB), False)
+    assert cap == 1440
+
+
+def test_unknown_sizes_take_the_best():
+    (cap, _, _, _), _ = planner(budget_gb=1).choose('a', candidates(None, None), False)
+    assert cap is None
+
+
+def test_deadline_without_throughput_starts_capped():
+    (cap, _, _, _), reason = planner(deadline='8h').choose('a', candidates(*[10 * MB] * 8), False)
+    assert cap == main.QualityPlanner.START_CAP
+    assert "no throughput measured yet" in reason
+
+
+def test_listed_entries_leave_the_queue_when_planned():
+    plan = planner(budget_gb=1)
+    plan.add_items(3)
+    plan.choose('a', candidates(100 * MB), True)
+    assert plan.items == 2
+
+
+def test_parse_deadline_rejects_garbage():
+    with pytest.raises(ValueError):
+        main.parse_deadline('tomorrow-ish')
+
+
+def test_item_is_planned_once():
+    ydl = main.yt_dlp.YoutubeDL({'quiet': True, 'format': 'best'})
+    formats = [{'format_id': 'audio', 'filesize': MB, 'ext': 'm4a', 'url': 'http://x/audio', 'protocol': 'https',
+                'vcodec': 'none', 'acodec': 'mp4a'}]
+    formats += [{'format_id': f'{height}', 'height': height, 'filesize': size, 'ext': 'mp4', 'url': f'http://x/{height}',
+                 'protocol': 'https', 'vcodec': 'avc1', 'acodec': 'none'}
+                for height, size in ((360, 50 * MB), (720, 200 * MB), (1080, 800 * MB))]
+    info = {'id': 'x', 'extractor_key': 'Generic', 'title': 't', 'formats': formats}
+    plan = planner(budget_gb=0.5)
+    pp = main.AdaptiveFormatPP(plan)
+    pp.set_downloader(ydl)
+    pp.run(info)
+    assert ydl.params['format'] == main.adaptive_format(720)
+    assert pp.keys == {('Generic', 'x')}
+    # Planned again with the budget spent, the item keeps its format
+    plan.spent = 10 ** 9
+    pp.run(info)
+    assert ydl.params['format'] == main.adaptive_format(720)
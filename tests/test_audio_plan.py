@@ -0,0 +1,60 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('acodec, codec', [
+    ('mp4a.40.2', 'm4a'),
+    ('mp4a.40.2', 'original'),
+    ('opus', 'opus'),
+    ('opus', 'original'),
+])
+def test_matching_codec_is_copied(acodec, codec):
+    info = {'acodec': acodec, 'abr': 128}
+    target, quality, source, transcode = main.plan_audio_output(info, codec, 'best')
+    assert (target, quality, transcode) == ('best', None, False)
+    assert source == ('aac' if acodec.startswith('mp4a') else acodec)
+
+
+def test_lower_bitrate_forces_a_transcode_in_the_same_codec():
+    assert main.plan_audio_output({'acodec': 'opus', 'abr': 160}, 'opus', '64') == ('opus', 64.0, 'opus', True)
+    assert main.plan_audio_output({'acodec': 'mp4a.40.2', 'abr': 128}, 'm4a', '96') == ('m4a', 96.0, 'aac', True)
+
+
+def test_higher_or_equal_bitrate_is_copied():
+    # Re-encoding up cannot add quality; within 5% counts as equal
+    assert main.plan_audio_output({'acodec': 'opus', 'abr': 130}, 'opus', '128')[0] == 'best'
+    assert main.plan_audio_output({'acodec': 'opus', 'abr': 96}, 'opus', '192')[0] == 'best'
+
+
+def test_lossless_source_is_never_reencoded_for_a_bitrate():
+    assert main.plan_audio_output({'acodec': 'flac'}, 'original', '128') == ('best', None, 'flac', False)
+
+
+def test_other_codec_is_transcoded():
+    assert main.plan_audio_output({'acodec': 'opus', 'abr': 160}, 'mp3', '192') == ('mp3', 192.0, 'opus', False)
+
+
+def test_best_mp3_is_320kbps_cbr():
+    plan = main.plan_audio_output({'acodec': 'opus', 'abr': 160}, 'mp3', 'best')
+    assert plan == ('mp3', main.BEST_MP3_QUALITY, 'opus', False)
+    assert main.describe_audio_plan({'acodec': 'opus', 'abr': 160}, plan) == "opus 160kbps → mp3 320kbps"
+    assert main.audio_quality_label('mp3', 'best') == "320kbps"
+
+
+def test_best_in_other_codecs_uses_the_highest_vbr_setting():
+    assert main.plan_audio_output({'acodec': 'mp4a.40.2'}, 'opus', 'best') == ('opus', main.BEST_VBR_QUALITY, 'aac', False)
+    assert main.audio_quality_label('opus', 'best') == "best"
+
+
+def test_unknown_source_codec_is_left_to_ffprobe():
+    assert main.plan_audio_output({'acodec': 'none'}, 'original', 'best') == ('best', None, None, False)
+    assert main.plan_audio_output({}, 'original', '128') == ('best', None, None, False)
+
+
+def test_planned_extension():
+    info = {'acodec': 'opus', 'ext': 'webm'}
+    assert main.planned_audio_ext(info, main.plan_audio_output(info, 'original', 'best')) == 'opus'
+    assert main.planned_audio_ext(info, main.plan_audio_output(info, 'mp3', 'best')) == 'mp3'
+    m4a = {'acodec': 'mp4a.40.2', 'ext': 'm4a'}
+    assert main.planned_audio_ext(m4a, main.plan_audio_output(m4a, 'm4a', 'best')) == 'm4a'
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+import main
+
+
+class Task:
+    def __init__(self, priority='normal'):
+        self.priority = priority
+        self.allocation = None
+
+
+def config(**overrides):
+    return {'bandwidth_limit_mbps': 0, 'bandwidth_schedule': [],
+            'bandwidth_weights': {'high': 8, 'normal': 4, 'bulk': 1}, **overrides}
+
+
+@pytest.fixture
+def governor():
+    return main.BandwidthGovernor()
+
+
+def test_unlimited_keeps_no_state(governor):
+    governor.configure(config())
+    task = Task()
+    governor.consume(task, 10 ** 9)
+    assert governor.buckets == {}
+    assert task.allocation is None
+
+
+def test_budget_is_split_by_class_weight_then_evenly(governor):
+    governor.configure(config(bandwidth_limit_mbps=26))  # 3.25 MB/s
+    high, normal, bulk_a, bulk_b = Task('high'), Task('normal'), Task('bulk'), Task('bulk')
+    for task in (high, normal, bulk_a, bulk_b):
+        governor.consume(task, 0)
+    for task in (high, normal, bulk_a, bulk_b):
+        governor.consume(task, 0)
+    limit = 26 * 125000
+    assert high.allocation == pytest.approx(limit * 8 / 13)
+    assert normal.allocation == pytest.approx(limit * 4 / 13)
+    assert bulk_a.allocation == bulk_b.allocation == pytest.approx(limit / 13 / 2)
+
+
+def test_consume_waits_for_the_share_to_pay(governor):
+    governor.configure(config(bandwidth_limit_mbps=8))  # 1 MB/s
+    task = Task()
+    start = time.monotonic()
+    governor.consume(task, 300000)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_released_task_leaves_the_split(governor):
+    governor.configure(config(bandwidth_limit_mbps=8))
+    first, second = Task(), Task()
+    governor.consume(first, 0)
+    governor.consume(second, 0)
+    governor.release(second)
+    governor.consume(first, 0)
+    assert first.allocation == pytest.approx(1000000)
+
+
+def test_limit_rate_survives_config_reloads(governor):
+    governor.configure(config(bandwidth_limit_mbps=100), cli_limit=5)
+    governor.configure(config(bandwidth_limit_mbps=100))
+    assert governor.current_limit() == 5 * 125000
+
+
+def test_schedule_window_wrapping_midnight(governor, monkeypatch):
+    governor.configure(config(bandwidth_limit_mbps=50, bandwidth_schedule=[
+        {'start': '22:00', 'end': '06:00', 'limit_mbps': 10}]))
+    for clock, mbps in (('23:30', 10), ('05:59', 10), ('06:00', 50), ('12:00', 50)):
+        hour, minute = map(int, clock.split(':'))
+        monkeypatch.setattr(main.time, 'localtime', lambda h=hour, m=minute: time.struct_time((2026, 1, 1, h, m, 0, 3, 1, 0)))
+        assert governor.current_limit() == mbps * 125000, clock
@@ -0,0 +1,64 @@
+import pytest
+
+import main
+
+PROFILE = {'download_type': '2', 'audio_quality': '192', 'audio_codec': 'mp3'}
+
+
+@pytest.fixture(autouse=True)
+def journal_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'JOURNAL_FILE', tmp_path / 'journal.sqlite3')
+
+
+def test_running_batch_is_not_offered():
+    journal = main.JobJournal.start(PROFILE, 'batch')
+    journal.add_links(['u1'])
+    assert main.JobJournal.unfinished('batch') == (None, [])
+    journal.close()
+
+
+def test_released_batch_resumes_what_is_left_in_order():
+    journal = main.JobJournal.start(PROFILE, 'batch')
+    journal.add_links(['u1', 'u2', 'u3', 'u4'])
+    journal.update('u1', 'done')
+    journal.update('u2', 'downloading', attempt=True)
+    journal.update('u4', 'failed', error='boom', attempt=True, flush=True)
+    journal.close()
+    resumed, urls = main.JobJournal.unfinished('batch')
+    assert resumed.batch_id == journal.batch_id
+    assert resumed.profile == PROFILE
+    assert urls == ['u2', 'u3', 'u4']
+    # Taken over: no other run is offered it meanwhile
+    assert main.JobJournal.unfinished('batch') == (None, [])
+    resumed.close()
+
+
+def test_links_failing_too_often_are_not_resumed():
+    journal = main.JobJournal.start(PROFILE, 'batch')
+    journal.add_links(['u1', 'u2'])
+    for _ in range(main.JOURNAL_MAX_ATTEMPTS):
+        journal.update('u1', 'failed', attempt=True, flush=True)
+    journal.close()
+    resumed, urls = main.JobJournal.unfinished('batch')
+    assert urls == ['u2']
+    resumed.close()
+
+
+def test_batches_resume_only_in_their_own_mode():
+    journal = main.JobJournal.start(PROFILE, 'sync')
+    journal.add_links(['u1'])
+    journal.close()
+    assert main.JobJournal.unfinished('batch') == (None, [])
+    resumed, urls = main.JobJournal.unfinished('sync')
+    assert urls == ['u1']
+    resumed.close()
+
+
+def test_finished_batch_is_forgotten():
+    journal = main.JobJournal.start(PROFILE, 'batch')
+    journal.add_links(['u1'])
+    journal.update('u1', 'done')
+    journal.close()
+    assert main.JobJournal.unfinished('batch') == (None, [])
+    with main._db_lock:
+        assert main.open_db(main.JOURNAL_FILE, main.JOURNAL_SCHEMA).execute("SELECT COUNT(*) FROM batches").fetchone() == (0,)
@@ -0,0 +1,62 @@
+import json
+
+import main
+
+load_progress = main.SegmentedHttpFD.load_progress
+
+PIECE = 100
+PIECES = [(0, 100), (100, 200), (200, 300), (300, 350)]
+FRESH = [0, 100, 200, 300]
+
+
+def paths(tmp_path):
+    part = tmp_path / 'video.mp4.part'
+    return str(part), str(part) + '.segments'
+
+
+def test_no_part_file_starts_fresh(tmp_path):
+    part, state = paths(tmp_path)
+    assert load_progress(part, state, PIECES, PIECE) == FRESH
+
+
+def test_saved_state_is_resumed(tmp_path):
+    part, state = paths(tmp_path)
+    with open(part, 'wb') as f:
+        f.truncate(350)
+    with open(state, 'w') as f:
+        json.dump({'piece_size': PIECE, 'reached': [100, 150, 200, 340]}, f)
+    assert load_progress(part, state, PIECES, PIECE) == [100, 150, 200, 340]
+
+
+def test_state_of_another_split_starts_fresh(tmp_path):
+    part, state = paths(tmp_path)
+    with open(part, 'wb') as f:
+        f.truncate(350)
+    with open(state, 'w') as f:
+        json.dump({'piece_size': 50, 'reached': [50] * 7}, f)
+    assert load_progress(part, state, PIECES, PIECE) == FRESH
+
+
+def test_sequential_prefix_is_kept(tmp_path):
+    # A plain download that was cut off left the first 150 bytes
+    part, state = paths(tmp_path)
+    with open(part, 'wb') as f:
+        f.write(b'x' * 150)
+    assert load_progress(part, state, PIECES, PIECE) == [100, 150, 200, 300]
+
+
+def test_preallocated_part_without_state_starts_fresh(tmp_path):
+    # A segmented run that died before saving its state leaves a sparse full-size file
+    part, state = paths(tmp_path)
+    with open(part, 'wb') as f:
+        f.truncate(350)
+    assert load_progress(part, state, PIECES, PIECE) == FRESH
+
+
+def test_corrupt_state_falls_back_to_the_prefix(tmp_path):
+    part, state = paths(tmp_path)
+    with open(part, 'wb') as f:
+        f.write(b'x' * 120)
+    with open(state, 'w') as f:
+        f.write('{"piece_size": 100, "reach')
+    assert load_progress(part, state, PIECES, PIECE) == [100, 120, 200, 300]
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+
+import main
+
+PROFILE = {'download_type': '1', 'quality': 'best'}
+LEASE = 0.3
+
+
+def stores(tmp_path, *nodes):
+    return [main.WorkStore(tmp_path / 'work.sqlite3', node, LEASE) for node in nodes]
+
+
+def test_claimed_job_is_not_claimed_twice(tmp_path):
+    a, b = stores(tmp_path, 'a', 'b')
+    assert a.enqueue(['u1', 'u2'], PROFILE) == 2
+    _, rows = a.claim(1)
+    assert [row[1] for row in rows] == ['u1']
+    _, rows = b.claim(5)
+    assert [row[1] for row in rows] == ['u2']
+    assert b.claim(5)[1] == []
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    a, b = stores(tmp_path, 'a', 'b')
+    a.enqueue(['u1'], PROFILE)
+    token, rows = a.claim(1)
+    for _ in range(3):
+        time.sleep(LEASE / 2)
+        assert a.heartbeat({rows[0][0]: token}) == []
+    assert b.claim(1)[1] == []
+    assert a.holds(rows[0][0], token)
+    assert a.finish(rows[0][0], token, 'ok') == 'done'
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    a, b = stores(tmp_path, 'a', 'b')
+    a.enqueue(['u1'], PROFILE)
+    old_token, rows = a.claim(1)
+    job_id = rows[0][0]
+    time.sleep(LEASE + 0.1)
+    assert not a.holds(job_id, old_token)
+    new_token, rows = b.claim(1)
+    assert [row[0] for row in rows] == [job_id]
+    # The old holder finds out and can no longer settle the job
+    assert a.heartbeat({job_id: old_token}) == [job_id]
+    assert not a.holds(job_id, old_token)
+    assert a.finish(job_id, old_token, 'ok') is None
+    assert b.holds(job_id, new_token)
+    assert b.finish(job_id, new_token, 'ok') == 'done'
+
+
+def test_reused_node_name_cannot_settle_an_old_lease(tmp_path):
+    a, = stores(tmp_path, 'a')
+    a.enqueue(['u1'], PROFILE)
+    old_token, rows = a.claim(1)
+    time.sleep(LEASE + 0.1)
+    new_token, _ = a.claim(1)
+    assert a.finish(rows[0][0], old_token, 'ok') is None
+    assert a.finish(rows[0][0], new_token, 'ok') == 'done'
+
+
+def test_job_fails_after_expiring_too_often(tmp_path):
+    a, = stores(tmp_path, 'a')
+    a.enqueue(['u1'], PROFILE)
+    for _ in range(main.WORK_MAX_ATTEMPTS):
+        assert len(a.claim(1)[1]) == 1
+        time.sleep(LEASE + 0.1)
+    assert a.claim(1)[1] == []
+    assert a.status()['failed'] == [{'url': 'u1', 'error': 'lease expired'}]
+
+
+def test_failed_job_is_retried_then_fails_for_good(tmp_path):
+    a, = stores(tmp_path, 'a')
+    a.enqueue(['u1'], PROFILE)
+    states = []
+    for _ in range(main.WORK_MAX_ATTEMPTS):
+        token, rows = a.claim(1)
+        states.append(a.finish(rows[0][0], token, 'failed', 'boom'))
+    assert states == ['queued'] * (main.WORK_MAX_ATTEMPTS - 1) + ['failed']
+    # Enqueueing it again gives it a fresh set of attempts
+    assert a.enqueue(['u1'], PROFILE) == 1
+
+
+def test_entries_pinned_to_a_live_node_wait_for_it(tmp_path):
+    a, b = stores(tmp_path, 'a', 'b')
+    a.enqueue(['list'], PROFILE, affinity=True)
+    token, rows = a.claim(1)
+    a.heartbeat({rows[0][0]: token})
+    a.add_entries(rows[0][0], ['e1', 'e2'], PROFILE, pinned='a')
+    assert b.claim(5)[1] == []
+    a.leave()
+    assert [row[1] for row in b.claim(5)[1]] == ['e1', 'e2']
+
+
+class MoveFiles:
+    def pp_key(self):
+        return 'MoveFiles'
+
+
+def test_lost_lease_discards_unmoved_files(tmp_path):
+    staged, library = tmp_path / 'staging', tmp_path / 'library'
+    staged.mkdir()
+    library.mkdir()
+    (staged / 'clip.mp4').write_bytes(b'video')
+    (staged / 'clip.en.vtt').write_bytes(b'subs')
+    (library / 'kept.jpg').write_bytes(b'already in place')
+    moved = []
+
+    class Downloader:
+        def run_pp(self, pp, info):
+            moved.append(info['filepath'])
+            return info
+
+    ydl = Downloader()
+    held = [True]
+    main.guard_lease(ydl, lambda: held[0])
+    info = {'filepath': str(staged / 'clip.mp4'), '__finaldir': str(library),
+            '__files_to_move': {str(staged / 'clip.en.vtt'): str(library / 'clip.en.vtt'),
+                                str(library / 'kept.jpg'): str(library / 'kept.jpg')}}
+    ydl.run_pp(MoveFiles(), info)
+    assert moved == [info['filepath']]
+
+    held[0] = False
+    with pytest.raises(main.yt_dlp.utils.DownloadCancelled):
+        ydl.run_pp(MoveFiles(), info)
+    assert moved == [info['filepath']]
+    assert sorted(path.name for path in tmp_path.rglob('*') if path.is_file()) == ['kept.jpg']